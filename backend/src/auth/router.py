@@ -1,6 +1,8 @@
 from pydantic import EmailStr
 from models import UserData, UserDataCreate
-from init import SessionLocal, redis_email, redis_username
+from init import SessionLocal
+from user_cache import user_cache, user_to_dict
+from usernames import username_resolver
 from .init import auth_router
 import json
 import bcrypt
@@ -33,16 +35,10 @@ def verify_google_password(google_credential: str, stored_credential: str) -> bo
     return google_credential == stored_credential
 
 async def user_exists(email: str) -> bool:
-    user = redis_email.get(email)
-    if user is None:
-        return False
-    return True
+    return await user_cache.exists(email=email)
 
 async def username_exists(username: str) -> bool:
-    user = redis_username.get(username)
-    if user is None:
-        return False
-    return True
+    return await user_cache.exists(username=username)
 
 async def calculate_initial_ranking() -> int:
     """Calculate the initial ranking for a new user based on existing users"""
@@ -116,10 +112,7 @@ async def decode_token(token_request: TokenRequest):
 
 @auth_router.get("/username-user",name="username-user")
 async def username_exists(username: str) -> bool:
-    user = redis_username.get(username)
-    if user is None:
-        return False
-    return True
+    return await user_cache.exists(username=username)
 
 @auth_router.post("/signup",name="signup")
 async def create_user_data(user: UserDataCreate):
@@ -151,46 +144,27 @@ async def create_user_data(user: UserDataCreate):
                 favourite=user.favourite,
                 streak=user.streak,
                 password=stored_password,
-                friends=[],
-                friendRequests=[],
                 avatar=user.avatar,
-                battles=[],
-                invitations=[]
+                battles=[]
             )
         db.add(db_user)
         await db.commit()
         await db.refresh(db_user)
 
-        user_dict = {
-            'username': db_user.username,
-            'email': db_user.email,
-            'totalBattle': db_user.totalBattle,
-            'winRate': db_user.winRate,
-            'ranking': db_user.ranking,
-            'winBattle': db_user.winBattle,
-            'favourite': db_user.favourite,
-            'streak': db_user.streak,
-            'password': db_user.password,
-            'friends': db_user.friends,
-            'friendRequests': db_user.friendRequests,
-            'avatar': db_user.avatar,
-            'battles': db_user.battles,
-            'invitations': db_user.invitations
-        }
-        redis_email.set(user.email, json.dumps(user_dict))
-        redis_username.set(user.username, json.dumps(user_dict))
+        # A new user has no friends, requests or invitations yet
+        user_dict = user_to_dict(db_user, relations={})
+        await user_cache.put(user_dict)
+        await username_resolver.registered(db_user.username)
         
         token = create_access_token(db_user.email, timedelta(minutes=1440))
         return {"access_token": token, "token_type": "bearer","user":user_dict}
     
 @auth_router.post("/signin",name="signin")
 async def get_user_data(user: UserRequest):
-        data = redis_email.get(user.email)
+        data = await user_cache.get_by_email(user.email)
         if data is None:
             raise HTTPException(status_code=404, detail="User not found")
         
-        data = json.loads(data)
-        
         # If this is a Google user, just allow sign-in if email exists
         if is_google_user(user.password):
             pass  # allow sign-in if email exists
@@ -198,18 +172,12 @@ async def get_user_data(user: UserRequest):
             if not verify_password(user.password, data['password']):
                 raise HTTPException(status_code=401, detail="Invalid password")
         
-        redis_email.set(user.email, json.dumps(data))
-        redis_username.set(data['username'], json.dumps(data))
-        
         token = create_access_token(user.email, timedelta(minutes=1440))
         return {"access_token": token, "token_type": "bearer", "user": data}
     
 @auth_router.get("/reset",name="reset-redis")
 async def reset_data():
-    for key in redis_email.scan_iter("*"):
-        redis_email.delete(key)
-    for key in redis_username.scan_iter("*"):
-        redis_username.delete(key)
+    await user_cache.flush()
     return True
 
 
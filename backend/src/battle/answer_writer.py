@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime
+from typing import List, Optional
+from sqlalchemy import insert
+from models import UserAnswer
+from init import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Flush as soon as this many answers are buffered
+ANSWER_BATCH_SIZE = int(os.getenv("ANSWER_BATCH_SIZE", "200"))
+
+# Flush at least this often while answers are pending (milliseconds)
+ANSWER_FLUSH_INTERVAL_MS = int(os.getenv("ANSWER_FLUSH_INTERVAL_MS", "500"))
+
+# Upper bound on buffered answers; submitters wait once it is reached
+ANSWER_BUFFER_LIMIT = int(os.getenv("ANSWER_BUFFER_LIMIT", "10000"))
+
+# How long a submitter may wait on a full buffer before the answer is dropped (seconds)
+ANSWER_SUBMIT_TIMEOUT = float(os.getenv("ANSWER_SUBMIT_TIMEOUT", "1.0"))
+
+_STOP = object()
+
+
+class AnswerWriter:
+    """
+    Write-behind buffer for UserAnswer rows.
+
+    Answers from every battle are queued in memory and written by one
+    background task as a single multi-row INSERT per batch, either when
+    ANSWER_BATCH_SIZE rows are waiting or every ANSWER_FLUSH_INTERVAL_MS.
+    The queue is bounded: when the database falls behind, submit() waits
+    for room (backpressure) and only drops the answer after
+    ANSWER_SUBMIT_TIMEOUT, since answers are training data and never
+    affect the battle itself.
+    """
+
+    def __init__(self, batch_size: int = ANSWER_BATCH_SIZE, flush_interval_ms: int = ANSWER_FLUSH_INTERVAL_MS,
+                 buffer_limit: int = ANSWER_BUFFER_LIMIT):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.buffer_limit = buffer_limit
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._stopping = False
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def _ensure_running(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.buffer_limit)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, username: str, battle_id: str, question_text: str, user_answer: str, correct_answer: str,
+                     is_correct: bool, sport: str, level: str, question_index: int) -> bool:
+        """Queue an answer for persistence; returns False if it had to be dropped"""
+        if self._closing:
+            logger.warning(f"[ANSWER_WRITER] Writer is shutting down, dropping answer from {username} in battle {battle_id}")
+            self.dropped += 1
+            return False
+
+        self._ensure_running()
+        row = {
+            "id": str(uuid.uuid4()),
+            "username": username,
+            "battle_id": battle_id,
+            "question_text": question_text,
+            "user_answer": user_answer if user_answer is not None else "",
+            "correct_answer": correct_answer,
+            "is_correct": is_correct,
+            "sport": sport,
+            "level": level,
+            "question_index": question_index,
+            "answered_at": datetime.utcnow(),
+        }
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        try:
+            await asyncio.wait_for(self._queue.put(row), ANSWER_SUBMIT_TIMEOUT)
+            return True
+        except asyncio.TimeoutError:
+            self.dropped += 1
+            logger.warning(f"[ANSWER_WRITER] Buffer full ({self.buffer_limit}), dropped answer from {username} in battle {battle_id}")
+            return False
+
+    async def _next_batch(self) -> List[dict]:
+        """Wait for the first row, then collect until the batch is full or the flush interval passes"""
+        loop = asyncio.get_event_loop()
+        batch = []
+        row = await self._queue.get()
+        deadline = loop.time() + self.flush_interval
+        while row is not _STOP:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                return batch
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                return batch
+            try:
+                row = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                return batch
+        # Shutdown sentinel: everything queued before it is in this batch or already written
+        self._stopping = True
+        return batch
+
+    async def _write(self, rows: List[dict]):
+        if not rows:
+            return
+        try:
+            async with SessionLocal() as session:
+                await session.execute(insert(UserAnswer), rows)
+                await session.commit()
+            self.written += len(rows)
+            logger.info(f"[ANSWER_WRITER] Flushed {len(rows)} answers ({self.pending} pending)")
+        except Exception as e:
+            self.failed += len(rows)
+            logger.error(f"[ANSWER_WRITER] Error flushing {len(rows)} answers: {str(e)}")
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                batch = await self._next_batch()
+                await self._write(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[ANSWER_WRITER] Error in writer loop: {str(e)}")
+
+    async def shutdown(self):
+        """Stop accepting answers and flush everything still buffered"""
+        self._closing = True
+        if self._task is not None and not self._task.done():
+            # The sentinel queues behind every pending row, so the writer drains them first
+            await self._queue.put(_STOP)
+            await self._task
+        self._task = None
+        logger.info(f"[ANSWER_WRITER] Shut down: written={self.written}, dropped={self.dropped}, failed={self.failed}")
+
+
+# Global writer instance shared by all battle websockets
+answer_writer = AnswerWriter()
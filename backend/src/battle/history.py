@@ -0,0 +1,62 @@
+import logging
+from datetime import datetime
+from typing import List, Optional, Tuple
+from sqlalchemy import select, union_all, and_, or_
+from sqlalchemy.orm import aliased
+from models import BattleModel
+
+logger = logging.getLogger(__name__)
+
+# Largest page a history endpoint will return in one request
+MAX_HISTORY_PAGE = 200
+
+
+def encode_cursor(battle: BattleModel) -> str:
+    return f"{battle.created_at.isoformat()}|{battle.id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Split a cursor into (created_at, id); raises ValueError on a malformed cursor"""
+    created_at, _, battle_id = cursor.partition("|")
+    if not battle_id:
+        raise ValueError(f"invalid cursor: {cursor}")
+    return datetime.fromisoformat(created_at), battle_id
+
+
+def _opponent_page(column, username: str, limit: int, after: Optional[Tuple[datetime, str]]):
+    stmt = select(BattleModel).where(column == username)
+    if after is not None:
+        created_at, battle_id = after
+        stmt = stmt.where(or_(
+            BattleModel.created_at < created_at,
+            and_(BattleModel.created_at == created_at, BattleModel.id < battle_id)
+        ))
+    return stmt.order_by(BattleModel.created_at.desc(), BattleModel.id.desc()).limit(limit)
+
+
+async def fetch_battle_history(session, username: str, limit: int, cursor: Optional[str] = None) -> Tuple[List[BattleModel], Optional[str]]:
+    """
+    One page of a user's battles, newest first, and the cursor for the next page.
+
+    Each side of the UNION ALL is a range scan on its (opponent, created_at, id)
+    index, so a page costs one query however many battles the user has.
+    """
+    limit = max(1, min(limit, MAX_HISTORY_PAGE))
+    after = decode_cursor(cursor) if cursor else None
+
+    # One extra row tells us whether there is a next page
+    page = union_all(
+        _opponent_page(BattleModel.first_opponent, username, limit + 1, after),
+        _opponent_page(BattleModel.second_opponent, username, limit + 1, after),
+    ).subquery()
+    battle = aliased(BattleModel, page)
+    result = await session.execute(
+        select(battle).order_by(page.c.created_at.desc(), page.c.id.desc()).limit(limit + 1)
+    )
+    rows = list(result.scalars().all())
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1])
+    return rows, next_cursor
@@ -1,4 +1,5 @@
 from fastapi import APIRouter
+from battle.lobby import lobby
 
 battle_router = APIRouter()
 
@@ -68,4 +69,75 @@ class Battle:
       else:
         return "nothing"
     
-battles = {key: value for key, value in []}
\ No newline at end of file
+battles = {key: value for key, value in []}
+
+# username -> id of the battle they are playing in (both seats taken)
+active_by_user = {}
+# battle id -> (first_opponent, second_opponent) for battles in play
+battle_players = {}
+
+def _take_seat(battle: Battle, username: str):
+    battle.second_opponent = username
+    battle_players[battle.id] = (battle.first_opponent, username)
+    active_by_user[battle.first_opponent] = battle.id
+    active_by_user[username] = battle.id
+
+async def find_battle(battle_id: str):
+    """The battle as this worker holds it, or rebuilt from the lobby entry if another worker created it"""
+    battle = battles.get(battle_id)
+    if battle is not None:
+        return battle
+    entry = await lobby.get(battle_id)
+    if entry is None:
+        return None
+    return Battle(id=entry["id"], first_opponent=entry["first_opponent"], sport=entry["sport"], level=entry["level"])
+
+async def seat_opponent(battle: Battle, username: str):
+    """
+    Take the second seat of a waiting battle created on any worker.
+
+    Removing the lobby entry is the claim, so of two concurrent joins only
+    one gets the seat. Returns the lobby change, or None if the battle was
+    joined or cancelled first.
+    """
+    change = await lobby.remove(battle.id, seated_by=username)
+    if change is None:
+        return None
+    battles[battle.id] = battle
+    _take_seat(battle, username)
+    return change
+
+def adopt_claim(battle_id: str, seated_by):
+    """Another worker took one of our battles out of the lobby: seat our copy too, or forget it if it was cancelled"""
+    battle = battles.get(battle_id)
+    if battle is None or battle.second_opponent:
+        return
+    if seated_by:
+        _take_seat(battle, seated_by)
+    else:
+        forget_battle(battle_id)
+
+def forget_battle(battle_id: str):
+    """Remove a battle from this worker's memory and active indexes, leaving the lobby alone"""
+    battle = battles.pop(battle_id, None)
+    for username in battle_players.pop(battle_id, ()):
+        if active_by_user.get(username) == battle_id:
+            del active_by_user[username]
+    return battle
+
+async def drop_battle(battle_id: str):
+    """Remove a battle from memory, the lobby and the active indexes; returns the lobby change if it was still waiting"""
+    forget_battle(battle_id)
+    return await lobby.remove(battle_id)
+
+async def withdraw_battle(battle_id: str):
+    """Take a waiting battle out of the lobby and forget it; None, with nothing forgotten, if it was joined first"""
+    change = await lobby.remove(battle_id)
+    if change is not None:
+        forget_battle(battle_id)
+    return change
+
+def active_battle_for(username: str):
+    """The battle this user is currently playing, if any"""
+    battle_id = active_by_user.get(username)
+    return battles.get(battle_id) if battle_id else None
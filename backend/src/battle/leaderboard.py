@@ -0,0 +1,261 @@
+import logging
+import os
+import uuid
+from typing import Awaitable, Callable, Iterable, List, Optional
+import redis.asyncio as aioredis
+from sqlalchemy import select, update, bindparam
+from init import SessionLocal
+from models import UserData
+from redis_pool import redis_pool
+from scheduler import scheduler
+from user_cache import user_cache
+
+logger = logging.getLogger(__name__)
+
+# Sorted set of user email -> composite ranking score
+LEADERBOARD_KEY = "leaderboard:points"
+
+# Delay before changed rankings are written back to Postgres (seconds)
+LEADERBOARD_PERSIST_DELAY = int(os.getenv("LEADERBOARD_PERSIST_DELAY", "30"))
+
+# Users read per round trip when the whole leaderboard is rebuilt or persisted
+LEADERBOARD_REBUILD_CHUNK = int(os.getenv("LEADERBOARD_REBUILD_CHUNK", "1000"))
+
+# Hash {lo, hi} of the 0-based rank positions whose occupant may have changed since the
+# last persist; hi = -1 means "to the end of the set"
+LEADERBOARD_DIRTY_KEY = "leaderboard:dirty"
+
+# Widen the dirty range to cover [lo, hi] (hi = -1: to the end)
+_MERGE_DIRTY = """
+local function merge(lo, hi)
+    local cur_lo = redis.call('HGET', KEYS[2], 'lo')
+    local cur_hi = redis.call('HGET', KEYS[2], 'hi')
+    if cur_lo then lo = math.min(lo, tonumber(cur_lo)) end
+    if cur_hi then
+        cur_hi = tonumber(cur_hi)
+        if cur_hi == -1 or hi == -1 then hi = -1 else hi = math.max(hi, cur_hi) end
+    end
+    redis.call('HSET', KEYS[2], 'lo', lo, 'hi', hi)
+end
+"""
+
+# ZADD (or ZREM when ARGV[2] is empty) one member and mark the ranks it shifted.
+# Moving from rank a to rank b only reorders positions a..b; a new member shifts
+# everything from its rank down, and a removed one everything below it.
+_RESCORE = _MERGE_DIRTY + """
+local old = redis.call('ZREVRANK', KEYS[1], ARGV[1])
+if ARGV[2] == '' then
+    if not old then return 0 end
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    merge(old, -1)
+    return 1
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+local new = redis.call('ZREVRANK', KEYS[1], ARGV[1])
+if not old then
+    merge(new, -1)
+elseif old ~= new then
+    merge(math.min(old, new), math.max(old, new))
+end
+return 1
+"""
+
+# Put back a range taken by a persist that failed
+_MARK_DIRTY = _MERGE_DIRTY + """
+merge(tonumber(ARGV[1]), tonumber(ARGV[2]))
+return 1
+"""
+
+# Take and clear the dirty range: {lo, hi} or nil
+_TAKE_DIRTY = """
+local range = redis.call('HMGET', KEYS[1], 'lo', 'hi')
+if not range[1] then return nil end
+redis.call('DEL', KEYS[1])
+return range
+"""
+
+
+def compute_points(total_battle: int, win_battle: int, win_rate: int, streak: int) -> int:
+    """Ranking points for a user based on wins, win rate, streak and experience"""
+    base_points = win_battle * 100  # 100 points per win
+
+    # Win rate bonus (0-50 points)
+    win_rate_bonus = min(50, win_rate // 2) if win_rate > 0 else 0
+
+    # Streak bonus (0-100 points)
+    streak_bonus = min(100, streak * 10) if streak > 0 else 0
+
+    # Experience bonus (0-25 points)
+    experience_bonus = min(25, total_battle // 4) if total_battle > 0 else 0
+
+    # Consistency bonus (bonus for high win rate with many battles)
+    consistency_bonus = 0
+    if total_battle >= 10 and win_rate >= 70:
+        consistency_bonus = 25
+    elif total_battle >= 5 and win_rate >= 80:
+        consistency_bonus = 15
+
+    # New user bonus (encourage new players)
+    new_user_bonus = 0
+    if total_battle <= 3 and win_battle > 0:
+        new_user_bonus = 20  # Bonus for winning early battles
+
+    return base_points + win_rate_bonus + streak_bonus + experience_bonus + consistency_bonus + new_user_bonus
+
+
+def ranking_score(points: int, wins: int, win_rate: int) -> float:
+    """Pack the (points, wins, win rate) sort key into one sorted-set score"""
+    return points * 1_000_000_000 + min(wins, 999_999) * 1_000 + min(max(win_rate, 0), 999)
+
+
+class Leaderboard:
+    """
+    Leaderboard kept in a Redis sorted set.
+
+    A finished battle only re-scores its two players (ZADD); a rank is read
+    on demand with ZREVRANK. The ranking column in Postgres and the cached
+    user dicts are written back lazily by a debounced background job. Each
+    re-score records the span of rank positions it shifted, so the job only
+    reads that slice of the set and those users' rows.
+    """
+
+    def __init__(self):
+        self._client: Optional[aioredis.Redis] = None
+        self._scripts = {}
+
+    def _redis(self) -> aioredis.Redis:
+        if self._client is None:
+            self._client = redis_pool.client()
+            self._scripts = {
+                "rescore": self._client.register_script(_RESCORE),
+                "mark": self._client.register_script(_MARK_DIRTY),
+                "take": self._client.register_script(_TAKE_DIRTY),
+            }
+        return self._client
+
+    async def update_users(self, users: Iterable[dict]):
+        """Re-score users from their stats dicts (email, totalBattle, winBattle, winRate, streak)"""
+        client = self._redis()
+        async with client.pipeline(transaction=False) as pipe:
+            for user in users:
+                points = compute_points(user.get("totalBattle", 0), user.get("winBattle", 0),
+                                        user.get("winRate", 0), user.get("streak", 0))
+                score = ranking_score(points, user.get("winBattle", 0), user.get("winRate", 0))
+                await self._scripts["rescore"](keys=[LEADERBOARD_KEY, LEADERBOARD_DIRTY_KEY], args=[user["email"], score], client=pipe)
+            await pipe.execute()
+        self.schedule_persist()
+
+    async def remove(self, email: str):
+        self._redis()
+        await self._scripts["rescore"](keys=[LEADERBOARD_KEY, LEADERBOARD_DIRTY_KEY], args=[email, ""])
+        self.schedule_persist()
+
+    async def rank_of(self, email: str) -> Optional[int]:
+        rank = await self._redis().zrevrank(LEADERBOARD_KEY, email)
+        return None if rank is None else rank + 1
+
+    async def top(self, limit: int = -1) -> List[str]:
+        """Emails in rank order"""
+        return await self._redis().zrevrange(LEADERBOARD_KEY, 0, limit - 1 if limit > 0 else -1)
+
+    async def size(self) -> int:
+        return await self._redis().zcard(LEADERBOARD_KEY)
+
+    async def rebuild(self, progress: Optional[Callable[[int], Awaitable]] = None) -> int:
+        """
+        Recompute every user's score from Postgres and replace the sorted set (repair / startup path).
+
+        Rows are streamed LEADERBOARD_REBUILD_CHUNK at a time into a staging
+        set that is renamed over the live one at the end, so readers never
+        see a partial leaderboard. progress(count) is awaited after each chunk.
+        """
+        client = self._redis()
+        staging = f"{LEADERBOARD_KEY}:rebuild:{uuid.uuid4().hex}"
+        count = 0
+        try:
+            async with SessionLocal() as db:
+                result = await db.stream(
+                    select(UserData.email, UserData.totalBattle, UserData.winBattle, UserData.winRate, UserData.streak)
+                    .execution_options(yield_per=LEADERBOARD_REBUILD_CHUNK)
+                )
+                async for rows in result.partitions():
+                    await client.zadd(staging, {
+                        row.email: ranking_score(compute_points(row.totalBattle, row.winBattle, row.winRate, row.streak),
+                                                 row.winBattle, row.winRate)
+                        for row in rows
+                    })
+                    count += len(rows)
+                    if progress is not None:
+                        await progress(len(rows))
+
+            async with client.pipeline(transaction=True) as pipe:
+                if count:
+                    pipe.rename(staging, LEADERBOARD_KEY)
+                else:
+                    pipe.delete(LEADERBOARD_KEY)
+                await pipe.execute()
+        finally:
+            await client.delete(staging)
+        # Every rank may have moved
+        await self._scripts["mark"](keys=[LEADERBOARD_KEY, LEADERBOARD_DIRTY_KEY], args=[0, -1])
+        await self.persist()
+        logger.info(f"[LEADERBOARD] Rebuilt leaderboard for {count} users")
+        return count
+
+    def schedule_persist(self):
+        """Debounce write-back: one persist per LEADERBOARD_PERSIST_DELAY however many battles finish"""
+        if not scheduler.is_scheduled(("leaderboard_persist",)):
+            scheduler.schedule(("leaderboard_persist",), LEADERBOARD_PERSIST_DELAY, self.persist)
+
+    async def persist(self) -> int:
+        """Write ranks that changed back to Postgres and the user caches, reading only the dirty rank range"""
+        client = self._redis()
+        taken = await self._scripts["take"](keys=[LEADERBOARD_DIRTY_KEY])
+        if not taken:
+            return 0
+        lo, hi = int(taken[0]), int(taken[1])
+
+        try:
+            ranked = await client.zrevrange(LEADERBOARD_KEY, lo, hi)
+            new_ranks = {email: rank for rank, email in enumerate(ranked, lo + 1)}
+            changed = []
+            async with SessionLocal() as db:
+                for start in range(0, len(ranked), LEADERBOARD_REBUILD_CHUNK):
+                    chunk = ranked[start:start + LEADERBOARD_REBUILD_CHUNK]
+                    result = await db.execute(select(UserData.email, UserData.ranking).where(UserData.email.in_(chunk)))
+                    changed.extend(
+                        {"b_email": email, "b_ranking": new_ranks[email]}
+                        for email, ranking in result.all()
+                        if ranking != new_ranks[email]
+                    )
+                if changed:
+                    await db.execute(
+                        update(UserData.__table__)
+                        .where(UserData.__table__.c.email == bindparam("b_email"))
+                        .values(ranking=bindparam("b_ranking")),
+                        changed
+                    )
+                    await db.commit()
+        except Exception:
+            # Leave the range for the next persist
+            await self._scripts["mark"](keys=[LEADERBOARD_KEY, LEADERBOARD_DIRTY_KEY], args=[lo, hi])
+            raise
+
+        if changed:
+            await user_cache.update_fields({item["b_email"]: {"ranking": item["b_ranking"]} for item in changed})
+        logger.info(f"[LEADERBOARD] Persisted {len(changed)} changed rankings from ranks {lo + 1}..{'end' if hi < 0 else hi + 1}")
+        return len(changed)
+
+    async def shutdown(self):
+        if scheduler.is_scheduled(("leaderboard_persist",)):
+            scheduler.cancel(("leaderboard_persist",))
+            try:
+                await self.persist()
+            except Exception as e:
+                logger.error(f"[LEADERBOARD] Error persisting rankings on shutdown: {str(e)}")
+        # The pooled client itself is closed with the pool
+        self._client = None
+
+
+# Global leaderboard instance
+leaderboard = Leaderboard()
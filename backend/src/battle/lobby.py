@@ -0,0 +1,368 @@
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+import redis.asyncio as aioredis
+from config import WORKER_ID
+from notification_bus import NOTIFICATION_BUS_BACKEND
+from redis_pool import redis_pool
+
+logger = logging.getLogger(__name__)
+
+# "local" keeps the lobby in this process only; "redis" shares entries, version and change log
+# between workers. Follows the notification bus, which is what carries lobby frames across workers
+LOBBY_BACKEND = os.getenv("LOBBY_BACKEND", NOTIFICATION_BUS_BACKEND)
+
+# Number of lobby changes kept for "changes since version N" requests
+LOBBY_CHANGE_LOG = int(os.getenv("LOBBY_CHANGE_LOG", "1000"))
+
+# Shared lobby keys: battle id -> entry JSON, the version counter, the newest-first change
+# log, and one set of waiting battle ids per creator
+LOBBY_ENTRIES_KEY = "lobby:entries"
+LOBBY_VERSION_KEY = "lobby:version"
+LOBBY_CHANGES_KEY = "lobby:changes"
+LOBBY_CREATOR_PREFIX = "lobby:creator:"
+
+# Channel a worker announces on after taking a battle out of the shared lobby, so the
+# worker that created the battle can seat (or forget) its own copy
+LOBBY_CLAIM_CHANNEL = "lobby_claims"
+
+# KEYS: entries, version, changes (, creator set); ARGV[1]: change log size.
+# Bump the version and log one change; data is already JSON encoded
+_RECORD = """
+local function record(op, data)
+    local version = redis.call('INCR', KEYS[2])
+    local change = '{"version":' .. version .. ',"op":"' .. op .. '","data":' .. data .. '}'
+    redis.call('LPUSH', KEYS[3], change)
+    redis.call('LTRIM', KEYS[3], 0, tonumber(ARGV[1]) - 1)
+    return change
+end
+"""
+
+# ARGV: log size, battle id, entry JSON
+_ADD = _RECORD + """
+redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+redis.call('SADD', KEYS[4], ARGV[2])
+return record('added', ARGV[3])
+"""
+
+# ARGV: log size, battle id, creator key prefix. Only the caller that actually
+# deletes the entry gets a change back; everyone else gets nil
+_REMOVE = _RECORD + """
+local entry = redis.call('HGET', KEYS[1], ARGV[2])
+if not entry then return nil end
+redis.call('HDEL', KEYS[1], ARGV[2])
+redis.call('SREM', ARGV[3] .. cjson.decode(entry)['first_opponent'], ARGV[2])
+return record('removed', cjson.encode(ARGV[2]))
+"""
+
+# ARGV: log size, avatar
+_UPDATE_CREATOR = _RECORD + """
+local changes = {}
+for _, battle_id in ipairs(redis.call('SMEMBERS', KEYS[4])) do
+    local raw = redis.call('HGET', KEYS[1], battle_id)
+    if raw then
+        local entry = cjson.decode(raw)
+        if entry['creator_avatar'] ~= ARGV[2] then
+            entry['creator_avatar'] = ARGV[2]
+            raw = cjson.encode(entry)
+            redis.call('HSET', KEYS[1], battle_id, raw)
+            table.insert(changes, record('updated', raw))
+        end
+    end
+end
+return changes
+"""
+
+# KEYS: version, changes; ARGV: the client's version.
+# {version, 0} when the log cannot answer, else {version, 1, change...} oldest first
+_CHANGES_SINCE = """
+local version = tonumber(redis.call('GET', KEYS[1]) or '0')
+local since = tonumber(ARGV[1])
+if since < 0 or since > version then return {version, 0} end
+local count = version - since
+if count == 0 then return {version, 1} end
+if count > redis.call('LLEN', KEYS[2]) then return {version, 0} end
+local result = {version, 1}
+local changes = redis.call('LRANGE', KEYS[2], 0, count - 1)
+for i = #changes, 1, -1 do table.insert(result, changes[i]) end
+return result
+"""
+
+
+def _entry(battle, creator_avatar: str) -> dict:
+    return {
+        "id": battle.id,
+        "first_opponent": battle.first_opponent,
+        "sport": battle.sport,
+        "level": battle.level,
+        "creator_avatar": creator_avatar or ''
+    }
+
+
+def _snapshot(version: int, battles: List[dict]) -> dict:
+    return {
+        "version": version,
+        "battles": battles,
+        "frame": json.dumps({"type": "waiting_battles", "version": version, "data": battles}),
+    }
+
+
+class LocalLobby:
+    """
+    Index of waiting battles (no second opponent yet) for this worker.
+
+    Entries are maintained on create, join and cancel and already carry
+    the creator's avatar, so listing the lobby never touches the database.
+    Every change bumps a version and is kept in a bounded change log; a
+    client that knows version N can ask for just the changes after it.
+    Mutations return the change they recorded, or None if nothing changed.
+    """
+
+    shared = False
+
+    def __init__(self, change_log: int = LOBBY_CHANGE_LOG):
+        self.entries: Dict[str, dict] = {}
+        self.by_creator: Dict[str, set] = {}
+        self.version = 0
+        self._changes = deque(maxlen=change_log)
+        self._snapshot: Optional[dict] = None
+
+    def _record(self, op: str, data) -> dict:
+        self.version += 1
+        change = {"version": self.version, "op": op, "data": data}
+        self._changes.append(change)
+        self._snapshot = None
+        return change
+
+    async def add(self, battle, creator_avatar: str = '') -> dict:
+        entry = _entry(battle, creator_avatar)
+        self.entries[battle.id] = entry
+        self.by_creator.setdefault(battle.first_opponent, set()).add(battle.id)
+        return self._record("added", entry)
+
+    async def remove(self, battle_id: str, seated_by: Optional[str] = None) -> Optional[dict]:
+        """Drop a battle that was joined (by seated_by), cancelled or expired; a no-op if it is not waiting"""
+        entry = self.entries.pop(battle_id, None)
+        if entry is None:
+            return None
+        owned = self.by_creator.get(entry["first_opponent"])
+        if owned is not None:
+            owned.discard(battle_id)
+            if not owned:
+                del self.by_creator[entry["first_opponent"]]
+        return self._record("removed", battle_id)
+
+    async def update_creator(self, username: str, avatar: str) -> List[dict]:
+        """Refresh the cached creator avatar after a profile change"""
+        changes = []
+        for battle_id in self.by_creator.get(username, ()):
+            entry = self.entries[battle_id]
+            if entry["creator_avatar"] == (avatar or ''):
+                continue
+            entry = dict(entry, creator_avatar=avatar or '')
+            self.entries[battle_id] = entry
+            changes.append(self._record("updated", entry))
+        return changes
+
+    async def get(self, battle_id: str) -> Optional[dict]:
+        return self.entries.get(battle_id)
+
+    async def waiting_for(self, username: str) -> List[dict]:
+        return [self.entries[battle_id] for battle_id in self.by_creator.get(username, ())]
+
+    async def battles(self) -> List[dict]:
+        return (await self.snapshot())["battles"]
+
+    async def snapshot(self) -> dict:
+        """Full lobby at the current version; rebuilt only after a change"""
+        if self._snapshot is None:
+            self._snapshot = _snapshot(self.version, list(self.entries.values()))
+        return self._snapshot
+
+    async def snapshot_frame(self) -> str:
+        """The encoded waiting_battles message sent on connect"""
+        return (await self.snapshot())["frame"]
+
+    @staticmethod
+    def delta(event_type: str, change: dict) -> dict:
+        """A lobby change message (battle_created, battle_removed, ...) stamped with the version of its change"""
+        return {"type": event_type, "version": change["version"], "data": change["data"]}
+
+    async def changes_since(self, version: int) -> Tuple[int, Optional[List[dict]]]:
+        """(current version, changes after `version`); changes is None if the log no longer reaches back that far"""
+        if version == self.version:
+            return self.version, []
+        if version < 0 or version > self.version or not self._changes or self._changes[0]["version"] > version + 1:
+            return self.version, None
+        return self.version, [change for change in self._changes if change["version"] > version]
+
+    async def shutdown(self):
+        return None
+
+
+class RedisLobby(LocalLobby):
+    """
+    Lobby shared by every worker.
+
+    Entries, the version counter and the capped change log live in Redis
+    and are only changed through Lua scripts, so the version a client sees
+    in a delta from one worker means the same thing to
+    /get_waiting_battles_since on any other. The snapshot is still cached
+    in this process and reused while the shared version has not moved.
+    """
+
+    shared = True
+
+    def __init__(self, change_log: int = LOBBY_CHANGE_LOG):
+        self.change_log = change_log
+        self._snapshot: Optional[dict] = None
+        self._client: Optional[aioredis.Redis] = None
+        self._scripts = {}
+        self._listener: Optional[asyncio.Task] = None
+
+    def _redis(self) -> aioredis.Redis:
+        if self._client is None:
+            self._client = redis_pool.client()
+            self._scripts = {
+                "add": self._client.register_script(_ADD),
+                "remove": self._client.register_script(_REMOVE),
+                "update_creator": self._client.register_script(_UPDATE_CREATOR),
+                "changes_since": self._client.register_script(_CHANGES_SINCE),
+            }
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.get_event_loop().create_task(self._listen())
+        return self._client
+
+    @staticmethod
+    def _log_keys(creator: Optional[str] = None) -> list:
+        keys = [LOBBY_ENTRIES_KEY, LOBBY_VERSION_KEY, LOBBY_CHANGES_KEY]
+        if creator is not None:
+            keys.append(f"{LOBBY_CREATOR_PREFIX}{creator}")
+        return keys
+
+    async def add(self, battle, creator_avatar: str = '') -> dict:
+        self._redis()
+        change = await self._scripts["add"](
+            keys=self._log_keys(battle.first_opponent),
+            args=[self.change_log, battle.id, json.dumps(_entry(battle, creator_avatar))],
+        )
+        return json.loads(change)
+
+    async def remove(self, battle_id: str, seated_by: Optional[str] = None) -> Optional[dict]:
+        """
+        Drop a battle that was joined (by seated_by), cancelled or expired.
+
+        The entry is the battle's free seat: only the one caller that deletes
+        it gets the change back, whichever worker it runs on. The other
+        workers are then told, so the creator's worker updates its copy.
+        """
+        client = self._redis()
+        change = await self._scripts["remove"](
+            keys=self._log_keys(), args=[self.change_log, battle_id, LOBBY_CREATOR_PREFIX]
+        )
+        if not change:
+            return None
+        try:
+            await client.publish(LOBBY_CLAIM_CHANNEL, json.dumps({
+                "origin": WORKER_ID,
+                "battle_id": battle_id,
+                "seated_by": seated_by,
+            }))
+        except Exception as e:
+            logger.error(f"[LOBBY] Error announcing removal of battle {battle_id}: {str(e)}")
+        return json.loads(change)
+
+    async def update_creator(self, username: str, avatar: str) -> List[dict]:
+        """Refresh the cached creator avatar after a profile change"""
+        self._redis()
+        changes = await self._scripts["update_creator"](
+            keys=self._log_keys(username), args=[self.change_log, avatar or '']
+        )
+        return [json.loads(change) for change in changes or ()]
+
+    async def get(self, battle_id: str) -> Optional[dict]:
+        raw = await self._redis().hget(LOBBY_ENTRIES_KEY, battle_id)
+        return json.loads(raw) if raw else None
+
+    async def waiting_for(self, username: str) -> List[dict]:
+        client = self._redis()
+        battle_ids = await client.smembers(f"{LOBBY_CREATOR_PREFIX}{username}")
+        if not battle_ids:
+            return []
+        return [json.loads(raw) for raw in await client.hmget(LOBBY_ENTRIES_KEY, list(battle_ids)) if raw]
+
+    async def snapshot(self) -> dict:
+        """Full lobby at the current shared version; re-read only after a change on any worker"""
+        client = self._redis()
+        version = int(await client.get(LOBBY_VERSION_KEY) or 0)
+        if self._snapshot is not None and self._snapshot["version"] == version:
+            return self._snapshot
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.get(LOBBY_VERSION_KEY)
+            pipe.hvals(LOBBY_ENTRIES_KEY)
+            version, entries = await pipe.execute()
+        self._snapshot = _snapshot(int(version or 0), [json.loads(raw) for raw in entries])
+        return self._snapshot
+
+    async def changes_since(self, version: int) -> Tuple[int, Optional[List[dict]]]:
+        """(current version, changes after `version`); changes is None if the log no longer reaches back that far"""
+        self._redis()
+        result = await self._scripts["changes_since"](
+            keys=[LOBBY_VERSION_KEY, LOBBY_CHANGES_KEY], args=[version]
+        )
+        current = int(result[0])
+        if not int(result[1]):
+            return current, None
+        return current, [json.loads(change) for change in result[2:]]
+
+    async def _listen(self):
+        from battle.init import adopt_claim
+        while True:
+            pubsub = self._client.pubsub()
+            try:
+                await pubsub.subscribe(LOBBY_CLAIM_CHANNEL)
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    try:
+                        claim = json.loads(message["data"])
+                    except (ValueError, TypeError):
+                        continue
+                    if claim.get("origin") == WORKER_ID:
+                        continue
+                    adopt_claim(claim.get("battle_id"), claim.get("seated_by"))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[LOBBY] Claim subscription error, reconnecting: {str(e)}")
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    async def shutdown(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        # The pooled client itself is closed with the pool
+        self._client = None
+
+
+def create_lobby():
+    if LOBBY_BACKEND == "redis":
+        logger.info(f"[LOBBY] Using shared Redis lobby (worker {WORKER_ID})")
+        return RedisLobby()
+    return LocalLobby()
+
+
+# Global lobby instance
+lobby = create_lobby()
@@ -1,13 +1,20 @@
-from battle.init import Battle,battle_router,battles
-from models import UserDataCreate,UserData
-from fastapi import  Query
+from battle.init import Battle,battle_router,battles,seat_opponent,drop_battle,find_battle
+from battle.lobby import lobby
+from models import UserData
+from fastapi import  Query, Response, Depends
 from fastapi import HTTPException
 from init import SessionLocal
 from models import BattleModel
 import uuid
-from init import redis_username,redis_email
 from tasks import queue_quiz_generation_task
-from db.router import update_user_data,get_user_by_username,repair_user_battles
+from db.router import get_user_by_username,repair_user_battles
+from battle.leaderboard import leaderboard, compute_points
+from battle.history import fetch_battle_history, MAX_HISTORY_PAGE
+from friends.relations import add_invitation, remove_invitation, clear_invitations
+from user_cache import user_cache
+from typing import Optional
+from redis_pool import get_redis
+from quiz_events import questions_key
 
 import json
 import math
@@ -42,38 +49,26 @@ async def create_battle(first_opponent: str, sport: str = Query(...), level: str
             # Don't fail the battle creation if quiz generation fails
             # The battle can still proceed with fallback questions
         
-        # Broadcast new battle to all connected users via WebSocket
+        # The creator's avatar is looked up once here and cached in the lobby entry
         try:
-            from websocket import manager
-            
-            # Get creator's user data to include avatar
             creator_user = await get_user_by_username(first_opponent)
             creator_avatar = creator_user.get('avatar', '') if creator_user else ''
-            
-            # Prepare battle data for broadcast
-            battle_data = {
-                "id": battle_id,
-                "first_opponent": first_opponent,
-                "sport": sport,
-                "level": level,
-                "creator_avatar": creator_avatar
-            }
+        except Exception as e:
+            logger.error(f"Failed to load creator profile for battle {battle_id}: {str(e)}")
+            creator_avatar = ''
+        change = await lobby.add(battles[battle_id], creator_avatar)
+        
+        # Broadcast new battle to all connected users via WebSocket
+        try:
+            from websocket import manager
             
             # Broadcast to all connected users
-            broadcast_message = {
-                "type": "battle_created",
-                "data": battle_data
-            }
+            broadcast_message = lobby.delta("battle_created", change)
             
-            logger.info(f"Broadcasting battle creation to all connected users: {battle_data}")
+            logger.info(f"Broadcasting battle creation to all connected users: {change['data']}")
             
-            # Send to all connected users
-            for connected_user in manager.active_connections.keys():
-                try:
-                    await manager.send_message(json.dumps(broadcast_message), connected_user)
-                    logger.info(f"Sent battle creation notification to {connected_user}")
-                except Exception as e:
-                    logger.error(f"Failed to send battle creation notification to {connected_user}: {str(e)}")
+            # Encoded once and shared by every connected user on every worker
+            await manager.broadcast(broadcast_message)
                     
         except Exception as e:
             logger.error(f"Failed to broadcast battle creation: {str(e)}")
@@ -84,57 +79,66 @@ async def create_battle(first_opponent: str, sport: str = Query(...), level: str
         logger.error(f"Error creating battle: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to create battle: {str(e)}")
 
+async def _broadcast_removal(change, exclude=()):
+    """Announce a battle leaving the lobby, stamped with the version of that change; None means nothing was removed"""
+    if change is None:
+        return
+    try:
+        from websocket import manager
+        await manager.broadcast(lobby.delta("battle_removed", change), exclude=exclude)
+    except Exception as e:
+        logger.error(f"Failed to broadcast battle removal: {str(e)}")
+
 @battle_router.delete("/delete")
 async def delete_battle(battle_id: str):
     logger.info(f"Attempting to delete battle {battle_id}")
     logger.info(f"Available battles before deletion: {list(battles.keys())}")
     
-    if battle_id in battles:
-        battles.pop(battle_id)
+    held = battle_id in battles
+    # Also takes a waiting battle created on another worker out of the shared lobby
+    change = await drop_battle(battle_id)
+    if held or change is not None:
         logger.info(f"Battle {battle_id} deleted successfully")
         logger.info(f"Available battles after deletion: {list(battles.keys())}")
 
-        # Broadcast battle removal to all connected users
-        try:
-            from websocket import manager
-            
-            broadcast_message = {
-                "type": "battle_removed",
-                "data": battle_id
-            }
-            
-            logger.info(f"Broadcasting battle removal to all connected users: {battle_id}")
-            
-            # Send to all connected users
-            for connected_user in manager.active_connections.keys():
-                try:
-                    await manager.send_message(json.dumps(broadcast_message), connected_user)
-                    logger.info(f"Sent battle removal notification to {connected_user}")
-                except Exception as e:
-                    logger.error(f"Failed to send battle removal notification to {connected_user}: {str(e)}")
-                    
-        except Exception as e:
-            logger.error(f"Failed to broadcast battle removal: {str(e)}")
+        # Broadcast battle removal to all connected users, if it was still waiting
+        logger.info(f"Broadcasting battle removal to all connected users: {battle_id}")
+        await _broadcast_removal(change)
     else:
         logger.warning(f"Battle {battle_id} not found in memory for deletion")
 
     return {"message": "Battle deleted successfully"}
 
 
+async def _drop_invitation(friend_user: dict, battle_id: str) -> bool:
+    """Remove one invitation row and the cached entry; False if the user had no such invitation"""
+    async with SessionLocal() as db:
+        removed = await remove_invitation(db, friend_user['email'], battle_id)
+        await db.commit()
+    if removed:
+        await user_cache.edit_lists({friend_user['email']: [("remove", "invitations", battle_id)]})
+    return removed
+
+async def clear_battle_invitations(battle_id: str) -> list:
+    """Withdraw every outstanding invitation to a battle; returns the usernames that had one"""
+    async with SessionLocal() as db:
+        invited = await clear_invitations(db, battle_id)
+        await db.commit()
+    await user_cache.edit_lists({email: [("remove", "invitations", battle_id)] for email in invited})
+    return list(invited.values())
+
 @battle_router.post("/invite-friend")
 async def invite_friend(battle_id: str, friend_username: str):
     friend_user = await get_user_by_username(friend_username)
     if not friend_user:
         raise HTTPException(status_code=401, detail="Friend not found")
     
-    if battle_id in friend_user['invitations']:
+    async with SessionLocal() as db:
+        added = await add_invitation(db, friend_user['email'], battle_id)
+        await db.commit()
+    if not added:
         return False
-    friend_user['invitations'].append(battle_id)    
-
-    user_data = UserDataCreate(
-        **friend_user
-    )
-    await update_user_data(user_data)
+    await user_cache.edit_lists({friend_user['email']: [("add", "invitations", battle_id)]})
     return True
 
 @battle_router.post("/cancel-invitation")
@@ -143,28 +147,7 @@ async def cancel_invitation(friend_username: str, battle_id: str):
     if not friend_user:
         raise HTTPException(status_code=401, detail="Friend not found")
 
-    if battle_id not in friend_user['invitations']:
-        return False
-    friend_user['invitations'].remove(battle_id)
-        
-    user_data = UserDataCreate(
-         streak=friend_user['streak'],
-         winRate=friend_user['winRate'],
-         winBattle=friend_user['winBattle'],
-         ranking=friend_user['ranking'],
-         totalBattle=friend_user['totalBattle'],
-         favourite=friend_user['favourite'],
-         avatar=friend_user['avatar'],
-         username=friend_user['username'],
-         email=friend_user['email'],
-         password=friend_user['password'],
-         friends=friend_user['friends'],
-         friendRequests=friend_user['friendRequests'],
-         battles=friend_user['battles'],
-         invitations=friend_user['invitations']
-        )
-    await update_user_data(user_data)
-    return True
+    return await _drop_invitation(friend_user, battle_id)
 
 @battle_router.post("/accept-invitation")
 async def accept_invitation(friend_username: str, battle_id: str):
@@ -175,24 +158,22 @@ async def accept_invitation(friend_username: str, battle_id: str):
     if battle_id not in friend_user['invitations']:
         raise HTTPException(status_code=400, detail="Invitation not found")
     
-    battle = battles.get(battle_id)
+    # The battle may have been created on another worker
+    battle = await find_battle(battle_id)
     if not battle:
         raise HTTPException(status_code=404, detail="Battle not found")
     
+    # Remove invitation and add friend as second opponent; the seat goes to whoever claims it first
+    await _drop_invitation(friend_user, battle_id)
+    change = None if battle.second_opponent else await seat_opponent(battle, friend_username)
+    
     # Check if battle already has a second opponent
-    if battle.second_opponent:
-        # Remove the invitation since the battle is full
-        friend_user['invitations'].remove(battle_id)
-        user_data = UserDataCreate(**friend_user)
-        await update_user_data(user_data)
+    if change is None:
+        # A stale lobby entry is dropped like any other removal, so the version matches a logged change
+        await _broadcast_removal(await lobby.remove(battle_id))
         raise HTTPException(status_code=409, detail="Battle is already full. Another player has already joined.")
     
-    # Remove invitation and add friend as second opponent
-    friend_user['invitations'].remove(battle_id)
-    user_data = UserDataCreate(**friend_user)
-    await update_user_data(user_data)
-    
-    battle.second_opponent = friend_username
+    await _broadcast_removal(change, exclude=(battle.first_opponent, battle.second_opponent))
     return True
 
 @battle_router.post("/reject-invitation")
@@ -209,19 +190,13 @@ async def reject_invitation(friend_username: str, battle_id: str):
             logger.error(f"Friend {friend_username} not found")
             raise HTTPException(status_code=401, detail="Friend not found")
 
-        if battle_id not in friend_user['invitations']:
+        # Remove the invitation from the friend's list
+        if not await _drop_invitation(friend_user, battle_id):
             logger.warning(f"Battle {battle_id} not found in {friend_username}'s invitations")
             return False
-            
-        # Remove the invitation from the friend's list
-        friend_user['invitations'].remove(battle_id)
-        
-        # Update the friend's data
-        user_data = UserDataCreate(**friend_user)
-        await update_user_data(user_data)
         
-        # Get the battle to find the creator
-        battle = battles.get(battle_id)
+        # Get the battle to find the creator, wherever it was created
+        battle = await find_battle(battle_id)
         if battle:
             battle_creator = battle.first_opponent
             logger.info(f"Battle creator {battle_creator} will be notified of rejection")
@@ -243,18 +218,13 @@ async def reject_invitation(friend_username: str, battle_id: str):
                 }
                 
                 # Send notification to battle creator if they're connected
-                if battle_creator in manager.active_connections:
-                    await manager.send_message(json.dumps(rejection_message), battle_creator)
-                    logger.info(f"Sent rejection notification to battle creator {battle_creator}")
-                else:
-                    logger.info(f"Battle creator {battle_creator} is not connected, notification will be sent when they connect")
+                # send_message reaches the user on whichever worker holds their socket
+                await manager.send_message(json.dumps(rejection_message), battle_creator)
+                logger.info(f"Sent rejection notification to battle creator {battle_creator}")
                 
                 # Also send notification to the user who rejected the invitation
-                if friend_username in manager.active_connections:
-                    await manager.send_message(json.dumps(rejection_message), friend_username)
-                    logger.info(f"Sent rejection notification to user who rejected {friend_username}")
-                else:
-                    logger.info(f"User who rejected {friend_username} is not connected, notification will be sent when they connect")
+                await manager.send_message(json.dumps(rejection_message), friend_username)
+                logger.info(f"Sent rejection notification to user who rejected {friend_username}")
                     
             except Exception as e:
                 logger.error(f"Failed to send rejection notification: {str(e)}")
@@ -271,285 +241,93 @@ async def reject_invitation(friend_username: str, battle_id: str):
 
 @battle_router.post("/battle_result")
 async def battle_result(battle_id: str, winner: str, loser: str, result: str):
-    import math
-    import json
-    # Import here to avoid circular import
-    from db.router import update_user_data, get_user_by_username
-    from init import redis_username, redis_email
-
     battle = battles.get(battle_id)
     if not battle:
         raise HTTPException(status_code=401, detail="Battle not found")
-    async with SessionLocal() as session:
-        # Save battle to DB
-        battle_db = BattleModel(
-            id=battle_id,
-            sport=battle.sport,
-            level=battle.level,
-            first_opponent=battle.first_opponent,
-            second_opponent=battle.second_opponent,
-            first_opponent_score=battle.first_opponent_score,
-            second_opponent_score=battle.second_opponent_score
-        )
-        session.add(battle_db)
-        await session.commit()
-        await session.refresh(battle_db)
-    if battle_id in battles:
-        del battles[battle_id]
-    # --- Begin repair-style update logic, but increment stats for this battle ---
-    from models import UserData, BattleModel
-    from init import redis_username, redis_email, SessionLocal
-    import math
-    import logging
-    logger = logging.getLogger(__name__)
-    try:
-        async with SessionLocal() as db:
-            # Get all users
-            users_result = await db.execute(select(UserData))
-            users = users_result.scalars().all()
-            # Get all battles
-            battles_result = await db.execute(select(BattleModel))
-            battles = battles_result.scalars().all()
-            # Build a mapping from username to battle objects
-            user_battles_map = {user.username: [] for user in users}
-            for battle in battles:
-                if battle.first_opponent:
-                    user_battles_map.setdefault(battle.first_opponent, []).append(battle)
-                if battle.second_opponent:
-                    user_battles_map.setdefault(battle.second_opponent, []).append(battle)
-            # Update each user
-            for user in users:
-                user_battles = user_battles_map.get(user.username, [])
-                user_battles.sort(key=lambda b: str(b.id))
-                battle_ids = [b.id for b in user_battles]
-                user.battles = battle_ids
-                user.totalBattle = len(battle_ids)
-                # Calculate winBattle and streak
-                win_count = 0
-                streak = 0
-                current_streak = 0
-                for battle in reversed(user_battles):  # Most recent first
-                    if battle.first_opponent == user.username:
-                        my_score = battle.first_opponent_score
-                        opp_score = battle.second_opponent_score
-                    else:
-                        my_score = battle.second_opponent_score
-                        opp_score = battle.first_opponent_score
-                    if my_score > opp_score:
-                        win_count += 1
-                        current_streak += 1
-                    else:
-                        if my_score == opp_score:
-                            current_streak = 0
-                        else:
-                            current_streak = 0
-                    if streak == 0 and current_streak > 0:
-                        streak = current_streak
-                user.winBattle = win_count
-                user.streak = streak
-                user.winRate = math.floor((user.winBattle / user.totalBattle) * 100) if user.totalBattle > 0 else 0
-                try:
-                    await db.commit()
-                    await db.refresh(user)
-                    # Update Redis
-                    user_dict = {
-                        'username': user.username,
-                        'email': user.email,
-                        'totalBattle': user.totalBattle,
-                        'winRate': user.winRate,
-                        'ranking': user.ranking,
-                        'winBattle': user.winBattle,
-                        'favourite': user.favourite,
-                        'streak': user.streak,
-                        'password': user.password,
-                        'friends': user.friends,
-                        'friendRequests': user.friendRequests,
-                        'avatar': user.avatar,
-                        'battles': user.battles,
-                        'invitations': user.invitations
-                    }
-                    redis_username.set(user.username, json.dumps(user_dict))
-                    redis_email.set(user.email, json.dumps(user_dict))
-                    logger.info(f"[RESULT-REPAIR] Updated user {user.username}: battles={user.totalBattle}, wins={user.winBattle}, streak={user.streak}, winRate={user.winRate}")
-                except Exception as e:
-                    logger.error(f"[RESULT-REPAIR] Failed to update user {user.username}: {str(e)}")
-    except Exception as e:
-        logger.error(f"[RESULT-REPAIR] Fatal error in result repair logic: {str(e)}")
-    # --- End repair-style update logic ---
+    await drop_battle(battle_id)
+    # Battle row and both players' stats commit together; a replayed result is a no-op
+    from battle.stats import record_battle_result, WIN, LOSS
+    await record_battle_result({
+        'id': battle_id,
+        'sport': battle.sport,
+        'level': battle.level,
+        'first_opponent': battle.first_opponent,
+        'second_opponent': battle.second_opponent,
+        'first_opponent_score': battle.first_opponent_score,
+        'second_opponent_score': battle.second_opponent_score
+    }, {winner: WIN, loser: LOSS})
     return True
 
 @battle_router.post("/battle_draw_result", tags=["battle"])
 async def battle_draw_result(battle_id: str, first_opponent: str, second_opponent: str, score1: int, score2: int):
     logger.info(f"[BATTLE_ROUTER] battle_draw_result called for battle_id={battle_id}, {first_opponent}({score1})-{second_opponent}({score2})")
+    from battle.stats import record_battle_result, DRAW
     try:
-        from models import BattleModel
-        from init import SessionLocal
-        async with SessionLocal() as session:
-            battle_db = BattleModel(
-                id=battle_id,
-                sport=None,
-                level=None,
-                first_opponent=first_opponent,
-                second_opponent=second_opponent,
-                first_opponent_score=score1,
-                second_opponent_score=score2
-            )
-            session.add(battle_db)
-            await session.commit()
-            await session.refresh(battle_db)
-            logger.info(f"[BATTLE_ROUTER] Battle {battle_id} (draw) saved to database.")
-    except Exception as e:
-        logger.error(f"[BATTLE_ROUTER] Error saving draw battle: {str(e)}\n{traceback.format_exc()}")
-        return {"success": False, "error": str(e)}
-    
-    # Update user stats for both users
-    from db.router import update_user_statistics, get_user_by_username
-    import math
-    try:
-        usernames = [first_opponent, second_opponent]
-        for username in usernames:
-            user = await get_user_by_username(username)
-            if not user:
-                logger.error(f"[BATTLE_ROUTER] User {username} not found for draw update")
-                continue
-                
-            new_total_battle = user['totalBattle'] + 1
-            new_win_battle = user['winBattle']  # No win for draw
-            new_streak = 0  # Draw breaks streak
-            new_win_rate = math.floor((new_win_battle / new_total_battle) * 100) if new_total_battle > 0 else 0
-            
-            # Update battles list
-            battles_list = user.get('battles', [])
-            if battle_id not in battles_list:
-                battles_list.append(battle_id)
-            
-            success = await update_user_statistics(
-                username=username,
-                total_battle=new_total_battle,
-                win_battle=new_win_battle,
-                streak=new_streak,
-                win_rate=new_win_rate,
-                battles_list=battles_list
-            )
-            if not success:
-                logger.error(f"[BATTLE_ROUTER] Failed to update user {username} for draw")
-                return {"success": False, "error": f"Failed to update user {username} for draw"}
-            else:
-                logger.info(f"[BATTLE_ROUTER] Successfully updated user {username} for draw: totalBattle={new_total_battle}, winBattle={new_win_battle}, streak={new_streak}, winRate={new_win_rate}")
-                
+        updated = await record_battle_result({
+            'id': battle_id,
+            'sport': None,
+            'level': None,
+            'first_opponent': first_opponent,
+            'second_opponent': second_opponent,
+            'first_opponent_score': score1,
+            'second_opponent_score': score2
+        }, {first_opponent: DRAW, second_opponent: DRAW})
+        if updated is None:
+            logger.info(f"[BATTLE_ROUTER] Battle {battle_id} (draw) was already recorded.")
+            return {"success": True}
+        logger.info(f"[BATTLE_ROUTER] Battle {battle_id} (draw) saved to database.")
+        for username, user in updated.items():
+            logger.info(f"[BATTLE_ROUTER] Successfully updated user {username} for draw: totalBattle={user['totalBattle']}, winBattle={user['winBattle']}, streak={user['streak']}, winRate={user['winRate']}")
         logger.info(f"[BATTLE_ROUTER] User stats updated for both users (draw).")
     except Exception as e:
-        logger.error(f"[BATTLE_ROUTER] Error updating user stats for draw: {str(e)}\n{traceback.format_exc()}")
+        logger.error(f"[BATTLE_ROUTER] Error saving draw battle: {str(e)}\n{traceback.format_exc()}")
         return {"success": False, "error": str(e)}
     return {"success": True}
 
+async def _battle_history_page(username: str, limit: int, cursor: Optional[str], response: Response) -> list:
+    """One keyset page of a user's battles, newest first; the next cursor goes in X-Next-Cursor"""
+    try:
+        async with SessionLocal() as session:
+            rows, next_cursor = await fetch_battle_history(session, username, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return [row.to_json() for row in rows]
+
 @battle_router.get("/get_battles")
-async def get_battles(username: str):
-    """Get all battles for a user, sorted by recency (newest first)"""
-    # Import here to avoid circular import
-    from db.router import get_user_by_username
-    logger.info(f"[BATTLE_ROUTER] Getting all battles for user: {username}")
-    user = await get_user_by_username(username)
-    if not user:
-        logger.error(f"[BATTLE_ROUTER] User {username} not found in DB (get_battles)")
-        return []
-    battles_user = user['battles']
-    logger.info(f"[BATTLE_ROUTER] User {username} has {len(battles_user)} battles in their list: {battles_user}")
-    battles_list = []
-    async with SessionLocal() as session:
-        for battle_id in battles_user:
-            logger.info(f"[BATTLE_ROUTER] Looking up battle {battle_id} in database")
-            battle_data = await session.get(BattleModel, battle_id)
-            if battle_data:
-                logger.info(f"[BATTLE_ROUTER] Found battle {battle_id} in database: {battle_data.to_json()}")
-                battles_list.append(battle_data.to_json())
-            else:
-                logger.warning(f"[BATTLE_ROUTER] Battle {battle_id} not found in database")
-    battles_list.sort(key=lambda x: x['id'], reverse=True)
+async def get_battles(response: Response, username: str, limit: int = MAX_HISTORY_PAGE, cursor: Optional[str] = None):
+    """Get battles for a user, newest first, paginated with the X-Next-Cursor header"""
+    logger.info(f"[BATTLE_ROUTER] Getting battles for user: {username} (limit: {limit})")
+    battles_list = await _battle_history_page(username, limit, cursor, response)
     logger.info(f"[BATTLE_ROUTER] Returning {len(battles_list)} battles for user {username} (sorted by recency)")
     return battles_list
 
 @battle_router.get("/get_recent_battles")
-async def get_recent_battles(username: str, limit: int = 4):
+async def get_recent_battles(response: Response, username: str, limit: int = 4, cursor: Optional[str] = None):
     """Get recent battles for a user, sorted by recency (newest first)"""
-    # Import here to avoid circular import
-    from db.router import get_user_by_username
     logger.info(f"[BATTLE_ROUTER] Getting recent battles for user: {username} (limit: {limit})")
-    user = await get_user_by_username(username)
-    if not user:
-        logger.error(f"[BATTLE_ROUTER] User {username} not found in DB (get_recent_battles)")
-        return []
-    battles_user = user['battles']
-    logger.info(f"[BATTLE_ROUTER] User {username} has {len(battles_user)} battles in their list: {battles_user}")
-    battles_list = []
-    async with SessionLocal() as session:
-        for battle_id in battles_user:
-            logger.info(f"[BATTLE_ROUTER] Looking up battle {battle_id} in database")
-            battle_data = await session.get(BattleModel, battle_id)
-            if battle_data:
-                logger.info(f"[BATTLE_ROUTER] Found battle {battle_id} in database: {battle_data.to_json()}")
-                battles_list.append(battle_data.to_json())
-            else:
-                logger.warning(f"[BATTLE_ROUTER] Battle {battle_id} not found in database")
-    battles_list.sort(key=lambda x: x['id'], reverse=True)
-    battles_list = battles_list[:limit]
+    battles_list = await _battle_history_page(username, limit, cursor, response)
     logger.info(f"[BATTLE_ROUTER] Returning {len(battles_list)} recent battles for user {username}")
     return battles_list
 
 @battle_router.get("/get_waiting_battles")
 async def get_waiting_battles():
-    waiting_battles = []
-    for battle in battles.values():
-        if battle.second_opponent == '':  
-            # Get the creator's user data to include avatar
-            try:
-                creator_user = await get_user_by_username(battle.first_opponent)
-                waiting_battles.append({
-                    "id": battle.id,
-                    "first_opponent": battle.first_opponent,
-                    "sport": battle.sport,
-                    "level": battle.level,
-                    "creator_avatar": creator_user.get('avatar', '') if creator_user else ''
-                })
-            except Exception as e:
-                # If we can't get user data, include battle without avatar
-                waiting_battles.append({
-                    "id": battle.id,
-                    "first_opponent": battle.first_opponent,
-                    "sport": battle.sport,
-                    "level": battle.level,
-                    "creator_avatar": ''
-                })
-    return waiting_battles
+    """Waiting battles from the lobby index, with the creator avatar already attached"""
+    return await lobby.battles()
+
+@battle_router.get("/get_waiting_battles_since")
+async def get_waiting_battles_since(version: int):
+    """Lobby changes after `version`; falls back to a full snapshot when the change log no longer reaches back"""
+    current, changes = await lobby.changes_since(version)
+    if changes is None:
+        snapshot = await lobby.snapshot()
+        return {"version": snapshot["version"], "snapshot": snapshot["battles"]}
+    return {"version": current, "changes": changes}
 
 async def calculate_user_points(user: UserData) -> int:
     """Calculate ranking points for a user based on multiple factors"""
-    base_points = user.winBattle * 100  # 100 points per win
-    
-    # Win rate bonus (0-50 points)
-    win_rate_bonus = min(50, user.winRate // 2) if user.winRate > 0 else 0
-    
-    # Streak bonus (0-100 points)
-    streak_bonus = min(100, user.streak * 10) if user.streak > 0 else 0
-    
-    # Experience bonus (0-25 points)
-    experience_bonus = min(25, user.totalBattle // 4) if user.totalBattle > 0 else 0
-    
-    # Consistency bonus (bonus for high win rate with many battles)
-    consistency_bonus = 0
-    if user.totalBattle >= 10 and user.winRate >= 70:
-        consistency_bonus = 25
-    elif user.totalBattle >= 5 and user.winRate >= 80:
-        consistency_bonus = 15
-    
-    # New user bonus (encourage new players)
-    new_user_bonus = 0
-    if user.totalBattle <= 3 and user.winBattle > 0:
-        new_user_bonus = 20  # Bonus for winning early battles
-    
-    total_points = base_points + win_rate_bonus + streak_bonus + experience_bonus + consistency_bonus + new_user_bonus
-    
-    return total_points
+    return compute_points(user.totalBattle, user.winBattle, user.winRate, user.streak)
 
 def get_ranking_tier(points: int) -> dict:
     """Get ranking tier information based on points"""
@@ -597,58 +375,11 @@ def get_ranking_tier(points: int) -> dict:
         }
 
 async def update_user_rankings():
-    """Update all user rankings based on a sophisticated points system"""
+    """Rebuild the whole leaderboard from Postgres; finished battles use leaderboard.update_users instead"""
     try:
-        async with SessionLocal() as db:
-            # Get all users
-            stmt = select(UserData)
-            result = await db.execute(stmt)
-            users = result.scalars().all()
-            
-            # Calculate points for each user
-            user_points = []
-            for user in users:
-                points = await calculate_user_points(user)
-                user_points.append({
-                    'user': user,
-                    'points': points,
-                    'wins': user.winBattle,
-                    'win_rate': user.winRate,
-                    'streak': user.streak,
-                    'total_battles': user.totalBattle
-                })
-            
-            # Sort by points (descending), then by wins (descending), then by win rate (descending)
-            user_points.sort(key=lambda x: (x['points'], x['wins'], x['win_rate']), reverse=True)
-            
-            # Update rankings
-            for index, user_data in enumerate(user_points, 1):
-                user = user_data['user']
-                user.ranking = index
-                
-                # Update Redis cache
-                user_dict = {
-                    'username': user.username,
-                    'email': user.email,
-                    'totalBattle': user.totalBattle,
-                    'winRate': user.winRate,
-                    'ranking': index,
-                    'winBattle': user.winBattle,
-                    'favourite': user.favourite,
-                    'streak': user.streak,
-                    'password': user.password,
-                    'friends': user.friends,
-                    'friendRequests': user.friendRequests,
-                    'avatar': user.avatar,
-                    'battles': user.battles,
-                    'invitations': user.invitations
-                }
-                redis_email.set(user.email, json.dumps(user_dict))
-                redis_username.set(user.username, json.dumps(user_dict))
-            
-            await db.commit()
-            logger.info(f"Updated rankings for {len(users)} users")
-            return True
+        count = await leaderboard.rebuild()
+        logger.info(f"Updated rankings for {count} users")
+        return True
     except Exception as e:
         logger.error(f"Error updating rankings: {str(e)}")
         return False
@@ -661,19 +392,6 @@ async def initialize_rankings():
     except Exception as e:
         logger.error(f"Error initializing rankings: {str(e)}")
 
-# Initialize rankings on module import
-import asyncio
-try:
-    loop = asyncio.get_event_loop()
-    if loop.is_running():
-        # If loop is running, schedule the initialization
-        loop.create_task(initialize_rankings())
-    else:
-        # If loop is not running, run it
-        loop.run_until_complete(initialize_rankings())
-except Exception as e:
-    logger.error(f"Could not initialize rankings: {str(e)}")
-
 @battle_router.post("/recalculate-rankings")
 async def recalculate_rankings():
     """Manually recalculate all user rankings"""
@@ -687,17 +405,13 @@ async def recalculate_rankings():
         raise HTTPException(status_code=500, detail=f"Error recalculating rankings: {str(e)}")
 
 @battle_router.get("/quiz-status/{battle_id}")
-async def get_quiz_generation_status(battle_id: str):
+async def get_quiz_generation_status(battle_id: str, redis_client=Depends(get_redis)):
     """
     Check the status of manual quiz generation for a battle
     """
     try:
         # Check if questions are already generated and cached
-        import redis
-        redis_client = redis.Redis.from_url("redis://redis:6379/0")
-        questions_key = f"battle_questions:{battle_id}"
-        
-        cached_questions = redis_client.get(questions_key)
+        cached_questions = await redis_client.get(questions_key(battle_id))
         if cached_questions:
             questions = json.loads(cached_questions)
             return {
@@ -721,16 +435,12 @@ async def get_quiz_generation_status(battle_id: str):
         raise HTTPException(status_code=500, detail="Error checking quiz status")
 
 @battle_router.get("/quiz/{battle_id}")
-async def get_battle_quiz(battle_id: str):
+async def get_battle_quiz(battle_id: str, redis_client=Depends(get_redis)):
     """
     Get the generated manual quiz questions for a battle
     """
     try:
-        import redis
-        redis_client = redis.Redis.from_url("redis://redis:6379/0")
-        questions_key = f"battle_questions:{battle_id}"
-        
-        cached_questions = redis_client.get(questions_key)
+        cached_questions = await redis_client.get(questions_key(battle_id))
         if not cached_questions:
             raise HTTPException(status_code=404, detail="Quiz questions not found or still being generated")
         
@@ -745,28 +455,10 @@ async def get_battle_quiz(battle_id: str):
         raise HTTPException(status_code=500, detail="Error retrieving quiz")
 
 @battle_router.get("/get_all_battles")
-async def get_all_battles_for_user(username: str):
-    """Get all battles for a specific user, sorted by recency (newest first)"""
-    # Import here to avoid circular import
-    from db.router import get_user_by_username
+async def get_all_battles_for_user(response: Response, username: str, limit: int = MAX_HISTORY_PAGE, cursor: Optional[str] = None):
+    """Get all battles for a specific user, newest first, paginated with the X-Next-Cursor header"""
     logger.info(f"[BATTLE_ROUTER] Getting all battles for user: {username}")
-    user = await get_user_by_username(username)
-    if not user:
-        logger.error(f"[BATTLE_ROUTER] User {username} not found in DB (get_all_battles_for_user)")
-        return []
-    battles_user = user['battles']
-    logger.info(f"[BATTLE_ROUTER] User {username} has {len(battles_user)} battles in their list: {battles_user}")
-    battles_list = []
-    async with SessionLocal() as session:
-        for battle_id in battles_user:
-            logger.info(f"[BATTLE_ROUTER] Looking up battle {battle_id} in database")
-            battle_data = await session.get(BattleModel, battle_id)
-            if battle_data:
-                logger.info(f"[BATTLE_ROUTER] Found battle {battle_id} in database: {battle_data.to_json()}")
-                battles_list.append(battle_data.to_json())
-            else:
-                logger.warning(f"[BATTLE_ROUTER] Battle {battle_id} not found in database")
-    battles_list.sort(key=lambda x: x['id'], reverse=True)
+    battles_list = await _battle_history_page(username, limit, cursor, response)
     logger.info(f"[BATTLE_ROUTER] Returning {len(battles_list)} all battles for user {username} (sorted by recency)")
     return battles_list
 
@@ -0,0 +1,241 @@
+import asyncio
+import json
+import logging
+from scheduler import scheduler
+
+logger = logging.getLogger(__name__)
+
+
+_CORRECT_FLAGS = ("correct", "isCorrect", "correct_answer", "is_correct")
+
+
+class AnswerKey:
+    """Compiled answer key for one question: the correct label and its position in the answers list"""
+
+    __slots__ = ("label", "index")
+
+    def __init__(self, label, index: int = -1):
+        self.label = label
+        self.index = index
+
+    def matches(self, answer) -> bool:
+        return self.label is not None and answer == self.label
+
+
+def compile_answer_key(question: dict) -> AnswerKey:
+    """Resolve the correct answer of a question once, accepting every flag spelling the generators have used"""
+    answers = question.get("answers", [])
+    for i, ans in enumerate(answers):
+        for flag in _CORRECT_FLAGS:
+            if ans.get(flag, False):
+                return AnswerKey(ans.get("label", ""), i)
+
+    for field in ("correctAnswer", "correct_answer", "correct"):
+        if field in question:
+            label = question[field]
+            index = next((i for i, ans in enumerate(answers) if ans.get("label") == label), -1)
+            return AnswerKey(label, index)
+    return AnswerKey(None)
+
+
+def compile_answer_keys(questions: list) -> list:
+    return [compile_answer_key(q) for q in questions]
+
+
+class BattleRuntime:
+    """
+    All live state for one running battle.
+
+    Replaces the parallel per-battle dicts that battle_ws.py used to keep
+    (connections, questions, scores, answers, progress, timers, finished
+    status) so that an answer is a single dict lookup and teardown is a
+    single pop.
+    """
+
+    __slots__ = (
+        "battle_id",
+        "sport",
+        "level",
+        "players",
+        "questions",
+        "answer_keys",
+        "scores",
+        "answers",
+        "progress",
+        "finished",
+        "finished_at",
+        "sockets",
+        "started_at",
+        "last_activity",
+        "completion_checks",
+        "completion_triggered",
+        "processing_completion",
+        "owner",
+        "quiz_frame",
+        "question_frames",
+    )
+
+    def __init__(self, battle_id: str, questions: list, players: tuple = (), sport: str = "football", level: str = "medium"):
+        now = asyncio.get_event_loop().time()
+        self.battle_id = battle_id
+        self.sport = sport
+        self.level = level
+        self.players = tuple(p for p in players if p)
+        self.questions = questions
+        self.answer_keys = compile_answer_keys(questions)
+        self.scores = {p: 0 for p in self.players}
+        self.answers = {}
+        self.progress = {p: -1 for p in self.players}  # -1 means not started
+        self.finished = {}
+        self.finished_at = {}
+        self.sockets = {}
+        self.started_at = now
+        self.last_activity = now
+        self.completion_checks = 0
+        self.completion_triggered = False
+        self.processing_completion = False
+        self.owner = False
+        self.quiz_frame = None
+        self.question_frames = None
+
+    @property
+    def question_count(self) -> int:
+        return len(self.questions)
+
+    def quiz_ready_frame(self) -> str:
+        """The quiz_ready frame is identical for every player, so it is encoded once per battle"""
+        if self.quiz_frame is None:
+            self.quiz_frame = json.dumps({"type": "quiz_ready", "questions": self.questions})
+        return self.quiz_frame
+
+    def next_question_frame(self, q_index: int) -> str:
+        """Splice the pre-encoded question into a frame; only the small scores envelope is encoded per send"""
+        if self.question_frames is None:
+            self.question_frames = [json.dumps(q) for q in self.questions]
+        return (
+            f'{{"type": "next_question", "question_index": {q_index}, '
+            f'"question": {self.question_frames[q_index]}, "scores": {json.dumps(self.scores)}}}'
+        )
+
+    def touch(self):
+        self.last_activity = asyncio.get_event_loop().time()
+
+    def opponent_of(self, username: str):
+        for player in self.players:
+            if player != username:
+                return player
+        return None
+
+    def resolve_players(self):
+        """Return (user1, user2), falling back to the score table if players are unknown"""
+        if len(self.players) >= 2:
+            return self.players[0], self.players[1]
+        score_keys = list(self.scores.keys())
+        if len(score_keys) >= 2:
+            return score_keys[0], score_keys[1]
+        return None, None
+
+    def record_answer(self, username: str, q_index: int, answer) -> bool:
+        """Store an answer; returns False if this question was already answered"""
+        user_answers = self.answers.get(username)
+        if user_answers is None:
+            user_answers = self.answers[username] = []
+        elif len(user_answers) > q_index:
+            return False
+        while len(user_answers) <= q_index:
+            user_answers.append(None)
+        user_answers[q_index] = answer
+        return True
+
+    def grade(self, username: str, q_index: int, answer) -> bool:
+        correct = self.answer_keys[q_index].matches(answer)
+        if correct:
+            self.scores[username] = self.scores.get(username, 0) + 1
+        self.progress[username] = q_index
+        return correct
+
+    def adopt_players(self, players: tuple, sport: str, level: str):
+        """Fill in players for a battle whose lobby entry lives on another worker"""
+        self.players = tuple(p for p in players if p)
+        self.sport = sport
+        self.level = level
+        for p in self.players:
+            self.scores.setdefault(p, 0)
+            self.progress.setdefault(p, -1)
+
+    def note_answer(self, username: str, q_index: int, answer):
+        """Keep a local copy of an answer that the shared state already accepted"""
+        user_answers = self.answers.setdefault(username, [])
+        while len(user_answers) <= q_index:
+            user_answers.append(None)
+        user_answers[q_index] = answer
+        if q_index > self.progress.get(username, -1):
+            self.progress[username] = q_index
+
+    def apply_shared_state(self, scores=None, progress=None, answer_counts=None, finished_at=None, last_activity=None):
+        """Overwrite local fields with the values held by a shared battle state backend"""
+        if scores:
+            self.scores.update(scores)
+        if progress:
+            self.progress.update(progress)
+        if answer_counts:
+            for username, count in answer_counts.items():
+                user_answers = self.answers.setdefault(username, [])
+                while len(user_answers) < count:
+                    user_answers.append(None)
+        if finished_at:
+            for username, at in finished_at.items():
+                self.finished[username] = True
+                self.finished_at.setdefault(username, at)
+        if last_activity is not None and last_activity > self.last_activity:
+            self.last_activity = last_activity
+
+    def mark_finished(self, username: str):
+        now = asyncio.get_event_loop().time()
+        self.finished[username] = True
+        self.finished_at[username] = now
+        self.progress[username] = len(self.questions) - 1
+        self.last_activity = now
+
+    def correct_label(self, q_index: int):
+        return self.answer_keys[q_index].label
+
+    def finished_users(self) -> list:
+        return [u for u, finished in self.finished.items() if finished]
+
+    def answer_count(self, username: str) -> int:
+        return len(self.answers.get(username, ()))
+
+    def add_socket(self, username: str, websocket):
+        self.sockets[username] = websocket
+
+    def remove_socket(self, username: str, websocket=None):
+        current = self.sockets.get(username)
+        if current is not None and (websocket is None or current is websocket):
+            del self.sockets[username]
+
+    def other_sockets(self, websocket):
+        return [ws for ws in self.sockets.values() if ws is not websocket]
+
+
+# battle_id -> BattleRuntime
+battle_runtimes = {}
+
+
+def get_runtime(battle_id: str):
+    return battle_runtimes.get(battle_id)
+
+
+def release_runtime(battle_id: str, drop_battle: bool = True):
+    """Single teardown path for a battle: drops the runtime, its pending timers and, unless told otherwise, the lobby entry"""
+    runtime = battle_runtimes.pop(battle_id, None)
+    scheduler.cancel_group(battle_id)
+    if drop_battle:
+        from battle.init import forget_battle, drop_battle as drop
+        battle = forget_battle(battle_id)
+        if battle is not None and not battle.second_opponent:
+            # Released before anyone joined: it leaves the lobby too
+            asyncio.get_event_loop().create_task(drop(battle_id))
+    if runtime is not None:
+        logger.info(f"[BATTLE_RUNTIME] Released runtime for battle {battle_id}")
+    return runtime
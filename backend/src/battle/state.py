@@ -0,0 +1,346 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Optional
+import redis.asyncio as aioredis
+from config import WORKER_ID
+from redis_pool import redis_pool
+
+logger = logging.getLogger(__name__)
+
+# "local" keeps battle state in this process only; "redis" shares it between workers
+BATTLE_STATE_BACKEND = os.getenv("BATTLE_STATE_BACKEND", "local")
+
+# Lifetime of a battle's shared keys; refreshed on every answer
+BATTLE_STATE_TTL = 2 * 60 * 60
+
+# Owner lease duration; the owner renews it every third of this
+BATTLE_LEASE_MS = int(os.getenv("BATTLE_LEASE_MS", "15000"))
+
+# Channel every worker listens on for frames addressed to sockets it holds
+BATTLE_ROUTE_CHANNEL = "battle_route"
+
+
+async def _send_local(runtime, frame: str, only: Optional[str] = None, exclude: Optional[str] = None) -> int:
+    sent = 0
+    for player, ws in list(runtime.sockets.items()):
+        if (only is not None and player != only) or (exclude is not None and player == exclude):
+            continue
+        try:
+            await ws.send_text(frame)
+            sent += 1
+        except Exception as e:
+            logger.error(f"[BATTLE_STATE] Error sending to {player} in battle {runtime.battle_id}: {str(e)}")
+            runtime.remove_socket(player, ws)
+    return sent
+
+
+class LocalBattleState:
+    """Single-process backend: the BattleRuntime itself is the source of truth"""
+
+    shared = False
+
+    async def register(self, runtime):
+        return runtime
+
+    async def submit_answer(self, runtime, username: str, q_index: int, answer) -> Optional[bool]:
+        """Record and grade an answer; returns None for a duplicate, otherwise whether it was correct"""
+        if not runtime.record_answer(username, q_index, answer):
+            return None
+        return runtime.grade(username, q_index, answer)
+
+    async def mark_finished(self, runtime, username: str):
+        runtime.mark_finished(username)
+
+    async def refresh(self, runtime):
+        return runtime
+
+    async def acquire_lease(self, battle_id: str) -> bool:
+        return True
+
+    async def release_lease(self, battle_id: str):
+        return None
+
+    async def claim_completion(self, battle_id: str) -> bool:
+        return True
+
+    async def send(self, runtime, frame: str, only: Optional[str] = None, exclude: Optional[str] = None,
+                   release: bool = False) -> int:
+        return await _send_local(runtime, frame, only=only, exclude=exclude)
+
+    async def discard(self, battle_id: str):
+        return None
+
+    async def shutdown(self):
+        return None
+
+
+# KEYS: answers, scores, progress, counts, meta
+# ARGV: username, q_index, answer, correct (0/1), ttl, now
+_SUBMIT_ANSWER = """
+if redis.call('HSETNX', KEYS[1], ARGV[1] .. ':' .. ARGV[2], ARGV[3]) == 0 then
+    return {0}
+end
+redis.call('HINCRBY', KEYS[2], ARGV[1], tonumber(ARGV[4]))
+redis.call('HINCRBY', KEYS[4], ARGV[1], 1)
+local progress = tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '-1')
+if tonumber(ARGV[2]) > progress then
+    redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+end
+redis.call('HSET', KEYS[5], 'last_activity', ARGV[6])
+for i = 1, 5 do
+    redis.call('EXPIRE', KEYS[i], ARGV[5])
+end
+return {1, redis.call('HGETALL', KEYS[2]), redis.call('HGETALL', KEYS[4])}
+"""
+
+# KEYS: lease; ARGV: owner, ttl ms
+_ACQUIRE_LEASE = """
+local owner = redis.call('GET', KEYS[1])
+if not owner then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+if owner == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# KEYS: lease; ARGV: owner
+_RELEASE_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _pairs(flat) -> dict:
+    return {flat[i]: flat[i + 1] for i in range(0, len(flat), 2)}
+
+
+class RedisBattleState:
+    """
+    Shared backend so the two players of a battle may sit on different workers.
+
+    Scores, answers, progress and finish times live in per-battle Redis
+    hashes and are only changed through Lua scripts, so concurrent answers
+    from two workers can neither double count nor lose a point. Each
+    worker still keeps a BattleRuntime for its own sockets and mirrors the
+    shared fields into it with refresh() before making a decision.
+
+    One worker at a time holds the battle's owner lease and runs the
+    battle-level timers (max duration, inactivity); if it dies, the lease
+    expires and another worker with a connected player takes over. Result
+    processing is claimed once with SET NX. Frames for sockets held by
+    other workers are routed over a single pub/sub channel.
+    """
+
+    shared = True
+
+    def __init__(self):
+        self._client: Optional[aioredis.Redis] = None
+        self._scripts = {}
+        self._listener: Optional[asyncio.Task] = None
+
+    def _redis(self) -> aioredis.Redis:
+        if self._client is None:
+            self._client = redis_pool.client()
+            self._scripts = {
+                "submit": self._client.register_script(_SUBMIT_ANSWER),
+                "acquire": self._client.register_script(_ACQUIRE_LEASE),
+                "release": self._client.register_script(_RELEASE_LEASE),
+            }
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.get_event_loop().create_task(self._listen())
+        return self._client
+
+    @staticmethod
+    def _keys(battle_id: str) -> dict:
+        prefix = f"battle_state:{battle_id}"
+        return {
+            "answers": f"{prefix}:answers",
+            "scores": f"{prefix}:scores",
+            "progress": f"{prefix}:progress",
+            "counts": f"{prefix}:counts",
+            "meta": f"{prefix}:meta",
+            "finished": f"{prefix}:finished",
+            "lease": f"{prefix}:lease",
+            "completed": f"{prefix}:completed",
+        }
+
+    async def register(self, runtime):
+        """Publish this battle's players on first load, or adopt them if another worker got there first"""
+        client = self._redis()
+        keys = self._keys(runtime.battle_id)
+        if runtime.players:
+            async with client.pipeline(transaction=True) as pipe:
+                pipe.hsetnx(keys["meta"], "players", json.dumps(list(runtime.players)))
+                pipe.hsetnx(keys["meta"], "sport", runtime.sport)
+                pipe.hsetnx(keys["meta"], "level", runtime.level)
+                pipe.hsetnx(keys["meta"], "started_at", time.time())
+                pipe.expire(keys["meta"], BATTLE_STATE_TTL)
+                await pipe.execute()
+        meta = await client.hgetall(keys["meta"])
+        if meta.get("players") and not runtime.players:
+            runtime.adopt_players(tuple(json.loads(meta["players"])), meta.get("sport", runtime.sport),
+                                  meta.get("level", runtime.level))
+        if meta.get("started_at"):
+            runtime.started_at = self._to_loop_time(float(meta["started_at"]))
+        return await self.refresh(runtime)
+
+    async def submit_answer(self, runtime, username: str, q_index: int, answer) -> Optional[bool]:
+        client = self._redis()
+        keys = self._keys(runtime.battle_id)
+        correct = runtime.answer_keys[q_index].matches(answer)
+        result = await self._scripts["submit"](
+            keys=[keys["answers"], keys["scores"], keys["progress"], keys["counts"], keys["meta"]],
+            args=[username, q_index, "" if answer is None else str(answer), int(correct), BATTLE_STATE_TTL, time.time()],
+            client=client,
+        )
+        if not result or int(result[0]) == 0:
+            return None
+        runtime.apply_shared_state(
+            scores={u: int(v) for u, v in _pairs(result[1]).items()},
+            answer_counts={u: int(v) for u, v in _pairs(result[2]).items()},
+        )
+        runtime.note_answer(username, q_index, answer)
+        return correct
+
+    async def mark_finished(self, runtime, username: str):
+        runtime.mark_finished(username)
+        client = self._redis()
+        keys = self._keys(runtime.battle_id)
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.hsetnx(keys["finished"], username, time.time())
+            pipe.expire(keys["finished"], BATTLE_STATE_TTL)
+            await pipe.execute()
+        await self.refresh(runtime)
+
+    async def refresh(self, runtime):
+        """Mirror the shared scores, progress, answer counts, finish times and activity into the local runtime"""
+        client = self._redis()
+        keys = self._keys(runtime.battle_id)
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.hgetall(keys["scores"])
+            pipe.hgetall(keys["progress"])
+            pipe.hgetall(keys["counts"])
+            pipe.hgetall(keys["finished"])
+            pipe.hget(keys["meta"], "last_activity")
+            scores, progress, counts, finished, last_activity = await pipe.execute()
+        runtime.apply_shared_state(
+            scores={u: int(v) for u, v in scores.items()},
+            progress={u: int(v) for u, v in progress.items()},
+            answer_counts={u: int(v) for u, v in counts.items()},
+            finished_at={u: self._to_loop_time(float(v)) for u, v in finished.items()},
+            last_activity=self._to_loop_time(float(last_activity)) if last_activity else None,
+        )
+        return runtime
+
+    @staticmethod
+    def _to_loop_time(wall_time: float) -> float:
+        return asyncio.get_event_loop().time() - (time.time() - wall_time)
+
+    async def acquire_lease(self, battle_id: str) -> bool:
+        """Take or renew the owner lease; False while another live worker owns the battle"""
+        client = self._redis()
+        result = await self._scripts["acquire"](
+            keys=[self._keys(battle_id)["lease"]], args=[WORKER_ID, BATTLE_LEASE_MS], client=client
+        )
+        return bool(result)
+
+    async def release_lease(self, battle_id: str):
+        client = self._redis()
+        await self._scripts["release"](keys=[self._keys(battle_id)["lease"]], args=[WORKER_ID], client=client)
+
+    async def claim_completion(self, battle_id: str) -> bool:
+        """Only the first worker to claim a battle processes its result"""
+        client = self._redis()
+        return bool(await client.set(self._keys(battle_id)["completed"], WORKER_ID, nx=True, ex=BATTLE_STATE_TTL))
+
+    async def send(self, runtime, frame: str, only: Optional[str] = None, exclude: Optional[str] = None,
+                   release: bool = False) -> int:
+        """Deliver a frame to local sockets and route it to workers holding the others"""
+        sent = await _send_local(runtime, frame, only=only, exclude=exclude)
+        if only is not None and only in runtime.sockets and not release:
+            return sent
+        try:
+            await self._redis().publish(BATTLE_ROUTE_CHANNEL, json.dumps({
+                "origin": WORKER_ID,
+                "battle_id": runtime.battle_id,
+                "frame": frame,
+                "only": only,
+                "exclude": exclude,
+                "release": release,
+            }))
+        except Exception as e:
+            logger.error(f"[BATTLE_STATE] Error routing frame for battle {runtime.battle_id}: {str(e)}")
+        return sent
+
+    async def discard(self, battle_id: str):
+        """Let a finished battle's shared keys expire shortly (the completion claim outlives them)"""
+        client = self._redis()
+        keys = self._keys(battle_id)
+        async with client.pipeline(transaction=False) as pipe:
+            for name in ("answers", "scores", "progress", "counts", "meta", "finished"):
+                pipe.expire(keys[name], 60)
+            await pipe.execute()
+        await self.release_lease(battle_id)
+
+    async def _listen(self):
+        from battle.runtime import get_runtime, release_runtime
+        while True:
+            pubsub = self._client.pubsub()
+            try:
+                await pubsub.subscribe(BATTLE_ROUTE_CHANNEL)
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    try:
+                        routed = json.loads(message["data"])
+                    except (ValueError, TypeError):
+                        continue
+                    if routed.get("origin") == WORKER_ID:
+                        continue
+                    runtime = get_runtime(routed.get("battle_id"))
+                    if runtime is None:
+                        continue
+                    await _send_local(runtime, routed["frame"], only=routed.get("only"), exclude=routed.get("exclude"))
+                    if routed.get("release"):
+                        release_runtime(runtime.battle_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[BATTLE_STATE] Route subscription error, reconnecting: {str(e)}")
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    async def shutdown(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        # The pooled client itself is closed with the pool
+        self._client = None
+
+
+def create_battle_state():
+    if BATTLE_STATE_BACKEND == "redis":
+        logger.info(f"[BATTLE_STATE] Using shared Redis battle state (worker {WORKER_ID})")
+        return RedisBattleState()
+    return LocalBattleState()
+
+
+# Global battle state backend shared by the battle websockets
+battle_state = create_battle_state()
@@ -0,0 +1,103 @@
+import logging
+from typing import Dict, Optional
+from sqlalchemy import update, func
+from sqlalchemy.dialects.postgresql import insert
+from init import SessionLocal
+from models import UserData, BattleModel
+from user_cache import user_cache, user_to_dict, USER_FIELDS, USER_RELATION_FIELDS
+
+logger = logging.getLogger(__name__)
+
+WIN = "win"
+LOSS = "loss"
+DRAW = "draw"
+
+# Columns returned by an outcome update, in the shape of the cached user record (relations aside)
+_USER_COLUMNS = tuple(getattr(UserData, field) for field in USER_FIELDS if field not in USER_RELATION_FIELDS)
+
+
+def outcome_statement(battle_id: str, username: str, outcome: str):
+    """
+    UPDATE ... RETURNING that applies one battle to one user in place.
+
+    The counters are computed by Postgres from the row's current values, so
+    two results landing at once cannot overwrite each other. A battle is
+    only applied once because its row is inserted ON CONFLICT DO NOTHING
+    first (record_battle_result).
+    """
+    won = 1 if outcome == WIN else 0
+    return (
+        update(UserData)
+        .where(UserData.username == username)
+        .values(
+            totalBattle=UserData.totalBattle + 1,
+            winBattle=UserData.winBattle + won,
+            streak=UserData.streak + 1 if won else 0,
+            winRate=(UserData.winBattle + won) * 100 // (UserData.totalBattle + 1),
+            # array_append on a NULL list yields a one-element list
+            battles=func.array_append(UserData.battles, battle_id),
+        )
+        .returning(*_USER_COLUMNS)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def apply_battle_outcomes(session, battle_id: str, outcomes: Dict[str, str]) -> Dict[str, dict]:
+    """
+    Apply outcomes {username: win|loss|draw} inside the caller's transaction; returns the updated users.
+    Only call this after inserting the battle row succeeded, which is what keeps a battle from counting twice.
+    """
+    updated = {}
+    for username, outcome in outcomes.items():
+        result = await session.execute(outcome_statement(battle_id, username, outcome))
+        row = result.one_or_none()
+        if row is None:
+            logger.warning(f"[BATTLE_STATS] Battle {battle_id} not applied to {username} (unknown user)")
+            continue
+        updated[username] = user_to_dict(row)
+    return updated
+
+
+async def record_battle_result(battle: dict, outcomes: Dict[str, str]) -> Optional[Dict[str, dict]]:
+    """
+    Persist a finished battle and its stats in a single transaction.
+
+    The battle row is inserted with ON CONFLICT DO NOTHING; if it already
+    exists another worker (or an earlier call) has counted this battle and
+    None is returned without touching any user. Caches and the
+    leaderboard are only updated once the transaction has committed.
+    """
+    async with SessionLocal() as session:
+        inserted = await session.execute(
+            insert(BattleModel).values(**battle).on_conflict_do_nothing(index_elements=[BattleModel.id]).returning(BattleModel.id)
+        )
+        if inserted.scalar_one_or_none() is None:
+            await session.rollback()
+            logger.warning(f"[BATTLE_STATS] Battle {battle['id']} already recorded, skipping")
+            return None
+        updated = await apply_battle_outcomes(session, battle['id'], outcomes)
+        await session.commit()
+
+    await publish_outcome(battle['id'], updated)
+    return updated
+
+
+async def publish_outcome(battle_id: str, updated: Dict[str, dict]):
+    """Post-commit side effects of a battle result: user caches and leaderboard scores"""
+    try:
+        await user_cache.record_battle(updated.values(), battle_id)
+    except Exception as e:
+        logger.error(f"[BATTLE_STATS] Error caching updated users: {str(e)}")
+    try:
+        from battle.leaderboard import leaderboard
+        await leaderboard.update_users(updated.values())
+    except Exception as e:
+        logger.error(f"[BATTLE_STATS] Error updating leaderboard: {str(e)}")
+
+
+def outcomes_for(user1: str, user2: str, score1: int, score2: int) -> Dict[str, str]:
+    if score1 > score2:
+        return {user1: WIN, user2: LOSS}
+    if score2 > score1:
+        return {user1: LOSS, user2: WIN}
+    return {user1: DRAW, user2: DRAW}
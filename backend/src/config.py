@@ -1,2 +1,9 @@
-DATABASE_URL = "postgresql+asyncpg://postgres:Kais123@db:5432/head2head"
-a="s"
\ No newline at end of file
+import os
+import socket
+import uuid
+
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql+asyncpg://postgres:Kais123@db:5432/head2head")
+a="s"
+
+# Identifies this process when several workers share Redis state or channels
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
@@ -0,0 +1,39 @@
+"""
+Migration script to add created_at and the per-opponent history indexes to the battles table
+"""
+import asyncio
+from sqlalchemy import text
+from init import get_db
+
+async def migrate():
+    """Add created_at to battles and index (opponent, created_at, id)"""
+    async for db in get_db():
+        try:
+            # Existing rows have no recorded time; they all get the migration time and sort by id
+            await db.execute(text("""
+                ALTER TABLE battles
+                ADD COLUMN IF NOT EXISTS created_at TIMESTAMP NOT NULL DEFAULT now()
+            """))
+            
+            await db.execute(text("""
+                CREATE INDEX IF NOT EXISTS ix_battles_first_opponent_created_at
+                ON battles (first_opponent, created_at, id)
+            """))
+            
+            await db.execute(text("""
+                CREATE INDEX IF NOT EXISTS ix_battles_second_opponent_created_at
+                ON battles (second_opponent, created_at, id)
+            """))
+            
+            await db.commit()
+            print("Migration completed successfully!")
+            
+        except Exception as e:
+            await db.rollback()
+            print(f"Migration failed: {e}")
+            raise
+        finally:
+            await db.close()
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
@@ -0,0 +1,105 @@
+"""
+Migration script to move friends, friend requests and invitations out of user_data ARRAY columns
+into the friendships, friend_requests and battle_invitations tables
+"""
+import asyncio
+from sqlalchemy import text
+from init import get_db
+
+async def migrate():
+    """Create the relation tables, copy the array contents into them and drop the arrays"""
+    async for db in get_db():
+        try:
+            await db.execute(text("""
+                CREATE TABLE IF NOT EXISTS friendships (
+                    user_email VARCHAR NOT NULL REFERENCES user_data (email) ON DELETE CASCADE ON UPDATE CASCADE,
+                    friend_email VARCHAR NOT NULL REFERENCES user_data (email) ON DELETE CASCADE ON UPDATE CASCADE,
+                    created_at TIMESTAMP NOT NULL DEFAULT now(),
+                    PRIMARY KEY (user_email, friend_email)
+                )
+            """))
+
+            await db.execute(text("""
+                CREATE INDEX IF NOT EXISTS ix_friendships_friend_email ON friendships (friend_email)
+            """))
+
+            await db.execute(text("""
+                CREATE TABLE IF NOT EXISTS friend_requests (
+                    to_email VARCHAR NOT NULL REFERENCES user_data (email) ON DELETE CASCADE ON UPDATE CASCADE,
+                    from_email VARCHAR NOT NULL REFERENCES user_data (email) ON DELETE CASCADE ON UPDATE CASCADE,
+                    created_at TIMESTAMP NOT NULL DEFAULT now(),
+                    PRIMARY KEY (to_email, from_email)
+                )
+            """))
+
+            await db.execute(text("""
+                CREATE INDEX IF NOT EXISTS ix_friend_requests_from_email ON friend_requests (from_email)
+            """))
+
+            await db.execute(text("""
+                CREATE TABLE IF NOT EXISTS battle_invitations (
+                    email VARCHAR NOT NULL REFERENCES user_data (email) ON DELETE CASCADE ON UPDATE CASCADE,
+                    battle_id VARCHAR NOT NULL,
+                    created_at TIMESTAMP NOT NULL DEFAULT now(),
+                    PRIMARY KEY (email, battle_id)
+                )
+            """))
+
+            await db.execute(text("""
+                CREATE INDEX IF NOT EXISTS ix_battle_invitations_battle_id ON battle_invitations (battle_id)
+            """))
+
+            result = await db.execute(text("""
+                SELECT count(*) FROM information_schema.columns
+                WHERE table_name = 'user_data' AND column_name = 'friends'
+            """))
+            if result.scalar():
+                # Array positions become created_at offsets so every list keeps its order;
+                # names that no longer resolve to a user are dropped
+                await db.execute(text("""
+                    INSERT INTO friendships (user_email, friend_email, created_at)
+                    SELECT u.email, f.email, now() + a.pos * interval '1 microsecond'
+                    FROM user_data u
+                    CROSS JOIN LATERAL unnest(u.friends) WITH ORDINALITY AS a(name, pos)
+                    JOIN user_data f ON f.username = a.name
+                    WHERE f.email <> u.email
+                    ON CONFLICT DO NOTHING
+                """))
+
+                await db.execute(text("""
+                    INSERT INTO friend_requests (to_email, from_email, created_at)
+                    SELECT u.email, f.email, now() + a.pos * interval '1 microsecond'
+                    FROM user_data u
+                    CROSS JOIN LATERAL unnest(u."friendRequests") WITH ORDINALITY AS a(name, pos)
+                    JOIN user_data f ON f.username = a.name
+                    WHERE f.email <> u.email
+                    ON CONFLICT DO NOTHING
+                """))
+
+                await db.execute(text("""
+                    INSERT INTO battle_invitations (email, battle_id, created_at)
+                    SELECT u.email, a.battle_id, now() + a.pos * interval '1 microsecond'
+                    FROM user_data u
+                    CROSS JOIN LATERAL unnest(u.invitations) WITH ORDINALITY AS a(battle_id, pos)
+                    ON CONFLICT DO NOTHING
+                """))
+
+                await db.execute(text("""
+                    ALTER TABLE user_data
+                    DROP COLUMN IF EXISTS friends,
+                    DROP COLUMN IF EXISTS "friendRequests",
+                    DROP COLUMN IF EXISTS invitations
+                """))
+
+            await db.commit()
+            print("Migration completed successfully!")
+
+        except Exception as e:
+            await db.rollback()
+            print(f"Migration failed: {e}")
+            raise
+        finally:
+            await db.close()
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
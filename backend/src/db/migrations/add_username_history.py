@@ -0,0 +1,39 @@
+"""
+Migration script to add the username_history table used to resolve former usernames
+"""
+import asyncio
+from sqlalchemy import text
+from init import get_db
+
+async def migrate():
+    """Create username_history and its case-insensitive lookup index"""
+    async for db in get_db():
+        try:
+            await db.execute(text("""
+                CREATE TABLE IF NOT EXISTS username_history (
+                    old_username VARCHAR PRIMARY KEY,
+                    email VARCHAR NOT NULL REFERENCES user_data (email) ON DELETE CASCADE ON UPDATE CASCADE,
+                    renamed_at TIMESTAMP NOT NULL DEFAULT now()
+                )
+            """))
+
+            await db.execute(text("""
+                CREATE INDEX IF NOT EXISTS ix_username_history_email ON username_history (email)
+            """))
+
+            await db.execute(text("""
+                CREATE INDEX IF NOT EXISTS ix_username_history_old_username_lower ON username_history (lower(old_username))
+            """))
+
+            await db.commit()
+            print("Migration completed successfully!")
+
+        except Exception as e:
+            await db.rollback()
+            print(f"Migration failed: {e}")
+            raise
+        finally:
+            await db.close()
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
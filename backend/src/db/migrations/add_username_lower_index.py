@@ -0,0 +1,28 @@
+"""
+Migration script to index user_data by lower(username) for case-insensitive lookups
+"""
+import asyncio
+from sqlalchemy import text
+from init import get_db
+
+async def migrate():
+    """Create the functional lower(username) index"""
+    async for db in get_db():
+        try:
+            await db.execute(text("""
+                CREATE INDEX IF NOT EXISTS ix_user_data_username_lower
+                ON user_data (lower(username))
+            """))
+            
+            await db.commit()
+            print("Migration completed successfully!")
+            
+        except Exception as e:
+            await db.rollback()
+            print(f"Migration failed: {e}")
+            raise
+        finally:
+            await db.close()
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
@@ -0,0 +1,28 @@
+"""
+Migration script to drop the legacy JSON copies of user records from Redis
+"""
+from init import redis_email, redis_username
+
+def migrate():
+    """Delete the per-email blobs in db 0 and the per-username copies in db 1"""
+    try:
+        removed = 0
+        # Legacy records were plain strings keyed by the bare email; every other key in db 0 is namespaced
+        for key in redis_email.scan_iter("*@*", count=500):
+            if b":" in key or redis_email.type(key) != b"string":
+                continue
+            redis_email.delete(key)
+            removed += 1
+
+        for key in redis_username.scan_iter("*", count=500):
+            redis_username.delete(key)
+            removed += 1
+
+        print(f"Migration completed successfully! Removed {removed} legacy keys")
+
+    except Exception as e:
+        print(f"Migration failed: {e}")
+        raise
+
+if __name__ == "__main__":
+    migrate()
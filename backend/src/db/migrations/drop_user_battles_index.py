@@ -0,0 +1,27 @@
+"""
+Migration script to drop the B-tree index on user_data.battles, which no query can use
+"""
+import asyncio
+from sqlalchemy import text
+from init import get_db
+
+async def migrate():
+    """Drop ix_user_data_battles; battles are counted once by the battles primary key instead"""
+    async for db in get_db():
+        try:
+            await db.execute(text("""
+                DROP INDEX IF EXISTS ix_user_data_battles
+            """))
+
+            await db.commit()
+            print("Migration completed successfully!")
+
+        except Exception as e:
+            await db.rollback()
+            print(f"Migration failed: {e}")
+            raise
+        finally:
+            await db.close()
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
@@ -1,5 +1,11 @@
-from models import UserData, UserDataCreate, BattleModel
-from init import SessionLocal, redis_email, redis_username
+from models import UserData, UserDataCreate, BattleModel, Friendship, FriendRequest
+from init import SessionLocal
+from redis_pool import redis_pool
+from user_cache import user_cache, user_to_dict
+from config import WORKER_ID
+from friends.relations import relations_for, referencing_users, user_record, user_records
+from maintenance import maintenance, MAINTENANCE_CHUNK_SIZE
+from usernames import username_resolver, record_rename
 from .init import db_router
 import json
 from fastapi import HTTPException, UploadFile, File
@@ -9,12 +15,22 @@ import aiofiles
 import os
 from datetime import datetime
 from auth.router import decode_access_token
-from sqlalchemy import select, update
+from sqlalchemy import select, update, delete, func, or_, exists, tuple_, bindparam
 import logging
+from typing import Optional
 import traceback
+import asyncio
+import math
 
 logger = logging.getLogger(__name__)
 
+# Relation rows checked per transaction by the username cleanup
+CLEANUP_CHUNK_SIZE = int(os.getenv("CLEANUP_CHUNK_SIZE", 1000))
+
+# Workers starting within this many seconds of each other share one cleanup run
+CLEANUP_LOCK_KEY = "maintenance:username_cleanup"
+CLEANUP_LOCK_SECONDS = int(os.getenv("CLEANUP_LOCK_SECONDS", 600))
+
 @db_router.post("/update-user",name="update user data")
 async def update_user_data(user: UserDataCreate):
     return await update_data(user)
@@ -52,101 +68,38 @@ async def delete_user_data(token: str):
         email = decoded_token.get("sub")
         async with SessionLocal() as db:
             data = await db.get(UserData, email)
-            friends = data.friends
-            
-            for friend in data.friends:
-                    friend_data = redis_username.get(friend)
-                    if friend_data:
-                        friend_model = json.loads(friend_data)
-                        if data.username in friend_model['friends']:
-                            friend_model['friends'].remove(data.username)
-                            redis_username.set(friend, json.dumps(friend_model))
-                            redis_email.set(friend_model['email'], json.dumps(friend_model))
-                            
-                            async with SessionLocal() as friend_db:
-                                db_friend = await friend_db.get(UserData, friend_model['email'])
-                                if db_friend:
-                                    db_friend.friends = friend_model['friends']
-                                    await friend_db.commit()
-                                    await friend_db.refresh(db_friend)
+            friends = (await relations_for(db, [email]))[email]["friends"]
+            friend_emails, requested_emails = await referencing_users(db, email)
 
-            # Delete the user
+            # Delete the user; their friendships, requests and invitations go with the row
             await db.delete(data)
             await db.commit()
-            redis_email.delete(email)
-            redis_username.delete(data.username)
+            await user_cache.invalidate(email=email, username=data.username)
+            await user_cache.edit_lists(_username_edits(friend_emails, requested_emails, data.username))
+            await username_resolver.removed(data.username)
             
-            # Recalculate rankings for all remaining users after account deletion
+            # Drop the user from the leaderboard; the remaining ranks are persisted lazily
             try:
-                from battle.router import update_user_rankings
-                logger.info(f"[DELETE] Recalculating rankings after account deletion...")
-                ranking_success = await update_user_rankings()
-                if ranking_success:
-                    logger.info(f"[DELETE] Successfully recalculated rankings after account deletion")
-                    
-                    # Update Redis cache for all remaining users with new rankings
-                    async with SessionLocal() as ranking_db:
-                        stmt = select(UserData)
-                        result = await ranking_db.execute(stmt)
-                        remaining_users = result.scalars().all()
-                        
-                        for user in remaining_users:
-                            try:
-                                await ranking_db.refresh(user)
-                                updated_user_dict = {
-                                    'username': user.username,
-                                    'email': user.email,
-                                    'totalBattle': user.totalBattle,
-                                    'winRate': user.winRate,
-                                    'ranking': user.ranking,
-                                    'winBattle': user.winBattle,
-                                    'favourite': user.favourite,
-                                    'streak': user.streak,
-                                    'password': user.password,
-                                    'friends': user.friends,
-                                    'friendRequests': user.friendRequests,
-                                    'avatar': user.avatar,
-                                    'battles': user.battles,
-                                    'invitations': user.invitations
-                                }
-                                
-                                redis_email.set(user.email, json.dumps(updated_user_dict))
-                                redis_username.set(user.username, json.dumps(updated_user_dict))
-                                
-                                # Send websocket notification to each remaining user
-                                try:
-                                    from websocket import manager
-                                    await manager.send_message(json.dumps({
-                                        "type": "user_updated",
-                                        "data": updated_user_dict
-                                    }), user.username)
-                                    logger.info(f"[DELETE] Sent user_updated websocket notification to {user.username} with new ranking {user.ranking}")
-                                except Exception as e:
-                                    logger.warning(f"[DELETE] Failed to send websocket notification to {user.username}: {str(e)}")
-                                    
-                            except Exception as e:
-                                logger.error(f"[DELETE] Error updating Redis for user {user.username}: {str(e)}")
-                else:
-                    logger.warning(f"[DELETE] Failed to recalculate rankings after account deletion")
+                from battle.leaderboard import leaderboard
+                await leaderboard.remove(email)
             except Exception as e:
-                logger.error(f"[DELETE] Error recalculating rankings after account deletion: {str(e)}\n{traceback.format_exc()}")
+                logger.error(f"[DELETE] Error removing {email} from leaderboard: {str(e)}")
             
             return friends
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting user: {str(e)}")
 
-@db_router.on_event("shutdown")
-async def end_event():
-    redis_email.close()
-    redis_username.close()
-
 @db_router.get("/get-user")
 async def get_user_data(token: str):
     try:
         decoded_token = decode_access_token(token)
         email = decoded_token.get("sub")
-        redis_data = redis_email.get(email)
-        return json.loads(redis_data)
+        user = await user_cache.get_by_email(email)
+        if user is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        return user
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting user data: {str(e)}")
 
@@ -154,30 +107,10 @@ async def get_user_data(token: str):
 async def get_user_by_username(username: str):
     logger.info(f"[DB_ROUTER] get_user_by_username called for {username}")
     try:
-        async with SessionLocal() as session:
-            stmt = select(UserData).where(UserData.username == username)
-            result = await session.execute(stmt)
-            user = result.scalar_one_or_none()
-            if not user:
-                logger.error(f"[DB_ROUTER] User {username} not found in DB")
-                return None
-            logger.info(f"[DB_ROUTER] User found: {user}")
-            return {
-                "totalBattle": user.totalBattle,
-                "winBattle": user.winBattle,
-                "streak": user.streak,
-                "winRate": user.winRate,
-                "battles": user.battles,
-                "username": user.username,
-                "email": user.email,
-                "ranking": user.ranking,
-                "favourite": user.favourite,
-                "avatar": user.avatar,
-                "password": user.password,
-                "friends": user.friends,
-                "friendRequests": user.friendRequests,
-                "invitations": user.invitations
-            }
+        user = await user_cache.get(username)
+        if not user:
+            logger.error(f"[DB_ROUTER] User {username} not found")
+        return user
     except Exception as e:
         logger.error(f"[DB_ROUTER] Error fetching user {username}: {str(e)}\n{traceback.format_exc()}")
         return None
@@ -319,24 +252,8 @@ async def upload_avatar(token: str, file: UploadFile = File(...)):
                 logger.info(f"[AVATAR_UPLOAD] Database updated with new avatar: {relative_path}")
                 
                 # Update Redis cache
-                user_dict = {
-                    'username': user_model.username,
-                    'email': user_model.email,
-                    'totalBattle': user_model.totalBattle,
-                    'winRate': user_model.winRate,
-                    'ranking': user_model.ranking,
-                    'winBattle': user_model.winBattle,
-                    'favourite': user_model.favourite,
-                    'streak': user_model.streak,
-                    'password': user_model.password,
-                    'friends': user_model.friends,
-                    'friendRequests': user_model.friendRequests,
-                    'avatar': relative_path,
-                    'battles': user_model.battles,
-                    'invitations': user_model.invitations
-                }
-                redis_email.set(email, json.dumps(user_dict))
-                redis_username.set(user_model.username, json.dumps(user_dict))
+                user_dict = user_to_dict(user_model)
+                await user_cache.put(user_dict)
                 logger.info(f"[AVATAR_UPLOAD] Redis cache updated")
                 
         except HTTPException:
@@ -381,102 +298,23 @@ async def upload_avatar_options():
         }
     )
 
-async def update_user_statistics(username: str, total_battle: int, win_battle: int, streak: int, win_rate: int, battles_list: list):
-    logger.info(f"[DB_ROUTER] update_user_statistics called for {username}: total_battle={total_battle}, win_battle={win_battle}, streak={streak}, win_rate={win_rate}, battles_list={battles_list}")
-    try:
-        # First get the user's email from Redis or database
-        user_email = None
-        
-        # Try to get from Redis first
-        try:
-            user_data = redis_username.get(username)
-            if user_data:
-                user_dict = json.loads(user_data)
-                user_email = user_dict.get('email')
-                logger.info(f"[DB_ROUTER] Found user email from Redis: {user_email}")
-        except Exception as e:
-            logger.warning(f"[DB_ROUTER] Error getting user email from Redis: {str(e)}")
-        
-        # If not found in Redis, get from database
-        if not user_email:
-            try:
-                async with SessionLocal() as session:
-                    stmt = select(UserData).where(UserData.username == username)
-                    result = await session.execute(stmt)
-                    user = result.scalar_one_or_none()
-                    if user:
-                        user_email = user.email
-                        logger.info(f"[DB_ROUTER] Found user email from database: {user_email}")
-                    else:
-                        logger.error(f"[DB_ROUTER] User {username} not found in database")
-                        return False
-            except Exception as e:
-                logger.error(f"[DB_ROUTER] Error getting user email from database: {str(e)}")
-                return False
-        
-        if not user_email:
-            logger.error(f"[DB_ROUTER] Could not find email for user {username}")
-            return False
-        
-        # Update DB using email as primary key
-        async with SessionLocal() as session:
-            user = await session.get(UserData, user_email)
-            if not user:
-                logger.error(f"[DB_ROUTER] User with email {user_email} not found in DB")
-                return False
-            
-            # Update all user statistics
-            user.totalBattle = total_battle
-            user.winBattle = win_battle
-            user.streak = streak
-            user.winRate = win_rate
-            user.battles = battles_list
-            
-            await session.commit()
-            await session.refresh(user)
-            logger.info(f"[DB_ROUTER] DB updated for {username} (email: {user_email})")
-        
-        # Update Redis with complete user data
-        try:
-            # Get complete user data from database
-            async with SessionLocal() as session:
-                user = await session.get(UserData, user_email)
-                if user:
-                    user_dict = {
-                        'username': user.username,
-                        'email': user.email,
-                        'totalBattle': user.totalBattle,
-                        'winRate': user.winRate,
-                        'ranking': user.ranking,
-                        'winBattle': user.winBattle,
-                        'favourite': user.favourite,
-                        'streak': user.streak,
-                        'password': user.password,
-                        'friends': user.friends,
-                        'friendRequests': user.friendRequests,
-                        'avatar': user.avatar,
-                        'battles': user.battles,
-                        'invitations': user.invitations
-                    }
-                    
-                    # Update both Redis caches
-                    redis_username.set(user.username, json.dumps(user_dict))
-                    redis_email.set(user.email, json.dumps(user_dict))
-                    logger.info(f"[DB_ROUTER] Redis updated for {username} with complete user data")
-                else:
-                    logger.error(f"[DB_ROUTER] User {username} not found after DB update")
-                    return False
-        except Exception as e:
-            logger.error(f"[DB_ROUTER] Error updating Redis for {username}: {str(e)}")
-            # Don't fail the entire operation if Redis update fails
-            # The database update was successful
-        
-        return True
-    except Exception as e:
-        logger.error(f"[DB_ROUTER] Error updating stats for {username}: {str(e)}\n{traceback.format_exc()}")
-        return False
+def _username_edits(friend_emails, requested_emails, username: str, new_username: Optional[str] = None) -> dict:
+    """Cached-list edits that drop (or rename) a username in its friends' lists and the requests it sent"""
+    edits = {}
+    for field, emails in (("friends", friend_emails), ("friendRequests", requested_emails)):
+        for email in emails:
+            ops = edits.setdefault(email, [])
+            ops.append(("remove", field, username))
+            if new_username:
+                ops.append(("add", field, new_username))
+    return edits
 
 async def update_data(user: UserDataCreate):
+    """
+    Write a user's profile and stats. The relation lists in `user` are
+    ignored; friends, requests and invitations change only through their
+    own endpoints (friends.relations).
+    """
     async with SessionLocal() as db:
         user_model = await db.get(UserData, user.email)
 
@@ -492,11 +330,8 @@ async def update_data(user: UserDataCreate):
                 favourite=user.favourite,
                 streak=user.streak,
                 password=user.password,
-                friends=user.friends,
-                friendRequests=user.friendRequests,
                 avatar=user.avatar,
-                battles=user.battles,
-                invitations=user.invitations
+                battles=user.battles
             )
             db.add(user_model)
             await db.commit()
@@ -515,10 +350,7 @@ async def update_data(user: UserDataCreate):
         user_model.favourite = user.favourite
         user_model.streak = user.streak
         user_model.password = user.password
-        user_model.friends = user.friends
-        user_model.friendRequests = user.friendRequests
         user_model.battles = user.battles
-        user_model.invitations = user.invitations
         if user.avatar:
             user_model.avatar = user.avatar
 
@@ -527,125 +359,23 @@ async def update_data(user: UserDataCreate):
 
         # If username changed, update all references
         if old_username != new_username:
-            print(f"Username changed from {old_username} to {new_username}, updating all references...")
-            
-            # 1. Update friends' friend lists
-            for friend_username in user_model.friends:
-                try:
-                    friend_data = redis_username.get(friend_username)
-                    if friend_data:
-                        friend_model = json.loads(friend_data)
-                        if old_username in friend_model['friends']:
-                            friend_model['friends'][friend_model['friends'].index(old_username)] = new_username
-                            
-                            # Update Redis cache
-                            redis_username.set(friend_username, json.dumps(friend_model))
-                            redis_email.set(friend_model['email'], json.dumps(friend_model))
-                            
-                            # Update database
-                            async with SessionLocal() as friend_db:
-                                db_friend = await friend_db.get(UserData, friend_model['email'])
-                                if db_friend:
-                                    db_friend.friends = friend_model['friends']
-                                    await friend_db.commit()
-                                    await friend_db.refresh(db_friend)
-                except Exception as e:
-                    print(f"Error updating friend {friend_username}: {e}")
-            
-            # 2. Update friend requests (users who have this user in their friendRequests)
-            all_users_stmt = select(UserData)
-            all_users_result = await db.execute(all_users_stmt)
-            all_users = all_users_result.scalars().all()
-            
-            for other_user in all_users:
-                if old_username in other_user.friendRequests:
-                    other_user.friendRequests[other_user.friendRequests.index(old_username)] = new_username
-                    
-                    # Update Redis cache for this user
-                    other_user_dict = {
-                        'username': other_user.username,
-                        'email': other_user.email,
-                        'totalBattle': other_user.totalBattle,
-                        'winRate': other_user.winRate,
-                        'ranking': other_user.ranking,
-                        'winBattle': other_user.winBattle,
-                        'favourite': other_user.favourite,
-                        'streak': other_user.streak,
-                        'password': other_user.password,
-                        'friends': other_user.friends,
-                        'friendRequests': other_user.friendRequests,
-                        'avatar': other_user.avatar,
-                        'battles': other_user.battles,
-                        'invitations': other_user.invitations
-                    }
-                    redis_username.set(other_user.username, json.dumps(other_user_dict))
-                    redis_email.set(other_user.email, json.dumps(other_user_dict))
-            
-            # 3. Update battle records
-            for battle_id in user_model.battles:
-                try:
-                    battle_data = await db.get(BattleModel, battle_id)
-                    if battle_data:
-                        if battle_data.first_opponent == old_username:
-                            battle_data.first_opponent = new_username
-                        elif battle_data.second_opponent == old_username:
-                            battle_data.second_opponent = new_username
-                        
-                        await db.commit()
-                        await db.refresh(battle_data)
-                except Exception as e:
-                    print(f"Error updating battle {battle_id}: {e}")
-            
-            # 4. Update invitations (users who have this user in their invitations)
-            for other_user in all_users:
-                if old_username in other_user.invitations:
-                    other_user.invitations[other_user.invitations.index(old_username)] = new_username
-                    
-                    # Update Redis cache for this user
-                    other_user_dict = {
-                        'username': other_user.username,
-                        'email': other_user.email,
-                        'totalBattle': other_user.totalBattle,
-                        'winRate': other_user.winRate,
-                        'ranking': other_user.ranking,
-                        'winBattle': other_user.winBattle,
-                        'favourite': other_user.favourite,
-                        'streak': other_user.streak,
-                        'password': other_user.password,
-                        'friends': other_user.friends,
-                        'friendRequests': other_user.friendRequests,
-                        'avatar': other_user.avatar,
-                        'battles': other_user.battles,
-                        'invitations': other_user.invitations
-                    }
-                    redis_username.set(other_user.username, json.dumps(other_user_dict))
-                    redis_email.set(other_user.email, json.dumps(other_user_dict))
+            logger.info(f"Username changed from {old_username} to {new_username}, updating all references...")
             
+            # Friendships and requests are keyed by email; only battles store the name itself
+            await db.execute(update(BattleModel).where(BattleModel.first_opponent == old_username).values(first_opponent=new_username))
+            await db.execute(update(BattleModel).where(BattleModel.second_opponent == old_username).values(second_opponent=new_username))
+            await record_rename(db, old_username, user_model.email)
             await db.commit()
+            
+            friend_emails, requested_emails = await referencing_users(db, user_model.email)
+            await user_cache.edit_lists(_username_edits(friend_emails, requested_emails, old_username, new_username))
+            await username_resolver.renamed(old_username, new_username, user_model.email)
 
         # Create user dictionary for Redis
-        user_dict = {
-            'username': user_model.username,
-            'email': user_model.email,
-            'totalBattle': user_model.totalBattle,
-            'winRate': user_model.winRate,
-            'ranking': user_model.ranking,
-            'winBattle': user_model.winBattle,
-            'favourite': user_model.favourite,
-            'streak': user_model.streak,
-            'password': user_model.password,
-            'friends': user_model.friends,
-            'friendRequests': user_model.friendRequests,
-            'avatar': user_model.avatar,
-            'battles': user_model.battles,
-            'invitations': user_model.invitations
-        }
+        user_dict = await user_record(db, user_model)
         
-        # Update Redis cache
-        if old_username != new_username:
-            redis_username.delete(old_username)
-        redis_email.set(user_model.email, json.dumps(user_dict))
-        redis_username.set(user_model.username, json.dumps(user_dict))
+        # Update Redis cache; a rename also drops the record under the old username
+        await user_cache.put(user_dict, old_username=old_username)
         
         # Send websocket notification to the user
         try:
@@ -658,11 +388,40 @@ async def update_data(user: UserDataCreate):
         except Exception as e:
             logger.warning(f"[RESET] Failed to send websocket notification to {user_model.username}: {str(e)}")
         
-        return user.friends
+        return user_dict['friends']
 
 @db_router.get("/get-leaderboard")
 async def get_leaderboard():
     try:
+        from battle.leaderboard import leaderboard
+        try:
+            ranked_emails = await leaderboard.top()
+        except Exception as e:
+            logger.error(f"[DB_ROUTER] Leaderboard unavailable, using stored rankings: {str(e)}")
+            ranked_emails = []
+        
+        if ranked_emails:
+            async with SessionLocal() as db:
+                result = await db.execute(select(UserData).where(UserData.email.in_(ranked_emails)))
+                users_by_email = {user.email: user for user in result.scalars().all()}
+            
+            leaderboard_data = []
+            for rank, email in enumerate(ranked_emails, 1):
+                user = users_by_email.get(email)
+                if user is None:
+                    continue
+                leaderboard_data.append({
+                    'rank': rank,
+                    'username': user.username,
+                    'wins': user.winBattle,
+                    'totalBattles': user.totalBattle,
+                    'winRate': user.winRate,
+                    'streak': user.streak,
+                    'favoriteSport': user.favourite,
+                    'avatar': user.avatar
+                })
+            return leaderboard_data
+        
         async with SessionLocal() as db:
             # Get all users ordered by their stored ranking (which is calculated by the points system)
             stmt = select(UserData).order_by(UserData.ranking.asc())
@@ -700,7 +459,12 @@ async def get_user_ranking_details(username: str):
             
             # Calculate ranking points
             from battle.router import calculate_user_points, get_ranking_tier
+            from battle.leaderboard import leaderboard
             total_points = await calculate_user_points(user)
+            try:
+                rank = await leaderboard.rank_of(user.email) or user.ranking
+            except Exception:
+                rank = user.ranking
             tier_info = get_ranking_tier(total_points)
             
             # Calculate individual components
@@ -721,7 +485,7 @@ async def get_user_ranking_details(username: str):
             
             return {
                 'username': user.username,
-                'rank': user.ranking,
+                'rank': rank,
                 'total_points': total_points,
                 'tier_info': tier_info,
                 'breakdown': {
@@ -764,92 +528,105 @@ async def get_ranking_tiers():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting ranking tiers: {str(e)}")
 
+async def _delete_orphaned(model, key_columns, owner_column, chunk_size: int):
+    """
+    Walk a relation table in primary-key order, chunk_size rows per transaction,
+    deleting rows that point at a user who no longer exists. Returns the number
+    of rows scanned and the owner emails of the deleted rows, whose cached
+    lists are invalidated one pipeline per chunk.
+    """
+    scanned = 0
+    owners = []
+    after = None
+    while True:
+        async with SessionLocal() as db:
+            page = select(*key_columns).order_by(*key_columns).limit(chunk_size)
+            if after is not None:
+                page = page.where(tuple_(*key_columns) > tuple_(*after))
+            keys = (await db.execute(page)).all()
+            if not keys:
+                break
+            scanned += len(keys)
+            after = tuple(keys[-1])
+
+            result = await db.execute(
+                delete(model)
+                .where(tuple_(*key_columns).in_([tuple(key) for key in keys]))
+                .where(or_(*(~exists().where(UserData.email == column) for column in key_columns)))
+                .returning(owner_column)
+            )
+            removed = result.scalars().all()
+            await db.commit()
+
+        if removed:
+            owners.extend(removed)
+            await user_cache.invalidate_many(removed)
+        if len(keys) < chunk_size:
+            break
+    return scanned, owners
+
 @db_router.get("/cleanup-old-usernames")
 async def cleanup_old_usernames():
     """Clean up old usernames from friends lists and other references"""
     try:
         async with SessionLocal() as db:
-            # Get all users
-            all_users_stmt = select(UserData)
-            all_users_result = await db.execute(all_users_stmt)
-            all_users = all_users_result.scalars().all()
-            
-            cleanup_stats = {
-                "users_checked": 0,
-                "friends_lists_updated": 0,
-                "friend_requests_updated": 0,
+            user_count = await db.scalar(select(func.count()).select_from(UserData))
+        
+        # Relations are keyed by email with ON DELETE CASCADE, so only rows left behind
+        # by a load that bypassed the foreign keys can point at a missing user
+        friendships_scanned, removed_friends = await _delete_orphaned(
+            Friendship, (Friendship.user_email, Friendship.friend_email), Friendship.user_email, CLEANUP_CHUNK_SIZE
+        )
+        requests_scanned, removed_requests = await _delete_orphaned(
+            FriendRequest, (FriendRequest.to_email, FriendRequest.from_email), FriendRequest.to_email, CLEANUP_CHUNK_SIZE
+        )
+        
+        return {
+            "message": "Old username cleanup completed",
+            "stats": {
+                "users_checked": user_count,
+                "relations_checked": friendships_scanned + requests_scanned,
+                "friends_lists_updated": len(set(removed_friends)),
+                "friend_requests_updated": len(set(removed_requests)),
                 "invitations_updated": 0,
-                "total_old_references_removed": 0
-            }
-            
-            for user in all_users:
-                cleanup_stats["users_checked"] += 1
-                updated = False
-                
-                # Check friends list
-                original_friends = user.friends.copy()
-                user.friends = [friend for friend in user.friends if friend in [u.username for u in all_users]]
-                if len(user.friends) != len(original_friends):
-                    cleanup_stats["friends_lists_updated"] += 1
-                    cleanup_stats["total_old_references_removed"] += len(original_friends) - len(user.friends)
-                    updated = True
-                
-                # Check friend requests
-                original_requests = user.friendRequests.copy()
-                user.friendRequests = [req for req in user.friendRequests if req in [u.username for u in all_users]]
-                if len(user.friendRequests) != len(original_requests):
-                    cleanup_stats["friend_requests_updated"] += 1
-                    cleanup_stats["total_old_references_removed"] += len(original_requests) - len(user.friendRequests)
-                    updated = True
-                
-                # Check invitations (these are battle IDs, not usernames, so we'll skip for now)
-                
-                if updated:
-                    # Update Redis cache
-                    user_dict = {
-                        'username': user.username,
-                        'email': user.email,
-                        'totalBattle': user.totalBattle,
-                        'winRate': user.winRate,
-                        'ranking': user.ranking,
-                        'winBattle': user.winBattle,
-                        'favourite': user.favourite,
-                        'streak': user.streak,
-                        'password': user.password,
-                        'friends': user.friends,
-                        'friendRequests': user.friendRequests,
-                        'avatar': user.avatar,
-                        'battles': user.battles,
-                        'invitations': user.invitations
-                    }
-                    redis_username.set(user.username, json.dumps(user_dict))
-                    redis_email.set(user.email, json.dumps(user_dict))
-            
-            await db.commit()
-            
-            return {
-                "message": "Old username cleanup completed",
-                "stats": cleanup_stats
+                "total_old_references_removed": len(removed_friends) + len(removed_requests)
             }
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error cleaning up old usernames: {str(e)}")
 
+async def run_username_cleanup():
+    """Startup sweep, run in the background; only one worker per lock period does the work"""
+    try:
+        if not await redis_pool.client().set(CLEANUP_LOCK_KEY, WORKER_ID, nx=True, ex=CLEANUP_LOCK_SECONDS):
+            logger.info("[CLEANUP] Username cleanup ran recently on another worker, skipping")
+            return
+        cleanup_result = await cleanup_old_usernames()
+        logger.info(f"Old username cleanup completed: {cleanup_result}")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Error during old username cleanup: {e}")
+
 @db_router.post("/recalculate-all-rankings")
 async def recalculate_all_rankings():
-    """Manually recalculate all user rankings - useful for testing and fixing inconsistencies"""
+    """Start a background recalculation of all user rankings; poll /db/maintenance/jobs/{job_id} for progress"""
     try:
-        from battle.router import update_user_rankings
-        success = await update_user_rankings()
-        if success:
-            return {
-                "message": "All user rankings recalculated successfully",
-                "status": "success"
-            }
-        else:
-            raise HTTPException(status_code=500, detail="Failed to recalculate rankings")
+        job = await maintenance.start("recalculate_all_rankings")
+        return {
+            "message": "Recalculation of all user rankings started",
+            "status": job["state"],
+            "job": job
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error recalculating rankings: {str(e)}")
 
+@maintenance.job("recalculate_all_rankings")
+async def _recalculate_all_rankings_job(job):
+    from battle.leaderboard import leaderboard
+    await job.phase("rankings", await _count_users())
+    return {"users_ranked": await leaderboard.rebuild(progress=job.advance)}
+
 @db_router.post("/reset-user-stats", name="reset user statistics")
 async def reset_user_stats(username: str, reset_type: str = "all"):
     """
@@ -917,26 +694,10 @@ async def reset_user_stats(username: str, reset_type: str = "all"):
             await db.refresh(user_model)
             
             # Update Redis cache with complete user data
-            user_dict = {
-                'username': user_model.username,
-                'email': user_model.email,
-                'totalBattle': user_model.totalBattle,
-                'winRate': user_model.winRate,
-                'ranking': user_model.ranking,
-                'winBattle': user_model.winBattle,
-                'favourite': user_model.favourite,
-                'streak': user_model.streak,
-                'password': user_model.password,
-                'friends': user_model.friends,
-                'friendRequests': user_model.friendRequests,
-                'avatar': user_model.avatar,
-                'battles': user_model.battles,
-                'invitations': user_model.invitations
-            }
+            user_dict = await user_record(db, user_model)
             
             # Update both Redis caches
-            redis_email.set(user_model.email, json.dumps(user_dict))
-            redis_username.set(user_model.username, json.dumps(user_dict))
+            await user_cache.put(user_dict)
             
             # Send websocket notification to the user
             try:
@@ -962,54 +723,20 @@ async def reset_user_stats(username: str, reset_type: str = "all"):
             logger.info(f"[RESET] New stats for {username}: {new_stats}")
             logger.info(f"[RESET] Successfully reset {reset_type} statistics for user {username}")
             
-            # Recalculate rankings for all users after stats reset
+            # Re-score only this user; the debounced write-back persists anyone else's rank shift
             try:
-                from battle.router import update_user_rankings
-                logger.info(f"[RESET] Recalculating rankings after stats reset...")
-                ranking_success = await update_user_rankings()
-                if ranking_success:
-                    logger.info(f"[RESET] Successfully recalculated rankings after stats reset")
-                    
-                    # Get updated user data with new ranking
-                    await db.refresh(user_model)
-                    updated_user_dict = {
-                        'username': user_model.username,
-                        'email': user_model.email,
-                        'totalBattle': user_model.totalBattle,
-                        'winRate': user_model.winRate,
-                        'ranking': user_model.ranking,
-                        'winBattle': user_model.winBattle,
-                        'favourite': user_model.favourite,
-                        'streak': user_model.streak,
-                        'password': user_model.password,
-                        'friends': user_model.friends,
-                        'friendRequests': user_model.friendRequests,
-                        'avatar': user_model.avatar,
-                        'battles': user_model.battles,
-                        'invitations': user_model.invitations
-                    }
-                    
-                    # Update Redis with new ranking
-                    redis_email.set(user_model.email, json.dumps(updated_user_dict))
-                    redis_username.set(user_model.username, json.dumps(updated_user_dict))
-                    
-                    # Send updated websocket notification with new ranking
-                    try:
-                        from websocket import manager
-                        await manager.send_message(json.dumps({
-                            "type": "stats_reset",
-                            "data": updated_user_dict
-                        }), user_model.username)
-                        logger.info(f"[RESET] Sent updated stats_reset websocket notification to {user_model.username} with new ranking {user_model.ranking}")
-                    except Exception as e:
-                        logger.warning(f"[RESET] Failed to send updated websocket notification to {user_model.username}: {str(e)}")
-                    
-                    # Update the return data with new ranking
-                    new_stats['ranking'] = user_model.ranking
-                else:
-                    logger.warning(f"[RESET] Failed to recalculate rankings after stats reset")
+                from battle.leaderboard import leaderboard
+                await leaderboard.update_users([user_dict])
+                ranking = await leaderboard.rank_of(user_model.email)
+                if ranking is not None and ranking != user_model.ranking:
+                    user_model.ranking = ranking
+                    await db.commit()
+                    await user_cache.update_fields({user_model.email: {"ranking": ranking}})
+                new_stats['ranking'] = user_model.ranking
+                ranking_success = True
             except Exception as e:
-                logger.error(f"[RESET] Error recalculating rankings after stats reset: {str(e)}\n{traceback.format_exc()}")
+                ranking_success = False
+                logger.error(f"[RESET] Error re-scoring {username} after stats reset: {str(e)}\n{traceback.format_exc()}")
             
             return {
                 "message": f"User {reset_type} statistics reset successfully",
@@ -1017,7 +744,7 @@ async def reset_user_stats(username: str, reset_type: str = "all"):
                 "reset_type": reset_type,
                 "original_stats": original_stats,
                 "new_stats": new_stats,
-                "rankings_recalculated": ranking_success if 'ranking_success' in locals() else False
+                "rankings_recalculated": ranking_success
             }
             
     except HTTPException:
@@ -1026,163 +753,73 @@ async def reset_user_stats(username: str, reset_type: str = "all"):
         logger.error(f"[RESET] Error resetting stats for {username}: {str(e)}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Error resetting user statistics: {str(e)}")
 
+# Stats each bulk reset type sets back to zero
+RESET_VALUES = {
+    "all": {"winBattle": 0, "winRate": 0, "totalBattle": 0, "ranking": 0, "streak": 0, "battles": []},
+    "battles": {"winBattle": 0, "winRate": 0, "totalBattle": 0, "streak": 0, "battles": []},
+    "ranking": {"ranking": 0},
+    "streak": {"streak": 0},
+}
+
 @db_router.post("/reset-all-users-stats", name="reset all users statistics")
 async def reset_all_users_stats(reset_type: str = "all"):
     """
-    Reset statistics for all users (admin function)
+    Reset statistics for all users (admin function). Runs as a background
+    job; poll /db/maintenance/jobs/{job_id} for progress.
     """
-    logger.info(f"[RESET-ALL] Starting mass reset for all users, type: {reset_type}")
+    if reset_type not in RESET_VALUES:
+        raise HTTPException(status_code=400, detail="Invalid reset type. Use 'all', 'battles', 'ranking', or 'streak'")
     
+    logger.info(f"[RESET-ALL] Starting mass reset for all users, type: {reset_type}")
     try:
-        async with SessionLocal() as db:
-            # Get all users
-            stmt = select(UserData)
-            result = await db.execute(stmt)
-            users = result.scalars().all()
-            
-            reset_count = 0
-            errors = []
-            
-            for user in users:
-                try:
-                    # Store original values
-                    original_stats = {
-                        'totalBattle': user.totalBattle,
-                        'winBattle': user.winBattle,
-                        'winRate': user.winRate,
-                        'streak': user.streak,
-                        'ranking': user.ranking,
-                        'battles_count': len(user.battles) if user.battles else 0
-                    }
-                    
-                    # Reset based on type
-                    if reset_type == "all":
-                        user.winBattle = 0
-                        user.winRate = 0
-                        user.totalBattle = 0
-                        user.ranking = 0
-                        user.streak = 0
-                        user.battles = []
-                    elif reset_type == "battles":
-                        user.winBattle = 0
-                        user.winRate = 0
-                        user.totalBattle = 0
-                        user.streak = 0
-                        user.battles = []
-                    elif reset_type == "ranking":
-                        user.ranking = 0
-                    elif reset_type == "streak":
-                        user.streak = 0
-                    else:
-                        raise ValueError(f"Invalid reset type: {reset_type}")
-                    
-                    reset_count += 1
-                    logger.info(f"[RESET-ALL] Reset {reset_type} for user {user.username}")
-                    
-                except Exception as e:
-                    error_msg = f"Error resetting user {user.username}: {str(e)}"
-                    errors.append(error_msg)
-                    logger.error(f"[RESET-ALL] {error_msg}")
-            
-            await db.commit()
-            
-            # Update Redis for all users
-            for user in users:
-                try:
-                    user_dict = {
-                        'username': user.username,
-                        'email': user.email,
-                        'totalBattle': user.totalBattle,
-                        'winRate': user.winRate,
-                        'ranking': user.ranking,
-                        'winBattle': user.winBattle,
-                        'favourite': user.favourite,
-                        'streak': user.streak,
-                        'password': user.password,
-                        'friends': user.friends,
-                        'friendRequests': user.friendRequests,
-                        'avatar': user.avatar,
-                        'battles': user.battles,
-                        'invitations': user.invitations
-                    }
-                    
-                    redis_email.set(user.email, json.dumps(user_dict))
-                    redis_username.set(user.username, json.dumps(user_dict))
-                    
-                except Exception as e:
-                    error_msg = f"Error updating Redis for user {user.username}: {str(e)}"
-                    errors.append(error_msg)
-                    logger.error(f"[RESET-ALL] {error_msg}")
-            
-            logger.info(f"[RESET-ALL] Successfully reset {reset_count} users, {len(errors)} errors")
-            
-            # Recalculate rankings for all users after bulk stats reset
-            try:
-                from battle.router import update_user_rankings
-                logger.info(f"[RESET-ALL] Recalculating rankings after bulk stats reset...")
-                ranking_success = await update_user_rankings()
-                if ranking_success:
-                    logger.info(f"[RESET-ALL] Successfully recalculated rankings after bulk stats reset")
-                    
-                    # Update Redis for all users with new rankings
-                    for user in users:
-                        try:
-                            await db.refresh(user)
-                            updated_user_dict = {
-                                'username': user.username,
-                                'email': user.email,
-                                'totalBattle': user.totalBattle,
-                                'winRate': user.winRate,
-                                'ranking': user.ranking,
-                                'winBattle': user.winBattle,
-                                'favourite': user.favourite,
-                                'streak': user.streak,
-                                'password': user.password,
-                                'friends': user.friends,
-                                'friendRequests': user.friendRequests,
-                                'avatar': user.avatar,
-                                'battles': user.battles,
-                                'invitations': user.invitations
-                            }
-                            
-                            redis_email.set(user.email, json.dumps(updated_user_dict))
-                            redis_username.set(user.username, json.dumps(updated_user_dict))
-                            
-                            # Send websocket notification to each user
-                            try:
-                                from websocket import manager
-                                await manager.send_message(json.dumps({
-                                    "type": "stats_reset",
-                                    "data": updated_user_dict
-                                }), user.username)
-                                logger.info(f"[RESET-ALL] Sent stats_reset websocket notification to {user.username} with new ranking {user.ranking}")
-                            except Exception as e:
-                                logger.warning(f"[RESET-ALL] Failed to send websocket notification to {user.username}: {str(e)}")
-                                
-                        except Exception as e:
-                            error_msg = f"Error updating Redis for user {user.username}: {str(e)}"
-                            errors.append(error_msg)
-                            logger.error(f"[RESET-ALL] {error_msg}")
-                else:
-                    logger.warning(f"[RESET-ALL] Failed to recalculate rankings after bulk stats reset")
-                    errors.append("Failed to recalculate rankings")
-            except Exception as e:
-                error_msg = f"Error recalculating rankings after bulk stats reset: {str(e)}"
-                errors.append(error_msg)
-                logger.error(f"[RESET-ALL] {error_msg}\n{traceback.format_exc()}")
-            
-            return {
-                "message": f"Successfully reset {reset_type} statistics for {reset_count} users",
-                "reset_type": reset_type,
-                "users_reset": reset_count,
-                "rankings_recalculated": ranking_success if 'ranking_success' in locals() else False,
-                "errors": errors if errors else None
-            }
-            
+        job = await maintenance.start("reset_all_users_stats", reset_type=reset_type)
+        return {
+            "message": f"Reset of {reset_type} statistics for all users started",
+            "reset_type": reset_type,
+            "status": job["state"],
+            "job": job
+        }
     except Exception as e:
-        logger.error(f"[RESET-ALL] Error in mass reset: {str(e)}\n{traceback.format_exc()}")
+        logger.error(f"[RESET-ALL] Error starting mass reset: {str(e)}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Error resetting all users statistics: {str(e)}")
 
+@maintenance.job("reset_all_users_stats")
+async def _reset_all_users_stats_job(job, reset_type: str):
+    """Reset in chunks, rebuild the rankings, then tell every user their new stats"""
+    from battle.leaderboard import leaderboard
+    from websocket import manager
+    values = RESET_VALUES[reset_type]
+    total = await _count_users()
+    
+    if await job.phase("reset", total):
+        async for users in _stream_users(job.cursor):
+            records = [{**user_to_dict(user), **values} for user in users]
+            async with SessionLocal() as db:
+                await db.execute(update(UserData).where(UserData.email.in_([user.email for user in users])).values(**values))
+                await db.commit()
+            await user_cache.put_many(records)
+            await job.advance(len(users), cursor=users[-1].email)
+        logger.info(f"[RESET-ALL] Reset {reset_type} for {job.processed} users")
+    
+    if await job.phase("rankings", total):
+        await leaderboard.rebuild(progress=job.advance)
+    
+    if await job.phase("notify", total):
+        async for users in _stream_users(job.cursor):
+            async with SessionLocal() as db:
+                records = await user_records(db, users)
+            for record in records:
+                try:
+                    await manager.send_message(json.dumps({
+                        "type": "stats_reset",
+                        "data": record
+                    }), record['username'])
+                except Exception as e:
+                    logger.warning(f"[RESET-ALL] Failed to send websocket notification to {record['username']}: {str(e)}")
+            await job.advance(len(users), cursor=users[-1].email)
+    
+    return {"reset_type": reset_type, "users_reset": total}
+
 @db_router.get("/debug-user-stats/{username}", name="debug user statistics")
 async def debug_user_stats(username: str):
     """Debug endpoint to check user statistics"""
@@ -1208,10 +845,8 @@ async def debug_user_stats(username: str):
             }
         
         # Get user from Redis
-        redis_data = redis_username.get(username)
-        redis_stats = None
-        if redis_data:
-            redis_stats = json.loads(redis_data)
+        redis_stats = await user_cache.peek(username)
+        if redis_stats:
             redis_stats = {
                 "username": redis_stats.get('username'),
                 "email": redis_stats.get('email'),
@@ -1378,26 +1013,21 @@ async def debug_redis_health():
     """Debug endpoint to check Redis health and data"""
     try:
         # Test Redis connection
-        redis_username.ping()
+        await redis_pool.client().ping()
         
         # Get some sample data
-        sample_keys = redis_username.keys("*")
+        sample_usernames = await user_cache.cached_usernames()
         sample_data = {}
         
-        for key in sample_keys[:5]:  # Show first 5 keys
-            if isinstance(key, bytes):
-                key = key.decode('utf-8')
-            data = redis_username.get(key)
+        for username in sample_usernames[:5]:  # Show first 5 users
+            data = await user_cache.peek(username)
             if data:
-                try:
-                    sample_data[key] = json.loads(data)
-                except:
-                    sample_data[key] = "Non-JSON data"
+                sample_data[username] = data
         
         return {
             "status": "healthy",
             "connection": "ok",
-            "total_keys": len(sample_keys),
+            "total_keys": len(sample_usernames),
             "sample_data": sample_data,
             "timestamp": str(datetime.now())
         }
@@ -1416,11 +1046,10 @@ async def debug_user_battles_list(username: str):
         logger.info(f"[DEBUG] Checking battles for user: {username}")
         
         # Get user from Redis
-        user_data = redis_username.get(username)
-        if not user_data:
+        user_dict = await user_cache.peek(username)
+        if not user_dict:
             return {"error": f"User {username} not found in Redis"}
         
-        user_dict = json.loads(user_data)
         battles_list = user_dict.get('battles', [])
         
         logger.info(f"[DEBUG] User {username} battles list from Redis: {battles_list}")
@@ -1466,96 +1095,109 @@ async def debug_user_battles_list(username: str):
         logger.error(f"[DEBUG] Full traceback: {traceback.format_exc()}")
         return {"error": f"Error checking user battles: {str(e)}"}
 
+# Columns a battle repair rebuilds from the battles table
+REPAIRED_FIELDS = ("battles", "totalBattle", "winBattle", "streak", "winRate")
+
+async def _count_users() -> int:
+    async with SessionLocal() as db:
+        return await db.scalar(select(func.count()).select_from(UserData))
+
+async def _stream_users(after: Optional[str] = None):
+    """Users in email order after a cursor, MAINTENANCE_CHUNK_SIZE per chunk from one server-side cursor"""
+    async with SessionLocal() as db:
+        stmt = select(UserData).order_by(UserData.email).execution_options(yield_per=MAINTENANCE_CHUNK_SIZE)
+        if after is not None:
+            stmt = stmt.where(UserData.email > after)
+        result = await db.stream_scalars(stmt)
+        async for users in result.partitions():
+            yield users
+
+def _battle_stats(username: str, battles) -> dict:
+    """A user's battles array, totalBattle, winBattle, streak and winRate from their battle rows"""
+    # Oldest first by creation time; the id only breaks ties
+    battles = sorted(battles, key=lambda b: (b.created_at, str(b.id)))
+    win_count = 0
+    streak = 0
+    current_streak = 0
+    for battle in reversed(battles):  # Most recent first
+        # Determine if user is first or second opponent
+        if battle.first_opponent == username:
+            my_score = battle.first_opponent_score
+            opp_score = battle.second_opponent_score
+        else:
+            my_score = battle.second_opponent_score
+            opp_score = battle.first_opponent_score
+        if my_score > opp_score:
+            win_count += 1
+            current_streak += 1
+        else:
+            # A draw or a loss breaks the streak
+            current_streak = 0
+        if streak == 0 and current_streak > 0:
+            streak = current_streak
+    return {
+        "battles": [battle.id for battle in battles],
+        "totalBattle": len(battles),
+        "winBattle": win_count,
+        "streak": streak,
+        "winRate": math.floor((win_count / len(battles)) * 100) if battles else 0,
+    }
+
+async def _repair_users(db, users) -> list:
+    """
+    Rebuild the battle stats of a chunk of users with one battles query and
+    one bulk UPDATE; returns their records with the repaired stats. The
+    caller commits.
+    """
+    battles_by_user = {user.username: [] for user in users}
+    result = await db.execute(
+        select(BattleModel.id, BattleModel.first_opponent, BattleModel.second_opponent,
+               BattleModel.first_opponent_score, BattleModel.second_opponent_score, BattleModel.created_at)
+        .where(or_(BattleModel.first_opponent.in_(list(battles_by_user)), BattleModel.second_opponent.in_(list(battles_by_user))))
+    )
+    for battle in result.all():
+        for name in {battle.first_opponent, battle.second_opponent}:
+            if name in battles_by_user:
+                battles_by_user[name].append(battle)
+    
+    repaired = [{**user_to_dict(user), **_battle_stats(user.username, battles_by_user[user.username])} for user in users]
+    await db.execute(
+        update(UserData.__table__)
+        .where(UserData.__table__.c.email == bindparam("b_email"))
+        .values(**{field: bindparam(f"b_{field}") for field in REPAIRED_FIELDS}),
+        [{"b_email": record['email'], **{f"b_{field}": record[field] for field in REPAIRED_FIELDS}} for record in repaired]
+    )
+    return repaired
+
 @db_router.post("/repair-user-battles", name="repair user battles")
 async def repair_user_battles():
-    """Repair all users' battles arrays, totalBattle, winBattle, streak, and ranking to match the actual battles in the database."""
-    from models import UserData, BattleModel
-    from init import redis_username, redis_email, SessionLocal
-    import json
-    import logging
-    import math
-    # Import here to avoid circular import
-    from battle.router import update_user_rankings
-    logger = logging.getLogger(__name__)
+    """Start a background repair of all users' battles arrays, totalBattle, winBattle, streak, and ranking to match the actual battles in the database."""
     try:
-        async with SessionLocal() as db:
-            # Get all users
-            users_result = await db.execute(select(UserData))
-            users = users_result.scalars().all()
-            # Get all battles
-            battles_result = await db.execute(select(BattleModel))
-            battles = battles_result.scalars().all()
-            # Build a mapping from username to battle objects
-            user_battles_map = {user.username: [] for user in users}
-            for battle in battles:
-                if battle.first_opponent:
-                    user_battles_map.setdefault(battle.first_opponent, []).append(battle)
-                if battle.second_opponent:
-                    user_battles_map.setdefault(battle.second_opponent, []).append(battle)
-            # Update each user
-            for user in users:
-                user_battles = user_battles_map.get(user.username, [])
-                # Sort battles by id (assuming id encodes time, else add created_at)
-                user_battles.sort(key=lambda b: str(b.id))
-                battle_ids = [b.id for b in user_battles]
-                user.battles = battle_ids
-                user.totalBattle = len(battle_ids)
-                # Calculate winBattle and streak
-                win_count = 0
-                streak = 0
-                current_streak = 0
-                for battle in reversed(user_battles):  # Most recent first
-                    # Determine if user is first or second opponent
-                    if battle.first_opponent == user.username:
-                        my_score = battle.first_opponent_score
-                        opp_score = battle.second_opponent_score
-                    else:
-                        my_score = battle.second_opponent_score
-                        opp_score = battle.first_opponent_score
-                    if my_score > opp_score:
-                        win_count += 1
-                        current_streak += 1
-                    else:
-                        if my_score == opp_score:
-                            # Draw breaks streak
-                            current_streak = 0
-                        else:
-                            current_streak = 0
-                    if streak == 0 and current_streak > 0:
-                        streak = current_streak
-                user.winBattle = win_count
-                user.streak = streak
-                # Calculate winRate
-                user.winRate = math.floor((user.winBattle / user.totalBattle) * 100) if user.totalBattle > 0 else 0
-                await db.commit()
-                await db.refresh(user)
-                # Update Redis
-                user_dict = {
-                    'username': user.username,
-                    'email': user.email,
-                    'totalBattle': user.totalBattle,
-                    'winRate': user.winRate,
-                    'ranking': user.ranking,
-                    'winBattle': user.winBattle,
-                    'favourite': user.favourite,
-                    'streak': user.streak,
-                    'password': user.password,
-                    'friends': user.friends,
-                    'friendRequests': user.friendRequests,
-                    'avatar': user.avatar,
-                    'battles': user.battles,
-                    'invitations': user.invitations
-                }
-                redis_username.set(user.username, json.dumps(user_dict))
-                redis_email.set(user.email, json.dumps(user_dict))
-                logger.info(f"[REPAIR] Updated user {user.username}: {len(battle_ids)} battles, {user.winBattle} wins, streak {user.streak}")
-            # Recalculate rankings for all users
-            await update_user_rankings()
-        return {"status": "success", "message": "All users' battles, winBattle, streak, winRate, and ranking repaired."}
+        job = await maintenance.start("repair_user_battles")
+        return {"status": job["state"], "message": "Repair of all users' battles, winBattle, streak, winRate, and ranking started.", "job": job}
     except Exception as e:
-        logger.error(f"[REPAIR] Error repairing user battles: {str(e)}")
+        logger.error(f"[REPAIR] Error starting user battles repair: {str(e)}")
         return {"status": "error", "message": str(e)}
 
+@maintenance.job("repair_user_battles")
+async def _repair_user_battles_job(job):
+    from battle.leaderboard import leaderboard
+    total = await _count_users()
+    
+    if await job.phase("repair", total):
+        async for users in _stream_users(job.cursor):
+            async with SessionLocal() as db:
+                repaired = await _repair_users(db, users)
+                await db.commit()
+            await user_cache.put_many(repaired)
+            await job.advance(len(users), cursor=users[-1].email)
+            logger.info(f"[REPAIR] Repaired {job.processed}/{total} users")
+    
+    if await job.phase("rankings", total):
+        await leaderboard.rebuild(progress=job.advance)
+    
+    return {"users_repaired": total}
+
 @db_router.get("/debug-user-battle-count/{username}", name="debug user battle count")
 async def debug_user_battle_count(username: str):
     """Debug endpoint to check a user's battle count and statistics"""
@@ -1563,11 +1205,10 @@ async def debug_user_battle_count(username: str):
         logger.info(f"[DEBUG] Checking battle count for user: {username}")
         
         # Get user from Redis
-        user_data = redis_username.get(username)
-        if not user_data:
+        user_dict = await user_cache.peek(username)
+        if not user_dict:
             return {"error": f"User {username} not found in Redis"}
         
-        user_dict = json.loads(user_data)
         battles_list = user_dict.get('battles', [])
         
         logger.info(f"[DEBUG] User {username} battles list from Redis: {battles_list}")
@@ -1624,137 +1265,66 @@ async def debug_user_battle_count(username: str):
 @db_router.post("/force-repair-user-battles/{username}", name="force repair user battles")
 async def force_repair_user_battles(username: str):
     """Force repair a specific user's battles array, totalBattle, winBattle, streak, and ranking"""
-    from models import UserData, BattleModel
-    from init import redis_username, redis_email, SessionLocal
-    import json
-    import logging
-    import math
-    # Import here to avoid circular import
-    from battle.router import update_user_rankings
-    logger = logging.getLogger(__name__)
-    
     try:
         logger.info(f"[FORCE-REPAIR] Starting force repair for user: {username}")
-        
-        async with SessionLocal() as db:
-            # Get the specific user
-            user = await db.get(UserData, username)
-            if not user:
-                logger.error(f"[FORCE-REPAIR] User {username} not found in database")
-                return {"error": f"User {username} not found"}
-            
-            # Get all battles for this user
-            stmt_first = select(BattleModel).where(BattleModel.first_opponent == username)
-            result_first = await db.execute(stmt_first)
-            battles_as_first = result_first.scalars().all()
-            
-            stmt_second = select(BattleModel).where(BattleModel.second_opponent == username)
-            result_second = await db.execute(stmt_second)
-            battles_as_second = result_second.scalars().all()
-            
-            # Combine all battles
-            all_user_battles = list(battles_as_first) + list(battles_as_second)
-            
-            # Remove duplicates (in case user appears as both first and second opponent in same battle)
-            unique_battles = []
-            seen_ids = set()
-            for battle in all_user_battles:
-                if battle.id not in seen_ids:
-                    unique_battles.append(battle)
-                    seen_ids.add(battle.id)
-            
-            # Sort battles by id
-            unique_battles.sort(key=lambda b: str(b.id))
-            battle_ids = [b.id for b in unique_battles]
-            
-            logger.info(f"[FORCE-REPAIR] User {username} has {len(battle_ids)} battles: {battle_ids}")
-            
-            # Update user battles list
-            user.battles = battle_ids
-            user.totalBattle = len(battle_ids)
-            
-            # Calculate winBattle and streak
-            win_count = 0
-            streak = 0
-            current_streak = 0
-            
-            for battle in reversed(unique_battles):  # Most recent first
-                # Determine if user is first or second opponent
-                if battle.first_opponent == username:
-                    my_score = battle.first_opponent_score
-                    opp_score = battle.second_opponent_score
-                else:
-                    my_score = battle.second_opponent_score
-                    opp_score = battle.first_opponent_score
-                
-                if my_score > opp_score:
-                    win_count += 1
-                    current_streak += 1
-                else:
-                    if my_score == opp_score:
-                        # Draw breaks streak
-                        current_streak = 0
-                    else:
-                        current_streak = 0
-                
-                if streak == 0 and current_streak > 0:
-                    streak = current_streak
-            
-            user.winBattle = win_count
-            user.streak = streak
-            user.winRate = math.floor((user.winBattle / user.totalBattle) * 100) if user.totalBattle > 0 else 0
-            
-            await db.commit()
-            await db.refresh(user)
-            
-            logger.info(f"[FORCE-REPAIR] Updated user {username}: totalBattle={user.totalBattle}, winBattle={user.winBattle}, winRate={user.winRate}, streak={user.streak}")
-            
-            # Update Redis cache
-            user_dict = {
-                'username': user.username,
-                'email': user.email,
-                'totalBattle': user.totalBattle,
-                'winRate': user.winRate,
-                'ranking': user.ranking,
-                'winBattle': user.winBattle,
-                'favourite': user.favourite,
-                'streak': user.streak,
-                'password': user.password,
-                'friends': user.friends,
-                'friendRequests': user.friendRequests,
-                'avatar': user.avatar,
-                'battles': user.battles,
-                'invitations': user.invitations
-            }
-            
-            redis_username.set(user.username, json.dumps(user_dict))
-            redis_email.set(user.email, json.dumps(user_dict))
-            
-            logger.info(f"[FORCE-REPAIR] Updated Redis cache for user {username}")
-            
-            # Update rankings
-            try:
-                await update_user_rankings()
-                logger.info(f"[FORCE-REPAIR] Updated user rankings")
-            except Exception as e:
-                logger.error(f"[FORCE-REPAIR] Error updating rankings: {str(e)}")
-            
-            return {
-                "success": True,
-                "message": f"Successfully repaired user {username}",
-                "user_stats": {
-                    "totalBattle": user.totalBattle,
-                    "winBattle": user.winBattle,
-                    "winRate": user.winRate,
-                    "streak": user.streak,
-                    "battles_count": len(user.battles)
-                }
-            }
-            
+        job = await maintenance.start("force_repair_user_battles", username=username)
+        return {
+            "success": True,
+            "message": f"Repair of user {username} started",
+            "job": job
+        }
     except Exception as e:
         logger.error(f"[FORCE-REPAIR] Error repairing user {username}: {str(e)}")
-        import traceback
         logger.error(f"[FORCE-REPAIR] Full traceback: {traceback.format_exc()}")
         return {"error": f"Error repairing user {username}: {str(e)}"}
 
+@maintenance.job("force_repair_user_battles")
+async def _force_repair_user_battles_job(job, username: str):
+    from battle.leaderboard import leaderboard
+    await job.phase("repair", 1)
+    async with SessionLocal() as db:
+        result = await db.execute(select(UserData).where(UserData.username == username))
+        user = result.scalar_one_or_none()
+        if user is None:
+            raise ValueError(f"User {username} not found")
+        record = (await _repair_users(db, [user]))[0]
+        await db.commit()
+    
+    await user_cache.put_many([record])
+    # Only this user's score changed; the debounced write-back persists any rank shifts
+    await leaderboard.update_users([record])
+    await job.advance(1, cursor=record['email'])
+    logger.info(f"[FORCE-REPAIR] Updated user {username}: totalBattle={record['totalBattle']}, winBattle={record['winBattle']}, winRate={record['winRate']}, streak={record['streak']}")
+    
+    return {
+        "username": username,
+        "user_stats": {
+            "totalBattle": record['totalBattle'],
+            "winBattle": record['winBattle'],
+            "winRate": record['winRate'],
+            "streak": record['streak'],
+            "battles_count": len(record['battles'])
+        }
+    }
+
+@db_router.get("/maintenance/jobs", name="list maintenance jobs")
+async def list_maintenance_jobs(limit: int = 20):
+    """Most recent bulk maintenance jobs, newest first, with progress and ETA"""
+    return await maintenance.recent(limit)
+
+@db_router.get("/maintenance/jobs/{job_id}", name="maintenance job status")
+async def get_maintenance_job(job_id: str):
+    job = await maintenance.status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@db_router.post("/maintenance/jobs/{job_id}/resume", name="resume maintenance job")
+async def resume_maintenance_job(job_id: str):
+    """Restart a failed or interrupted job from its last committed chunk"""
+    job = await maintenance.resume(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
 
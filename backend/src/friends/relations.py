@@ -0,0 +1,121 @@
+import logging
+from typing import Dict, Iterable, List, Tuple
+from sqlalchemy import select, delete, or_, and_
+from sqlalchemy.dialects.postgresql import insert
+from models import UserData, Friendship, FriendRequest, BattleInvitation
+from user_cache import user_to_dict
+
+logger = logging.getLogger(__name__)
+
+
+async def relations_for(session, emails: Iterable[str]) -> Dict[str, dict]:
+    """friends / friendRequests (usernames) and invitations (battle ids) per email, oldest first"""
+    emails = list(dict.fromkeys(emails))
+    relations = {email: {"friends": [], "friendRequests": [], "invitations": []} for email in emails}
+    if not emails:
+        return relations
+
+    friends = await session.execute(
+        select(Friendship.user_email, UserData.username)
+        .join(UserData, UserData.email == Friendship.friend_email)
+        .where(Friendship.user_email.in_(emails))
+        .order_by(Friendship.created_at)
+    )
+    for email, username in friends.all():
+        relations[email]["friends"].append(username)
+
+    requests = await session.execute(
+        select(FriendRequest.to_email, UserData.username)
+        .join(UserData, UserData.email == FriendRequest.from_email)
+        .where(FriendRequest.to_email.in_(emails))
+        .order_by(FriendRequest.created_at)
+    )
+    for email, username in requests.all():
+        relations[email]["friendRequests"].append(username)
+
+    invitations = await session.execute(
+        select(BattleInvitation.email, BattleInvitation.battle_id)
+        .where(BattleInvitation.email.in_(emails))
+        .order_by(BattleInvitation.created_at)
+    )
+    for email, battle_id in invitations.all():
+        relations[email]["invitations"].append(battle_id)
+    return relations
+
+
+async def user_record(session, user) -> dict:
+    """The full user record (as cached and sent to clients) for a UserData model"""
+    return (await user_records(session, [user]))[0]
+
+
+async def user_records(session, users: List) -> List[dict]:
+    relations = await relations_for(session, (user.email for user in users))
+    return [user_to_dict(user, relations[user.email]) for user in users]
+
+
+async def referencing_users(session, email: str) -> Tuple[List[str], List[str]]:
+    """Emails whose friends list, and whose friendRequests, show this user's username"""
+    friends = await session.execute(select(Friendship.user_email).where(Friendship.friend_email == email))
+    requested = await session.execute(select(FriendRequest.to_email).where(FriendRequest.from_email == email))
+    return list(friends.scalars().all()), list(requested.scalars().all())
+
+
+async def _insert(session, model, **values) -> bool:
+    """Insert one relation row; False if it already existed"""
+    result = await session.execute(
+        insert(model).values(**values).on_conflict_do_nothing().returning(*model.__table__.primary_key.columns)
+    )
+    return result.first() is not None
+
+
+async def add_friend_request(session, to_email: str, from_email: str) -> bool:
+    return await _insert(session, FriendRequest, to_email=to_email, from_email=from_email)
+
+
+async def remove_friend_request(session, to_email: str, from_email: str) -> bool:
+    result = await session.execute(
+        delete(FriendRequest).where(FriendRequest.to_email == to_email, FriendRequest.from_email == from_email)
+    )
+    return result.rowcount > 0
+
+
+async def add_friendship(session, email: str, friend_email: str) -> bool:
+    """Befriend two users (both directions) and drop any requests between them"""
+    await session.execute(delete(FriendRequest).where(or_(
+        and_(FriendRequest.to_email == email, FriendRequest.from_email == friend_email),
+        and_(FriendRequest.to_email == friend_email, FriendRequest.from_email == email),
+    )))
+    added = await _insert(session, Friendship, user_email=email, friend_email=friend_email)
+    added_back = await _insert(session, Friendship, user_email=friend_email, friend_email=email)
+    return added or added_back
+
+
+async def remove_friendship(session, email: str, friend_email: str) -> bool:
+    result = await session.execute(delete(Friendship).where(or_(
+        and_(Friendship.user_email == email, Friendship.friend_email == friend_email),
+        and_(Friendship.user_email == friend_email, Friendship.friend_email == email),
+    )))
+    return result.rowcount > 0
+
+
+async def add_invitation(session, email: str, battle_id: str) -> bool:
+    return await _insert(session, BattleInvitation, email=email, battle_id=battle_id)
+
+
+async def remove_invitation(session, email: str, battle_id: str) -> bool:
+    result = await session.execute(
+        delete(BattleInvitation).where(BattleInvitation.email == email, BattleInvitation.battle_id == battle_id)
+    )
+    return result.rowcount > 0
+
+
+async def clear_invitations(session, battle_id: str) -> Dict[str, str]:
+    """Withdraw every invitation to a battle; returns {email: username} of the users who had one"""
+    result = await session.execute(
+        delete(BattleInvitation).where(BattleInvitation.battle_id == battle_id).returning(BattleInvitation.email)
+    )
+    emails = list(result.scalars().all())
+    if not emails:
+        return {}
+    users = await session.execute(select(UserData.email, UserData.username).where(UserData.email.in_(emails)))
+    return dict(users.all())
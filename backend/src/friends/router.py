@@ -1,26 +1,28 @@
 from fastapi import APIRouter, HTTPException
-import json
-from init import redis_username, redis_email
-from models import UserDataCreate
-from db.router import update_data
+from init import SessionLocal
+from user_cache import user_cache
+from friends.relations import add_friend_request, remove_friend_request, add_friendship, remove_friendship
 
 router_friend = APIRouter()
 
 @router_friend.post("/cancel-friend-request")
 async def cancel_friend_request(username: str, from_username: str):
     try:
-        user_model = redis_username.get(username)
+        users = await user_cache.get_many([username, from_username])
+        user_model = users.get(username)
         if not user_model:
             raise HTTPException(status_code=404, detail="User not found")
-        
-        user_model = json.loads(user_model)
-           
+
+        from_model = users.get(from_username)
+        if from_model:
+            async with SessionLocal() as db:
+                removed = await remove_friend_request(db, user_model['email'], from_model['email'])
+                await db.commit()
+            if removed:
+                await user_cache.edit_lists({user_model['email']: [("remove", "friendRequests", from_username)]})
+
         if from_username in user_model.get('friendRequests', []):
             user_model['friendRequests'].remove(from_username)
-
-        redis_email.set(user_model['email'], json.dumps(user_model))
-        redis_username.set(username, json.dumps(user_model))
-        await update_data(UserDataCreate(**user_model)) 
         return user_model
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -28,37 +30,28 @@ async def cancel_friend_request(username: str, from_username: str):
 @router_friend.post("/add-friend")
 async def add_friend(username: str, friend_username: str):
     try:
-        user_model = redis_username.get(username)
-        friend_model = redis_username.get(friend_username)
-        
+        users = await user_cache.get_many([username, friend_username])
+        user_model = users.get(username)
+        friend_model = users.get(friend_username)
+
         if not user_model or not friend_model:
             raise HTTPException(status_code=404, detail="User not found")
-        
-        user_model = json.loads(user_model)
-        friend_model = json.loads(friend_model)
-        
-        # Remove friend requests
+
+        # One transaction: both friendship rows in, requests either way out
+        async with SessionLocal() as db:
+            await add_friendship(db, user_model['email'], friend_model['email'])
+            await db.commit()
+
+        await user_cache.edit_lists({
+            user_model['email']: [("remove", "friendRequests", friend_username), ("add", "friends", friend_username)],
+            friend_model['email']: [("remove", "friendRequests", username), ("add", "friends", username)],
+        })
+
         if friend_username in user_model.get('friendRequests', []):
             user_model['friendRequests'].remove(friend_username)
-        
-        if username in friend_model.get('friendRequests', []):
-            friend_model['friendRequests'].remove(username)
-
-        # Add to friends list
         if friend_username not in user_model.get('friends', []):
             user_model.setdefault('friends', []).append(friend_username)
-        if username not in friend_model.get('friends', []):
-            friend_model.setdefault('friends', []).append(username)
-
-        # Update Redis and database
-        redis_email.set(user_model['email'], json.dumps(user_model))
-        redis_username.set(username, json.dumps(user_model))
-        redis_email.set(friend_model['email'], json.dumps(friend_model))
-        redis_username.set(friend_username, json.dumps(friend_model))
-        
-        await update_data(UserDataCreate(**user_model))
-        await update_data(UserDataCreate(**friend_model))
-        
+
         return user_model
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -66,19 +59,17 @@ async def add_friend(username: str, friend_username: str):
 @router_friend.post("/friend-requests")
 async def send_friend_request(username: str, from_username: str):
     try:
-        user_model = redis_username.get(username)
-        if not user_model:
+        users = await user_cache.get_many([username, from_username])
+        user_model = users.get(username)
+        from_model = users.get(from_username)
+        if not user_model or not from_model:
             raise HTTPException(status_code=404, detail="User not found")
-        
-        user_model = json.loads(user_model)
-       
-        if from_username not in user_model.get('friendRequests', []):
-            user_model.setdefault('friendRequests', []).append(from_username)
-        
-        redis_email.set(user_model['email'], json.dumps(user_model))
-        redis_username.set(username, json.dumps(user_model))
-        
-        await update_data(UserDataCreate(**user_model))
+
+        async with SessionLocal() as db:
+            added = await add_friend_request(db, user_model['email'], from_model['email'])
+            await db.commit()
+        if added:
+            await user_cache.edit_lists({user_model['email']: [("add", "friendRequests", from_username)]})
         return True
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -86,11 +77,10 @@ async def send_friend_request(username: str, from_username: str):
 @router_friend.get("/check-friend-request")
 async def check_friend_request(username: str, from_username: str) -> bool:
     try:
-        user_model = redis_username.get(username)
+        user_model = await user_cache.get(username)
         if not user_model:
             raise HTTPException(status_code=404, detail="User not found")
-        
-        user_model = json.loads(user_model)
+
         return from_username in user_model.get('friendRequests', [])
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -98,32 +88,21 @@ async def check_friend_request(username: str, from_username: str) -> bool:
 @router_friend.post("/remove-friend")
 async def remove_friend(username: str, from_username: str):
     try:
-        # Remove friend for first user
-        user_model = redis_username.get(username)
-        if not user_model:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        user_model = json.loads(user_model)
-        if from_username in user_model.get('friends', []):
-            user_model['friends'].remove(from_username)
-        
-        redis_email.set(user_model['email'], json.dumps(user_model))
-        redis_username.set(username, json.dumps(user_model))
-        await update_data(UserDataCreate(**user_model))
-
-        # Remove friend for second user
-        friend_model = redis_username.get(from_username)
-        if not friend_model:
+        users = await user_cache.get_many([username, from_username])
+        user_model = users.get(username)
+        friend_model = users.get(from_username)
+        if not user_model or not friend_model:
             raise HTTPException(status_code=404, detail="User not found")
-        
-        friend_model = json.loads(friend_model)
-        if username in friend_model.get('friends', []):
-            friend_model['friends'].remove(username)
-        
-        redis_email.set(friend_model['email'], json.dumps(friend_model))
-        redis_username.set(from_username, json.dumps(friend_model))
-        await update_data(UserDataCreate(**friend_model))
 
+        # Both directions in one statement
+        async with SessionLocal() as db:
+            await remove_friendship(db, user_model['email'], friend_model['email'])
+            await db.commit()
+
+        await user_cache.edit_lists({
+            user_model['email']: [("remove", "friends", from_username)],
+            friend_model['email']: [("remove", "friends", username)],
+        })
         return True
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -131,10 +110,10 @@ async def remove_friend(username: str, from_username: str):
 @router_friend.get("/search-user")
 async def search_user(username: str):
     try:
-        user_model = redis_username.get(username.strip())
+        user_model = await user_cache.get(username.strip())
         if not user_model:
             raise HTTPException(status_code=404, detail="User not found")
-        
-        return json.loads(user_model)
+
+        return user_model
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
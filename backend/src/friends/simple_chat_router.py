@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, func, update
-from db.init import get_async_db
+from init import get_db
 from models import SimpleChatMessage, SimpleChatCreate, SimpleChatResponse
 from typing import List, Dict, Any
 import uuid
@@ -12,7 +12,7 @@ simple_chat_router = APIRouter()
 @simple_chat_router.post("/simple-chat/send", response_model=SimpleChatResponse)
 async def send_message(
     message_data: SimpleChatCreate,
-    db: AsyncSession = Depends(get_async_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Send a new chat message"""
     try:
@@ -48,7 +48,7 @@ async def send_message(
 async def get_chat_history(
     sender: str,
     receiver: str,
-    db: AsyncSession = Depends(get_async_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get chat history between two users"""
     try:
@@ -86,7 +86,7 @@ async def get_chat_history(
 async def get_chat_preview(
     username: str,
     friendUsername: str,
-    db: AsyncSession = Depends(get_async_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get chat preview (last message and unread count) between two users"""
     try:
@@ -137,7 +137,7 @@ async def get_chat_preview(
 async def mark_messages_read(
     sender: str,
     receiver: str,
-    db: AsyncSession = Depends(get_async_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Mark messages as read"""
     try:
@@ -157,7 +157,7 @@ async def mark_messages_read(
 @simple_chat_router.get("/simple-chat/unread-count")
 async def get_unread_count(
     receiver: str,
-    db: AsyncSession = Depends(get_async_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get unread message count for a user"""
     try:
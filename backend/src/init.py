@@ -7,6 +7,8 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import os
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.orm import sessionmaker
 import redis
 
@@ -27,12 +29,39 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Database setup
-engine = create_async_engine(DATABASE_URL, echo=True)
+# Database setup: the one engine every router, task and script shares.
+# Each process keeps DB_POOL_SIZE connections open and opens up to
+# DB_MAX_OVERFLOW more under bursts; pre-ping replaces connections the
+# server dropped while they sat idle in the pool.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+
+# Prepared statements asyncpg keeps per connection, so a repeated query skips the parse/plan round trip
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 500))
+
+# Log every statement (debugging only)
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() == "true"
+
+database_url = make_url(DATABASE_URL)
+if database_url.drivername == "postgresql+asyncpg":
+    database_url = database_url.update_query_dict({"prepared_statement_cache_size": str(DB_STATEMENT_CACHE_SIZE)})
+
+engine = create_async_engine(
+    database_url,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=True,
+    echo=DB_ECHO,
+)
 SessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 Base = declarative_base()
 
-# Redis setup
+# Redis setup (blocking clients for offline scripts; the app uses redis_pool)
 redis_email = redis.Redis(host='redis', port=6379, db=0)
 redis_username = redis.Redis(host='redis', port=6379, db=1)
 
@@ -41,6 +70,16 @@ async def get_db():
     async with SessionLocal() as session:
         yield session
 
+def pool_status() -> dict:
+    pool = engine.pool
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "max_overflow": DB_MAX_OVERFLOW,
+    }
+
 async def init_models():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
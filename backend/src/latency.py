@@ -0,0 +1,62 @@
+import bisect
+import os
+from typing import Optional, Sequence
+
+# Upper bounds of the latency buckets, in milliseconds
+LATENCY_BUCKETS_MS = tuple(
+    float(bound) for bound in os.getenv("LATENCY_BUCKETS_MS", "1,2,5,10,25,50,100,250,500,1000,2500,5000").split(",")
+)
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram with count, sum and max, exposed on /metrics/*"""
+
+    def __init__(self, name: str, buckets: Sequence[float] = LATENCY_BUCKETS_MS):
+        self.name = name
+        self.buckets = tuple(sorted(buckets))
+        # One extra slot for observations above the largest bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, seconds: float):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-th observation (None if empty or above every bound)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self) -> dict:
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets[f"le_{bound:g}ms"] = cumulative
+        buckets["le_inf"] = self.count
+        return {
+            "name": self.name,
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+
+# Time from a /ws connection arriving to its lobby snapshot being queued
+ws_connect_latency = LatencyHistogram("ws_connect")
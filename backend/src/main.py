@@ -17,7 +17,7 @@ from models import UserData, BattleModel
 from init import engine, Base
 from sqlalchemy import text
 from datetime import datetime
-import redis
+from redis_pool import redis_pool
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 import asyncio
 from websocket import chat_websocket_endpoint
@@ -71,8 +71,7 @@ async def health_check():
             await conn.execute(text("SELECT 1"))
         
         # Check Redis connection
-        redis_client = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"))
-        redis_client.ping()
+        await redis_pool.client().ping()
         
         # Check Google API key
         google_api_key = os.getenv("GOOGLE_API_KEY")
@@ -97,6 +96,30 @@ async def cors_test():
     """Simple CORS test endpoint"""
     return {"message": "CORS is working", "timestamp": datetime.now().isoformat()}
 
+@app.get("/metrics/connections")
+async def connection_metrics():
+    """Outbound send queue depth and slow-consumer drop/eviction counters"""
+    from outbound import send_queue_metrics
+    return send_queue_metrics.snapshot()
+
+@app.get("/metrics/ws-connect")
+async def ws_connect_metrics():
+    """Latency histogram of the /ws connect handshake"""
+    from latency import ws_connect_latency
+    return ws_connect_latency.snapshot()
+
+@app.get("/metrics/user-cache")
+async def user_cache_metrics():
+    """In-process user cache size, hit ratio, evictions and invalidations"""
+    from user_cache import user_cache
+    return user_cache.metrics()
+
+@app.get("/metrics/db-pool")
+async def db_pool_metrics():
+    """Connections the shared database pool holds, lends out and overflows"""
+    from init import pool_status
+    return pool_status()
+
 app.include_router(auth_router,prefix="/auth",tags=["auth"])
 app.include_router(db_router)
 app.include_router(router_friend, prefix="/api", tags=["friends"])
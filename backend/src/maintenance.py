@@ -0,0 +1,266 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+from redis_pool import redis_pool
+
+logger = logging.getLogger(__name__)
+
+# Rows handled per chunk: one transaction and one cache pipeline each
+MAINTENANCE_CHUNK_SIZE = int(os.getenv("MAINTENANCE_CHUNK_SIZE", 500))
+
+# A running job refreshes its lock on every checkpoint; a dead worker's lock lapses after this (seconds)
+MAINTENANCE_LOCK_SECONDS = int(os.getenv("MAINTENANCE_LOCK_SECONDS", 300))
+
+# How long job records are kept for the status endpoint (seconds)
+MAINTENANCE_JOB_TTL = int(os.getenv("MAINTENANCE_JOB_TTL", 7 * 24 * 3600))
+
+# Sorted set of job id -> creation time, newest last
+MAINTENANCE_JOBS_KEY = "maintenance:jobs"
+MAINTENANCE_JOBS_KEPT = 100
+
+# States a job can be resumed from
+RESUMABLE_STATES = ("failed", "interrupted")
+
+
+def _job_key(job_id: str) -> str:
+    return f"maintenance:job:{job_id}"
+
+
+def _lock_key(name: str, params: dict) -> str:
+    return f"maintenance:lock:{name}:{json.dumps(params, sort_keys=True)}"
+
+
+class MaintenanceJob:
+    """
+    Progress of one run of a bulk job, checkpointed to Redis after every
+    chunk so any worker can report it and a failed or interrupted run can
+    resume from its last cursor.
+
+    A job runs as a sequence of named phases. phase() returns False for a
+    phase already finished by an earlier attempt; a phase that was cut
+    short keeps its cursor, so its loop continues after the last chunk
+    that was committed.
+    """
+
+    def __init__(self, name: str, params: Optional[dict] = None, job_id: Optional[str] = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.name = name
+        self.params = params or {}
+        self.state = "queued"
+        self.phase_name: Optional[str] = None
+        self.done_phases: List[str] = []
+        self.total: Optional[int] = None
+        self.processed = 0
+        self.cursor: Optional[str] = None
+        self.errors: List[str] = []
+        self.result = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.rate: Optional[float] = None
+        self._rate_since = (time.time(), 0)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "MaintenanceJob":
+        job = cls(data["name"], data.get("params"), data["id"])
+        for field in ("state", "done_phases", "total", "processed", "cursor", "errors",
+                      "result", "created_at", "started_at", "finished_at"):
+            setattr(job, field, data.get(field, getattr(job, field)))
+        job.phase_name = data.get("phase")
+        return job
+
+    async def phase(self, name: str, total: Optional[int] = None) -> bool:
+        """Enter a phase; False if an earlier attempt already finished it"""
+        if name in self.done_phases:
+            return False
+        if self.phase_name != name:
+            if self.phase_name is not None:
+                self.done_phases.append(self.phase_name)
+            self.phase_name = name
+            self.processed = 0
+            self.cursor = None
+        self.total = total
+        self._rate_since = (time.time(), self.processed)
+        self.rate = None
+        await self.save()
+        return True
+
+    async def advance(self, count: int, cursor: Optional[str] = None):
+        """Record a committed chunk; resuming starts after cursor"""
+        self.processed += count
+        if cursor is not None:
+            self.cursor = cursor
+        since, processed_since = self._rate_since
+        elapsed = time.time() - since
+        if elapsed > 0:
+            self.rate = (self.processed - processed_since) / elapsed
+        await self.save()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "params": self.params,
+            "state": self.state,
+            "phase": self.phase_name,
+            "done_phases": self.done_phases,
+            "total": self.total,
+            "processed": self.processed,
+            "cursor": self.cursor,
+            "rate_per_second": round(self.rate, 3) if self.rate else None,
+            "errors": self.errors[-20:],
+            "result": self.result,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "updated_at": time.time(),
+        }
+
+    async def save(self):
+        client = redis_pool.client()
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.set(_job_key(self.id), json.dumps(self.to_dict()), ex=MAINTENANCE_JOB_TTL)
+            pipe.zadd(MAINTENANCE_JOBS_KEY, {self.id: self.created_at})
+            pipe.zremrangebyrank(MAINTENANCE_JOBS_KEY, 0, -MAINTENANCE_JOBS_KEPT - 1)
+            if self.state == "running":
+                pipe.expire(_lock_key(self.name, self.params), MAINTENANCE_LOCK_SECONDS)
+            await pipe.execute()
+
+
+def with_eta(data: dict) -> dict:
+    """A stored job record plus percent done and the seconds left at its last measured rate"""
+    total, processed, rate = data.get("total"), data.get("processed", 0), data.get("rate_per_second")
+    data["percent"] = round(100 * processed / total, 1) if total else None
+    data["eta_seconds"] = None
+    if data.get("state") == "running" and total is not None and rate:
+        since_update = time.time() - data.get("updated_at", time.time())
+        data["eta_seconds"] = round(max(0.0, (total - processed) / rate - since_update), 1)
+    return data
+
+
+class MaintenanceRunner:
+    """
+    In-process runner for bulk maintenance jobs.
+
+    Each job runs as its own task on the worker that started it, so the
+    request that starts it returns at once. A Redis lock per job name and
+    params keeps a second worker from running the same job concurrently;
+    starting a job that is already running returns the running one.
+    """
+
+    def __init__(self):
+        self._handlers: Dict[str, Callable[..., Awaitable]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def job(self, name: str):
+        """Register `async def handler(job, **params)` under name"""
+        def register(handler):
+            self._handlers[name] = handler
+            return handler
+        return register
+
+    async def start(self, name: str, **params) -> dict:
+        job = MaintenanceJob(name, params)
+        running = await self._acquire(job)
+        if running is not None:
+            return running
+        self._spawn(job)
+        return with_eta(job.to_dict())
+
+    async def resume(self, job_id: str) -> Optional[dict]:
+        data = await self.status(job_id)
+        if data is None:
+            return None
+        if data["state"] not in RESUMABLE_STATES and not (data["state"] == "running" and job_id not in self._tasks):
+            return data
+        job = MaintenanceJob.from_dict(data)
+        running = await self._acquire(job)
+        if running is not None:
+            return running
+        self._spawn(job)
+        return with_eta(job.to_dict())
+
+    async def run_inline(self, name: str, **params) -> dict:
+        """Run a job to completion in the caller (Celery, scripts)"""
+        job = MaintenanceJob(name, params)
+        running = await self._acquire(job)
+        if running is not None:
+            return running
+        await self._run(job)
+        return with_eta(job.to_dict())
+
+    async def status(self, job_id: str) -> Optional[dict]:
+        raw = await redis_pool.client().get(_job_key(job_id))
+        return with_eta(json.loads(raw)) if raw else None
+
+    async def recent(self, limit: int = 20) -> List[dict]:
+        client = redis_pool.client()
+        job_ids = await client.zrevrange(MAINTENANCE_JOBS_KEY, 0, limit - 1)
+        if not job_ids:
+            return []
+        raws = await client.mget([_job_key(job_id) for job_id in job_ids])
+        return [with_eta(json.loads(raw)) for raw in raws if raw]
+
+    async def shutdown(self):
+        """Cancel running jobs; they are left 'interrupted' and can be resumed"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _acquire(self, job: MaintenanceJob) -> Optional[dict]:
+        """Take the job's lock; the running job's record if someone else holds it"""
+        if job.name not in self._handlers:
+            raise ValueError(f"Unknown maintenance job: {job.name}")
+        client = redis_pool.client()
+        lock = _lock_key(job.name, job.params)
+        if await client.set(lock, job.id, nx=True, ex=MAINTENANCE_LOCK_SECONDS):
+            return None
+        holder = await client.get(lock)
+        running = await self.status(holder) if holder else None
+        return running or {"id": holder, "name": job.name, "params": job.params, "state": "running"}
+
+    def _spawn(self, job: MaintenanceJob):
+        self._tasks[job.id] = asyncio.get_event_loop().create_task(self._run(job))
+
+    async def _run(self, job: MaintenanceJob):
+        job.state = "running"
+        job.started_at = job.started_at or time.time()
+        job.finished_at = None
+        logger.info(f"[MAINTENANCE] Starting {job.name} {job.params} as job {job.id}")
+        try:
+            await job.save()
+            job.result = await self._handlers[job.name](job, **job.params)
+            if job.phase_name is not None:
+                job.done_phases.append(job.phase_name)
+                job.phase_name = None
+            job.state = "completed"
+            logger.info(f"[MAINTENANCE] Job {job.id} ({job.name}) completed: {job.result}")
+        except asyncio.CancelledError:
+            job.state = "interrupted"
+            logger.warning(f"[MAINTENANCE] Job {job.id} ({job.name}) interrupted at {job.phase_name} after {job.cursor}")
+            raise
+        except Exception as e:
+            job.state = "failed"
+            job.errors.append(str(e))
+            logger.error(f"[MAINTENANCE] Job {job.id} ({job.name}) failed: {str(e)}")
+        finally:
+            job.finished_at = time.time()
+            self._tasks.pop(job.id, None)
+            try:
+                await job.save()
+                client = redis_pool.client()
+                lock = _lock_key(job.name, job.params)
+                if await client.get(lock) == job.id:
+                    await client.delete(lock)
+            except Exception as e:
+                logger.error(f"[MAINTENANCE] Error recording the end of job {job.id}: {str(e)}")
+
+
+# Global runner instance
+maintenance = MaintenanceRunner()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ARRAY, DateTime, Boolean, Text, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, ARRAY, DateTime, Boolean, Text, ForeignKey, JSON, Index, func
 from sqlalchemy.orm import relationship
 from pydantic import BaseModel, EmailStr
 from init import Base
@@ -17,11 +17,57 @@ class UserData(Base):
     favourite = Column(String, index=True,nullable=False)
     streak = Column(Integer, index=True,nullable=False)
     password = Column(String, index=True,nullable=False)
-    friends = Column(ARRAY(String), index=True,nullable=True)
-    friendRequests = Column(ARRAY(String), index=True,nullable=True)
     avatar = Column(String, nullable=True)  
-    battles = Column(ARRAY(String), index=True,nullable=True)
-    invitations = Column(ARRAY(String), index=True,nullable=True)
+    battles = Column(ARRAY(String), nullable=True)
+
+    # Case-insensitive username lookups (reconnects with a differently cased name)
+    __table_args__ = (
+        Index("ix_user_data_username_lower", func.lower(username)),
+    )
+
+class UsernameHistory(Base):
+    """A username someone has renamed away from, so a client still using it can be resolved"""
+    __tablename__ = "username_history"
+    old_username = Column(String, primary_key=True)
+    email = Column(String, ForeignKey("user_data.email", ondelete="CASCADE", onupdate="CASCADE"), nullable=False, index=True)
+    renamed_at = Column(DateTime, default=datetime.utcnow, server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_username_history_old_username_lower", func.lower(old_username)),
+    )
+
+class Friendship(Base):
+    """One row per direction, so a user's friends are a range of the primary key"""
+    __tablename__ = "friendships"
+    user_email = Column(String, ForeignKey("user_data.email", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    friend_email = Column(String, ForeignKey("user_data.email", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    created_at = Column(DateTime, default=datetime.utcnow, server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_friendships_friend_email", "friend_email"),
+    )
+
+class FriendRequest(Base):
+    """A pending request from from_email, listed in to_email's friendRequests"""
+    __tablename__ = "friend_requests"
+    to_email = Column(String, ForeignKey("user_data.email", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    from_email = Column(String, ForeignKey("user_data.email", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    created_at = Column(DateTime, default=datetime.utcnow, server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_friend_requests_from_email", "from_email"),
+    )
+
+class BattleInvitation(Base):
+    """A battle id listed in the invited user's invitations"""
+    __tablename__ = "battle_invitations"
+    email = Column(String, ForeignKey("user_data.email", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    battle_id = Column(String, primary_key=True)
+    created_at = Column(DateTime, default=datetime.utcnow, server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_battle_invitations_battle_id", "battle_id"),
+    )
 
 class UserDataCreate(BaseModel):
     username: str
@@ -48,6 +94,13 @@ class BattleModel(Base):
     second_opponent = Column(String, index=True)
     first_opponent_score = Column(Integer, index=True)
     second_opponent_score = Column(Integer, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow, server_default=func.now(), nullable=False)
+
+    # Per-opponent history in (created_at, id) order, used by the keyset-paginated history endpoints
+    __table_args__ = (
+        Index("ix_battles_first_opponent_created_at", "first_opponent", "created_at", "id"),
+        Index("ix_battles_second_opponent_created_at", "second_opponent", "created_at", "id"),
+    )
 
     def to_json(self):
         return {
@@ -57,7 +110,8 @@ class BattleModel(Base):
             "first_opponent": self.first_opponent,
             "second_opponent": self.second_opponent,
             "first_opponent_score": self.first_opponent_score,
-            "second_opponent_score": self.second_opponent_score
+            "second_opponent_score": self.second_opponent_score,
+            "created_at": self.created_at.isoformat() if self.created_at else None
         }
 
 class UserAnswer(Base):
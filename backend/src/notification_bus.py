@@ -0,0 +1,141 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Callable, Iterable, Optional
+from config import WORKER_ID
+from redis_pool import redis_pool
+
+logger = logging.getLogger(__name__)
+
+# "local" delivers only to sockets in this process; "redis" fans out across workers
+NOTIFICATION_BUS_BACKEND = os.getenv("NOTIFICATION_BUS_BACKEND", "local")
+
+# Topic every lobby connection belongs to (battle_created, battle_removed, battle_joined, ...)
+LOBBY_TOPIC = "lobby"
+
+# How long a publisher waits for the bus subscription before giving up (seconds)
+BUS_READY_TIMEOUT = 5
+
+
+def user_channel(username: str) -> str:
+    return f"notify:user:{username}"
+
+
+def topic_channel(topic: str) -> str:
+    return f"notify:topic:{topic}"
+
+
+class NotificationBus:
+    """
+    Pub/sub delivery layer behind ConnectionManager.
+
+    Each worker subscribes to the per-user channel of every user whose
+    socket it holds, plus the topic channels it serves, and delivers what
+    arrives to its local sockets. A message for a single user is therefore
+    only seen by the worker holding that user, and a topic broadcast is
+    delivered locally first and published once for the other workers.
+    """
+
+    def __init__(self, deliver: Callable, local_users: Callable, topics: Iterable[str] = (LOBBY_TOPIC,)):
+        self._deliver = deliver
+        self._local_users = local_users
+        self._topics = tuple(topics)
+        self._client = None
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+        self._ready: Optional[asyncio.Event] = None
+
+    async def _ensure_running(self):
+        if self._client is None:
+            self._client = redis_pool.client()
+        if self._ready is None:
+            self._ready = asyncio.Event()
+        if self._listener is None or self._listener.done():
+            self._ready.clear()
+            self._listener = asyncio.get_event_loop().create_task(self._listen())
+        try:
+            await asyncio.wait_for(self._ready.wait(), BUS_READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ConnectionError("notification bus is not subscribed yet")
+
+    async def subscribe_user(self, username: str):
+        try:
+            await self._ensure_running()
+            await self._pubsub.subscribe(user_channel(username))
+        except Exception as e:
+            logger.error(f"[NOTIFY_BUS] Error subscribing for {username}: {str(e)}")
+
+    async def unsubscribe_user(self, username: str):
+        if self._pubsub is None:
+            return
+        try:
+            await self._pubsub.unsubscribe(user_channel(username))
+        except Exception as e:
+            logger.error(f"[NOTIFY_BUS] Error unsubscribing for {username}: {str(e)}")
+
+    async def publish_to_user(self, username: str, message: str) -> int:
+        """Publish to the worker holding this user; returns the number of subscribers reached"""
+        await self._ensure_running()
+        return await self._client.publish(user_channel(username), json.dumps({"origin": WORKER_ID, "frame": message}))
+
+    async def publish_to_topic(self, topic: str, message: str, exclude: Iterable[str] = ()):
+        await self._ensure_running()
+        await self._client.publish(topic_channel(topic), json.dumps({
+            "origin": WORKER_ID,
+            "frame": message,
+            "exclude": list(exclude),
+        }))
+
+    async def _listen(self):
+        while True:
+            self._pubsub = self._client.pubsub()
+            try:
+                # Resubscribe after a reconnect so no local user goes deaf
+                await self._pubsub.subscribe(
+                    *[topic_channel(t) for t in self._topics],
+                    *[user_channel(u) for u in self._local_users()]
+                )
+                self._ready.set()
+                async for message in self._pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    await self._dispatch(message["channel"], message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[NOTIFY_BUS] Subscription error, reconnecting: {str(e)}")
+                self._ready.clear()
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await self._pubsub.aclose()
+                except Exception:
+                    pass
+
+    async def _dispatch(self, channel: str, data: str):
+        try:
+            payload = json.loads(data)
+        except (ValueError, TypeError):
+            return
+        frame = payload.get("frame")
+        if frame is None:
+            return
+        if channel.startswith("notify:user:"):
+            await self._deliver(channel[len("notify:user:"):], frame)
+        elif payload.get("origin") != WORKER_ID:
+            exclude = set(payload.get("exclude") or ())
+            for username in list(self._local_users()):
+                if username not in exclude:
+                    await self._deliver(username, frame)
+
+    async def shutdown(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        # The pooled client itself is closed with the pool
+        self._client = None
@@ -0,0 +1,154 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# Frames a single connection may have waiting before the slow-consumer policy applies
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "256"))
+
+# "degrade" drops the oldest queued frame (evicting after SLOW_CONSUMER_MAX_DROPS drops);
+# "evict" closes the connection as soon as its queue overflows
+SLOW_CONSUMER_POLICY = os.getenv("SLOW_CONSUMER_POLICY", "degrade")
+
+# Drops tolerated under the "degrade" policy before the connection is closed anyway
+SLOW_CONSUMER_MAX_DROPS = int(os.getenv("SLOW_CONSUMER_MAX_DROPS", "64"))
+
+# Close code sent to evicted clients ("try again later")
+EVICTION_CLOSE_CODE = 1013
+
+
+def encode_frame(payload: Union[str, dict]) -> str:
+    """Serialize a payload once; an already encoded frame is returned unchanged"""
+    if isinstance(payload, str):
+        return payload
+    return json.dumps(payload)
+
+
+class SendQueueMetrics:
+    """Process-wide counters for outbound queues, exposed on /metrics/connections"""
+
+    def __init__(self):
+        self.queues = set()
+        self.enqueued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.evicted = 0
+        self.send_errors = 0
+
+    def snapshot(self) -> dict:
+        depths = [q.depth for q in self.queues]
+        return {
+            "connections": len(depths),
+            "queue_depth_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "queue_capacity": SEND_QUEUE_SIZE,
+            "policy": SLOW_CONSUMER_POLICY,
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "evicted": self.evicted,
+            "send_errors": self.send_errors,
+            "slowest": sorted(
+                ({"connection": q.label, "depth": q.depth, "drops": q.drops} for q in self.queues if q.depth),
+                key=lambda item: item["depth"],
+                reverse=True
+            )[:10],
+        }
+
+
+send_queue_metrics = SendQueueMetrics()
+
+
+class OutboundQueue:
+    """
+    Bounded outbound queue for one websocket, drained by its own writer task.
+
+    send_text() only enqueues, so a broadcast never waits on a slow client
+    and one stalled socket cannot hold up delivery to everyone after it.
+    It has the same send_text() signature as a WebSocket so existing send
+    paths keep working unchanged.
+    """
+
+    __slots__ = ("label", "websocket", "queue", "task", "drops", "closed")
+
+    def __init__(self, label: str, websocket, maxsize: int = SEND_QUEUE_SIZE):
+        self.label = label
+        self.websocket = websocket
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.drops = 0
+        self.closed = False
+        self.task: Optional[asyncio.Task] = asyncio.get_event_loop().create_task(self._writer())
+        send_queue_metrics.queues.add(self)
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    async def send_text(self, message: str):
+        if not self.offer(message):
+            raise ConnectionError(f"connection {self.label} is closed")
+
+    def offer(self, message: str) -> bool:
+        """Enqueue without blocking; returns False once the connection is closed or evicted"""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(message)
+            send_queue_metrics.enqueued += 1
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        send_queue_metrics.dropped += 1
+        self.drops += 1
+        if SLOW_CONSUMER_POLICY == "evict" or self.drops > SLOW_CONSUMER_MAX_DROPS:
+            logger.warning(f"[OUTBOUND] Evicting slow consumer {self.label} (depth={self.depth}, drops={self.drops})")
+            self.evict()
+            return False
+
+        # Degrade: the oldest frame is the most likely to be stale already
+        self.queue.get_nowait()
+        self.queue.put_nowait(message)
+        send_queue_metrics.enqueued += 1
+        return True
+
+    async def _writer(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                await self.websocket.send_text(message)
+                send_queue_metrics.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            send_queue_metrics.send_errors += 1
+            logger.error(f"[OUTBOUND] Error sending to {self.label}: {str(e)}")
+            self._mark_closed()
+
+    def _mark_closed(self):
+        self.closed = True
+        send_queue_metrics.queues.discard(self)
+
+    def evict(self):
+        if self.closed:
+            return
+        send_queue_metrics.evicted += 1
+        self.close()
+        # Closing the socket ends the endpoint's receive loop, which runs the normal cleanup
+        asyncio.get_event_loop().create_task(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await self.websocket.close(code=EVICTION_CLOSE_CODE)
+        except Exception:
+            pass
+
+    def close(self):
+        """Stop the writer; frames still queued are discarded"""
+        self._mark_closed()
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.task = None
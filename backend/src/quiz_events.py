@@ -0,0 +1,139 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+import redis
+from redis_pool import redis_pool
+
+logger = logging.getLogger(__name__)
+
+# Channel the Celery workers publish on once a battle's quiz is cached
+QUIZ_READY_CHANNEL = "quiz_ready"
+
+# How long the web process waits for a quiz before falling back to local generation
+QUIZ_READY_TIMEOUT = float(os.getenv("QUIZ_READY_TIMEOUT", "30"))
+
+
+def questions_key(battle_id: str) -> str:
+    return f"battle_questions:{battle_id}"
+
+
+def publish_quiz_ready(battle_id: str, question_count: int, client: Optional[redis.Redis] = None):
+    """Announce that a battle's questions are cached (called from the Celery worker after setex)"""
+    try:
+        client = client or redis_pool.sync_client()
+        client.publish(QUIZ_READY_CHANNEL, json.dumps({"battle_id": battle_id, "count": question_count}))
+    except Exception as e:
+        # Waiters still pick the quiz up from the cache when their timeout check runs
+        logger.error(f"[QUIZ_EVENTS] Error publishing quiz_ready for battle {battle_id}: {str(e)}")
+
+
+class QuizReadyListener:
+    """
+    One pub/sub subscription per web process that resolves waiters by battle id.
+
+    wait_for_questions() registers a future before checking the cache, so a
+    quiz published between the check and the subscription is never missed:
+    either the cache read sees it or the event resolves the future.
+    """
+
+    def __init__(self):
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._subscribed: Optional[asyncio.Event] = None
+
+    def _ensure_running(self):
+        if self._subscribed is None:
+            self._subscribed = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._subscribed.clear()
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            pubsub = redis_pool.client().pubsub()
+            try:
+                await pubsub.subscribe(QUIZ_READY_CHANNEL)
+                self._subscribed.set()
+                logger.info(f"[QUIZ_EVENTS] Subscribed to {QUIZ_READY_CHANNEL}")
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    try:
+                        battle_id = json.loads(message["data"]).get("battle_id")
+                    except (ValueError, TypeError):
+                        continue
+                    self._resolve(battle_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[QUIZ_EVENTS] Subscription error, reconnecting: {str(e)}")
+                self._subscribed.clear()
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    def _resolve(self, battle_id: str):
+        for future in self._waiters.pop(battle_id, ()):
+            if not future.done():
+                future.set_result(True)
+
+    async def _load(self, battle_id: str):
+        cached = await redis_pool.client().get(questions_key(battle_id))
+        if not cached:
+            return None
+        try:
+            return json.loads(cached)
+        except json.JSONDecodeError:
+            logger.error(f"[QUIZ_EVENTS] Failed to decode cached questions for battle {battle_id}")
+            return None
+
+    async def wait_for_questions(self, battle_id: str, timeout: float = QUIZ_READY_TIMEOUT):
+        """Return the battle's cached questions as soon as they are published, or None on timeout"""
+        self._ensure_running()
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        future = loop.create_future()
+        self._waiters.setdefault(battle_id, []).append(future)
+        try:
+            try:
+                await asyncio.wait_for(self._subscribed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+            questions = await self._load(battle_id)
+            if questions:
+                return questions
+
+            try:
+                await asyncio.wait_for(future, max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                # Last look in case the event was lost while reconnecting
+                return await self._load(battle_id)
+            return await self._load(battle_id)
+        except Exception as e:
+            logger.error(f"[QUIZ_EVENTS] Error waiting for questions for battle {battle_id}: {str(e)}")
+            return None
+        finally:
+            waiters = self._waiters.get(battle_id)
+            if waiters and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._waiters[battle_id]
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Global listener instance for the web process
+quiz_ready_listener = QuizReadyListener()
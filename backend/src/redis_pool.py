@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+from typing import Dict, Iterable, List, Optional
+import redis
+import redis.asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+
+# Connections one process may hold open (each pub/sub listener keeps one for itself)
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
+
+# How long a command waits for a free pooled connection before failing (seconds)
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+
+# Connect timeout; no read timeout, since pub/sub listeners block on reads by design
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "5"))
+
+
+class RedisPool:
+    """
+    The process-wide Redis connection pools.
+
+    Every module takes its client from here instead of opening its own, so
+    a request borrows an already open connection and never blocks the event
+    loop. There is one pool for clients that decode replies to str and one
+    for clients that return bytes; both are created on first use.
+    """
+
+    def __init__(self, url: str = REDIS_URL, max_connections: int = REDIS_MAX_CONNECTIONS):
+        self.url = url
+        self.max_connections = max_connections
+        self._clients: Dict[bool, aioredis.Redis] = {}
+        self._sync: Optional[redis.Redis] = None
+
+    def client(self, decode_responses: bool = True) -> aioredis.Redis:
+        client = self._clients.get(decode_responses)
+        if client is None:
+            pool = aioredis.BlockingConnectionPool.from_url(
+                self.url,
+                max_connections=self.max_connections,
+                timeout=REDIS_POOL_TIMEOUT,
+                socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+                health_check_interval=30,
+                decode_responses=decode_responses,
+            )
+            client = aioredis.Redis(connection_pool=pool)
+            self._clients[decode_responses] = client
+        return client
+
+    def sync_client(self) -> redis.Redis:
+        """Pooled blocking client for code without an event loop (Celery tasks, scripts)"""
+        if self._sync is None:
+            self._sync = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+                self.url,
+                max_connections=self.max_connections,
+                timeout=REDIS_POOL_TIMEOUT,
+                socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+            ))
+        return self._sync
+
+    async def get_json(self, key: str):
+        """A JSON value, or None when the key is missing or not valid JSON"""
+        return _loads(await self.client().get(key), key)
+
+    async def mget_json(self, keys: Iterable[str]) -> List:
+        keys = list(keys)
+        if not keys:
+            return []
+        return [_loads(raw, key) for key, raw in zip(keys, await self.client().mget(keys))]
+
+    async def set_json(self, key: str, value, ex: Optional[int] = None):
+        await self.client().set(key, json.dumps(value), ex=ex)
+
+    def pipeline(self, transaction: bool = False):
+        """`async with redis_pool.pipeline() as pipe:` queue commands, then `await pipe.execute()`"""
+        return self.client().pipeline(transaction=transaction)
+
+    async def close(self):
+        for client in self._clients.values():
+            try:
+                await client.aclose()
+                await client.connection_pool.disconnect()
+            except Exception as e:
+                logger.error(f"[REDIS] Error closing connection pool: {str(e)}")
+        self._clients.clear()
+        if self._sync is not None:
+            self._sync.close()
+            self._sync = None
+
+
+def _loads(raw, key: str):
+    if not raw:
+        return None
+    try:
+        return json.loads(raw)
+    except (ValueError, TypeError):
+        logger.error(f"[REDIS] Non-JSON value under {key}")
+        return None
+
+
+# Global pool instance
+redis_pool = RedisPool()
+
+
+async def get_redis() -> aioredis.Redis:
+    """FastAPI dependency: the shared decoded client"""
+    return redis_pool.client()
@@ -0,0 +1,175 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class _Deadline:
+    __slots__ = ("when", "seq", "key", "group", "callback", "args", "active")
+
+    def __init__(self, when: float, seq: int, key: Hashable, group: Optional[Hashable], callback: Callable, args: tuple):
+        self.when = when
+        self.seq = seq
+        self.key = key
+        self.group = group
+        self.callback = callback
+        self.args = args
+        self.active = True
+
+    def __lt__(self, other: "_Deadline") -> bool:
+        return (self.when, self.seq) < (other.when, other.seq)
+
+
+class DeadlineScheduler:
+    """
+    Per-process timer service backed by a binary heap of deadlines.
+
+    One background task sleeps until the earliest deadline and fires every
+    entry that is due, so thousands of battles cost one sleeping task instead
+    of one per timer, and nothing scans all battles on an interval.
+
+    Entries are keyed: scheduling a key that already exists replaces it, and
+    cancel() marks the entry dead in O(1) (it is dropped when it reaches the
+    top of the heap). Entries can also belong to a group, e.g. a battle id,
+    so a whole battle's timers can be cancelled together at teardown.
+    """
+
+    # Rebuild the heap once dead entries make up more than this share of it
+    COMPACT_RATIO = 0.5
+
+    def __init__(self):
+        self._heap: List[_Deadline] = []
+        self._entries: Dict[Hashable, _Deadline] = {}
+        self._groups: Dict[Hashable, Set[Hashable]] = {}
+        self._counter = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def schedule(self, key: Hashable, delay: float, callback: Callable, *args: Any, group: Optional[Hashable] = None):
+        """Run callback(*args) after delay seconds, replacing any pending entry with the same key"""
+        self.cancel(key)
+        loop = asyncio.get_event_loop()
+        entry = _Deadline(loop.time() + delay, next(self._counter), key, group, callback, args)
+        heapq.heappush(self._heap, entry)
+        self._entries[key] = entry
+        if group is not None:
+            self._groups.setdefault(group, set()).add(key)
+
+        self._ensure_running()
+        if self._heap[0] is entry:
+            self._wakeup.set()
+        return entry
+
+    def cancel(self, key: Hashable) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        entry.active = False
+        self._forget_group_key(entry)
+        self._maybe_compact()
+        return True
+
+    def cancel_group(self, group: Hashable) -> int:
+        keys = self._groups.pop(group, None)
+        if not keys:
+            return 0
+        for key in keys:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                entry.active = False
+        self._maybe_compact()
+        return len(keys)
+
+    def is_scheduled(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def _forget_group_key(self, entry: _Deadline):
+        if entry.group is None:
+            return
+        keys = self._groups.get(entry.group)
+        if keys is not None:
+            keys.discard(entry.key)
+            if not keys:
+                del self._groups[entry.group]
+
+    def _maybe_compact(self):
+        if len(self._heap) > 64 and len(self._entries) < len(self._heap) * self.COMPACT_RATIO:
+            self._heap = [entry for entry in self._heap if entry.active]
+            heapq.heapify(self._heap)
+
+    def _ensure_running(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                while self._heap and not self._heap[0].active:
+                    heapq.heappop(self._heap)
+
+                self._wakeup.clear()
+                if not self._heap:
+                    await self._wakeup.wait()
+                    continue
+
+                timeout = self._heap[0].when - loop.time()
+                if timeout > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                now = loop.time()
+                while self._heap and self._heap[0].when <= now:
+                    entry = heapq.heappop(self._heap)
+                    if not entry.active:
+                        continue
+                    entry.active = False
+                    if self._entries.get(entry.key) is entry:
+                        del self._entries[entry.key]
+                        self._forget_group_key(entry)
+                    self._fire(entry)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[SCHEDULER] Error in scheduler loop: {str(e)}")
+
+    def _fire(self, entry: _Deadline):
+        try:
+            result = entry.callback(*entry.args)
+            if asyncio.iscoroutine(result):
+                asyncio.get_event_loop().create_task(self._guard(entry.key, result))
+        except Exception as e:
+            logger.error(f"[SCHEDULER] Error firing deadline {entry.key}: {str(e)}")
+
+    async def _guard(self, key: Hashable, coro):
+        try:
+            await coro
+        except Exception as e:
+            logger.error(f"[SCHEDULER] Error in deadline {key}: {str(e)}")
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._heap.clear()
+        self._entries.clear()
+        self._groups.clear()
+
+
+# Global scheduler instance shared by the lobby and battle websockets
+scheduler = DeadlineScheduler()
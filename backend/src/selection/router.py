@@ -9,7 +9,8 @@ import json
 import jwt
 import logging
 
-from init import get_db, redis_email
+from init import get_db
+from user_cache import user_cache
 from models import (
     DebatePick, DebateComment, DebateVote, CommentLike,
     DebatePickCreate, DebatePickResponse, DebateCommentCreate, 
@@ -57,12 +58,11 @@ async def get_current_user(authorization: str = Header(None)):
         if not email:
             raise HTTPException(status_code=401, detail="Invalid token payload")
         
-        # Get user data from Redis
-        user_data = redis_email.get(email)
-        if not user_data:
+        # Get user data through the user cache
+        user_dict = await user_cache.get_by_email(email)
+        if not user_dict:
             raise HTTPException(status_code=401, detail="User not found")
         
-        user_dict = json.loads(user_data)
         return {
             "username": user_dict["username"],
             "email": user_dict["email"],
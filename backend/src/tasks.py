@@ -77,15 +77,19 @@ def save_questions_to_battle(battle_id: str, questions: list):
     Save questions to Redis cache for a battle
     """
     try:
-        import redis
-        redis_client = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"))
-        questions_key = f"battle_questions:{battle_id}"
+        from redis_pool import redis_pool
+        from quiz_events import publish_quiz_ready, questions_key
+        # The worker has no running event loop, so it borrows from the process's blocking pool
+        redis_client = redis_pool.sync_client()
         
         # Save questions to Redis with expiration (1 hour)
-        redis_client.setex(questions_key, 3600, json.dumps(questions))
+        redis_client.setex(questions_key(battle_id), 3600, json.dumps(questions))
         
         logger.info(f"Successfully saved {len(questions)} questions to cache for battle {battle_id}")
         
+        # Wake the web process waiting on this battle's quiz
+        publish_quiz_ready(battle_id, len(questions), redis_client)
+        
     except Exception as e:
         logger.error(f"Error saving questions to cache for battle {battle_id}: {str(e)}")
         raise
@@ -98,6 +102,32 @@ def queue_quiz_generation_task(battle_id, sport, level, question_count):
     logger.info(f"Queued AI quiz generation task for battle {battle_id}")
     return task 
 
+@celery_app.task
+def repair_user_stats():
+    """Offline full rebuild of every user's battles, wins, streak and ranking from the battles table"""
+    return asyncio.run(_run_maintenance_job("repair_user_battles"))
+
+async def _run_maintenance_job(name: str, **params):
+    """
+    Run a maintenance job inside this task's asyncio.run loop, then drop every
+    pooled Redis and Postgres connection: they are bound to this loop, which
+    closes when the task returns, and the next run in this worker gets a new one
+    """
+    # Importing db.router registers the maintenance jobs; imported here to avoid circular import
+    import db.router
+    from maintenance import maintenance
+    from user_cache import user_cache
+    from battle.leaderboard import leaderboard
+    from redis_pool import redis_pool
+    from init import engine
+    try:
+        return await maintenance.run_inline(name, **params)
+    finally:
+        await user_cache.shutdown()
+        await leaderboard.shutdown()
+        await redis_pool.close()
+        await engine.dispose()
+
 @celery_app.task
 def create_daily_debates():
     """Create new debates every day at midnight UTC"""
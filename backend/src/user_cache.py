@@ -0,0 +1,594 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+import redis.asyncio as aioredis
+from redis.exceptions import WatchError
+from sqlalchemy import select
+from config import WORKER_ID
+from init import SessionLocal
+from models import UserData
+from redis_pool import redis_pool
+
+logger = logging.getLogger(__name__)
+
+# Records kept in each worker's in-process cache, and how long one may be served from it (seconds)
+USER_L1_SIZE = int(os.getenv("USER_L1_SIZE", "10000"))
+USER_L1_TTL = float(os.getenv("USER_L1_TTL", "30"))
+
+# Channel on which every user write is announced so other workers drop their copy
+USER_INVALIDATION_CHANNEL = "user_cache:invalidate"
+
+# Fields of the cached user record, in the order every router has always returned them
+USER_FIELDS = (
+    'username', 'email', 'totalBattle', 'winRate', 'ranking', 'winBattle', 'favourite',
+    'streak', 'password', 'friends', 'friendRequests', 'avatar', 'battles', 'invitations',
+)
+
+# Unbounded arrays are kept in their own Redis lists, outside the record hash
+USER_LIST_FIELDS = ('friends', 'friendRequests', 'battles', 'invitations')
+USER_HASH_FIELDS = tuple(field for field in USER_FIELDS if field not in USER_LIST_FIELDS)
+
+# Lists kept in their own tables (friends.relations); only loads and list edits write them
+USER_RELATION_FIELDS = ('friends', 'friendRequests', 'invitations')
+
+# Hash field set only on records written by a full load, relations included
+USER_LOADED_FIELD = "_loaded"
+
+# Stats a finished battle changes; written field by field, never as a whole record
+USER_STAT_FIELDS = ('totalBattle', 'winBattle', 'winRate', 'streak')
+
+# Counter handing out the stable ids records are stored under
+USER_ID_COUNTER = "user:next_id"
+
+
+def user_to_dict(user, relations: Optional[dict] = None) -> dict:
+    """
+    The cached user record for a UserData model, a result row or a UserDataCreate.
+
+    Models and rows do not carry the relation lists; pass them as `relations`
+    (see friends.relations.user_record), otherwise those fields are None.
+    """
+    record = {}
+    for field in USER_FIELDS:
+        if field in USER_RELATION_FIELDS and relations is not None:
+            record[field] = list(relations.get(field) or [])
+        else:
+            record[field] = getattr(user, field, None)
+    return record
+
+
+def _version_key(kind: str, value: str) -> str:
+    return f"user:version:{kind}:{value}"
+
+
+def _pointer_key(kind: str, value: str) -> str:
+    return f"user:id:{kind}:{value}"
+
+
+def _record_key(user_id) -> str:
+    return f"user:{_text(user_id)}"
+
+
+def _list_key(user_id, field: str) -> str:
+    return f"user:{_text(user_id)}:{field}"
+
+
+def _text(value) -> str:
+    return value.decode('utf-8') if isinstance(value, bytes) else str(value)
+
+
+def _copy_record(user: dict) -> dict:
+    """Callers mutate the records they get back, so the in-process cache never hands out its own"""
+    return {key: list(value) if isinstance(value, list) else value for key, value in user.items()}
+
+
+# Resolve a pointer to a whole record: {id, [hash field, value, ...], list, list, ...}
+_READ_RECORD = """
+local id = redis.call('GET', KEYS[1])
+if not id then return false end
+local base = 'user:' .. id
+local fields = redis.call('HGETALL', base)
+if #fields == 0 then return false end
+local reply = {id, fields}
+for _, name in ipairs(ARGV) do
+    reply[#reply + 1] = redis.call('LRANGE', base .. ':' .. name, 0, -1)
+end
+return reply
+"""
+
+# The id stored under an email pointer, allocating one on first sight
+_ID_FOR_EMAIL = """
+local id = redis.call('GET', KEYS[1])
+if id then return id end
+id = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], id)
+return id
+"""
+
+# Patch a cached record in place; records that are not cached are left alone.
+# ARGV: number of hash fields, field/value pairs, then (add|remove, list, value) triples.
+# Returns the username, or false.
+_PATCH_RECORD = """
+local id = redis.call('GET', KEYS[1])
+if not id then return false end
+local base = 'user:' .. id
+local username = redis.call('HGET', base, 'username')
+if not username then return false end
+local fields = tonumber(ARGV[1])
+for i = 2, 2 * fields, 2 do
+    redis.call('HSET', base, ARGV[i], ARGV[i + 1])
+end
+for i = 2 * fields + 2, #ARGV, 3 do
+    local list = base .. ':' .. ARGV[i + 1]
+    if ARGV[i] == 'add' then
+        if not redis.call('LPOS', list, ARGV[i + 2]) then
+            redis.call('RPUSH', list, ARGV[i + 2])
+        end
+    else
+        redis.call('LREM', list, 0, ARGV[i + 2])
+    end
+end
+username = cjson.decode(username)
+redis.call('INCR', KEYS[2])
+redis.call('INCR', 'user:version:username:' .. username)
+return username
+"""
+
+
+class LocalUserCache:
+    """Bounded LRU of user records with a TTL, keyed by ("username", u) and ("email", e)"""
+
+    def __init__(self, maxsize: int = USER_L1_SIZE, ttl: float = USER_L1_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: tuple) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return _copy_record(entry[1])
+
+    def set(self, user: dict):
+        entry = (time.monotonic() + self.ttl, _copy_record(user))
+        for key in (("username", user['username']), ("email", user['email'])):
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, email: Optional[str] = None, username: Optional[str] = None):
+        for key in (("email", email), ("username", username)):
+            if key[1] and self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "capacity": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class UserCache:
+    """
+    Read-through / write-through cache for user records.
+
+    Each user is stored once: a hash "user:{id}" of the
+    scalar fields plus one list per array field ("user:{id}:battles", ...),
+    under a stable id found through small username and email pointers.
+    Stat changes are HSETs of the changed fields, never a full rewrite,
+    and friends / requests / invitations are edited one entry at a time.
+
+    A miss loads from Postgres once per key however many requests ask
+    for it at the same time (single flight). Every write and invalidation
+    bumps a per-user version; a loader only stores what it read if the
+    version is unchanged, so a slow load can never overwrite newer data.
+
+    In front of Redis each worker keeps a small LRU/TTL copy (self.local).
+    Writes are announced on USER_INVALIDATION_CHANNEL and other workers
+    drop their copy; the local layer is only used while that subscription
+    is live, and is cleared whenever it reconnects.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self.local = LocalUserCache()
+        self._client: Optional[aioredis.Redis] = None
+        self._listener: Optional[asyncio.Task] = None
+        self._subscribed: Optional[asyncio.Event] = None
+        self._scripts = {}
+
+    def _redis(self) -> aioredis.Redis:
+        if self._client is None:
+            self._client = redis_pool.client()
+            self._scripts = {
+                "read": self._client.register_script(_READ_RECORD),
+                "id": self._client.register_script(_ID_FOR_EMAIL),
+                "patch": self._client.register_script(_PATCH_RECORD),
+            }
+        return self._client
+
+    async def get(self, username: str) -> Optional[dict]:
+        if not username:
+            return None
+        return await self._get(("username", username), UserData.username)
+
+    async def get_by_email(self, email: str) -> Optional[dict]:
+        if not email:
+            return None
+        return await self._get(("email", email), UserData.email)
+
+    async def _get(self, key: tuple, column) -> Optional[dict]:
+        use_local = self._local_ready()
+        if use_local:
+            user = self.local.get(key)
+            if user is not None:
+                return user
+        user = await self._read(key)
+        if user is None:
+            user = await self._single_flight(key, column, key[1])
+        if user is not None and use_local:
+            self.local.set(user)
+        return user
+
+    async def get_many(self, usernames: Iterable[str]) -> Dict[str, dict]:
+        """Users by username in one cache round trip; misses are loaded with a single query"""
+        usernames = list(dict.fromkeys(u for u in usernames if u))
+        if not usernames:
+            return {}
+        found = {}
+        use_local = self._local_ready()
+        if use_local:
+            for username in usernames:
+                user = self.local.get(("username", username))
+                if user is not None:
+                    found[username] = user
+        remote = [u for u in usernames if u not in found]
+        if remote:
+            async with self._redis().pipeline(transaction=False) as pipe:
+                for username in remote:
+                    await self._scripts["read"](keys=[_pointer_key("username", username)], args=USER_LIST_FIELDS, client=pipe)
+                replies = await pipe.execute()
+            for username, reply in zip(remote, replies):
+                user = self._decode(reply, ("username", username))
+                if user is not None:
+                    found[username] = user
+                    if use_local:
+                        self.local.set(user)
+        missing = [u for u in usernames if u not in found]
+        if missing:
+            versions = await self._redis().mget([_version_key("username", u) for u in missing])
+            from friends.relations import user_records
+            async with SessionLocal() as session:
+                result = await session.execute(select(UserData).where(UserData.username.in_(missing)))
+                records = await user_records(session, result.scalars().all())
+            observed = dict(zip(missing, versions))
+            for user in records:
+                await self._store_if_unchanged(user, "username", user['username'], observed.get(user['username']))
+                found[user['username']] = user
+                if use_local:
+                    self.local.set(user)
+        return found
+
+    async def peek(self, username: str) -> Optional[dict]:
+        """The cached record only; never loads from Postgres"""
+        return await self._read(("username", username))
+
+    async def cached_usernames(self, limit: Optional[int] = None) -> List[str]:
+        """Usernames that currently have a cached record pointer (debug use)"""
+        prefix = _pointer_key("username", "")
+        usernames = []
+        async for key in self._redis().scan_iter(match=f"{prefix}*", count=500):
+            usernames.append(_text(key)[len(prefix):])
+            if limit is not None and len(usernames) >= limit:
+                break
+        return usernames
+
+    async def exists(self, username: Optional[str] = None, email: Optional[str] = None) -> bool:
+        if username is not None:
+            return await self.get(username) is not None
+        return await self.get_by_email(email) is not None
+
+    async def put(self, user, old_username: Optional[str] = None) -> dict:
+        """
+        Write-through after a committed change; accepts a model or a record dict.
+
+        Relation lists in the record are ignored: they change only through
+        edit_lists, after the relation tables have been written.
+        """
+        user = user if isinstance(user, dict) else user_to_dict(user)
+        await self.put_many([user], renamed={user['username']: old_username} if old_username else None)
+        return user
+
+    async def put_many(self, users: Iterable[dict], renamed: Optional[Dict[str, str]] = None):
+        users = [user if isinstance(user, dict) else user_to_dict(user) for user in users]
+        if not users:
+            return
+        ids = await self._ids_for(users)
+        async with self._redis().pipeline(transaction=True) as pipe:
+            for user, user_id in zip(users, ids):
+                self._bump(pipe, user['email'], user['username'])
+                self._write(pipe, user_id, user)
+                old_username = (renamed or {}).get(user['username'])
+                if old_username and old_username != user['username']:
+                    pipe.incr(_version_key("username", old_username))
+                    pipe.delete(_pointer_key("username", old_username))
+            await pipe.execute()
+
+        for user in users:
+            # The record passed in may lack the relation lists; the next read takes the stored one
+            self.local.discard(email=user['email'], username=user['username'])
+            self.local.discard(username=(renamed or {}).get(user['username']))
+        await self._announce([[user['email'], user['username'], (renamed or {}).get(user['username'])] for user in users])
+
+    async def update_fields(self, updates: Dict[str, dict]):
+        """Patch fields of cached records by email (e.g. rankings); records not cached are left alone"""
+        await self._patch({email: (fields, ()) for email, fields in updates.items()})
+
+    async def record_battle(self, users: Iterable[dict], battle_id: str):
+        """Apply a finished battle to cached records: HSET the changed stats and append the battle id"""
+        await self._patch({
+            user['email']: ({field: user[field] for field in USER_STAT_FIELDS}, (("add", "battles", battle_id),))
+            for user in users
+        })
+
+    async def edit_lists(self, edits: Dict[str, List[tuple]]):
+        """Apply (add|remove, list field, value) edits to cached records by email, after the tables are committed"""
+        await self._patch({email: ({}, ops) for email, ops in edits.items() if ops})
+
+    async def _patch(self, patches: Dict[str, tuple]):
+        if not patches:
+            return
+        async with self._redis().pipeline(transaction=False) as pipe:
+            for email, (fields, ops) in patches.items():
+                args = [len(fields)]
+                for field, value in fields.items():
+                    args.extend((field, json.dumps(value)))
+                for op in ops:
+                    args.extend(op)
+                await self._scripts["patch"](keys=[_pointer_key("email", email), _version_key("email", email)], args=args, client=pipe)
+            usernames = await pipe.execute()
+        patched = []
+        for email, username in zip(patches.keys(), usernames):
+            if username is None:
+                continue
+            username = _text(username)
+            self.local.discard(email=email, username=username)
+            patched.append([email, username, None])
+        if patched:
+            await self._announce(patched)
+
+    async def invalidate(self, email: Optional[str] = None, username: Optional[str] = None):
+        """Drop a user's cached record; the next read reloads it from Postgres"""
+        pointers = [_pointer_key(kind, value) for kind, value in (("email", email), ("username", username)) if value]
+        ids = {user_id for user_id in await self._redis().mget(pointers) if user_id} if pointers else set()
+        async with self._redis().pipeline(transaction=True) as pipe:
+            self._bump(pipe, email, username)
+            for user_id in ids:
+                pipe.delete(_record_key(user_id), *(_list_key(user_id, field) for field in USER_LIST_FIELDS))
+            if username:
+                # The email pointer is kept so the id stays stable; a username can pass to someone else
+                pipe.delete(_pointer_key("username", username))
+            await pipe.execute()
+        self.local.discard(email=email, username=username)
+        await self._announce([[email, username, None]])
+
+    async def invalidate_many(self, emails: Iterable[str]):
+        """invalidate() for a batch of emails: one MGET, one pipeline and one announcement"""
+        emails = list(dict.fromkeys(email for email in emails if email))
+        if not emails:
+            return
+        ids = await self._redis().mget([_pointer_key("email", email) for email in emails])
+        async with self._redis().pipeline(transaction=False) as pipe:
+            for email, user_id in zip(emails, ids):
+                self._bump(pipe, email, None)
+                if user_id:
+                    pipe.delete(_record_key(user_id), *(_list_key(user_id, field) for field in USER_LIST_FIELDS))
+            await pipe.execute()
+        for email in emails:
+            self.local.discard(email=email)
+        await self._announce([[email, None, None] for email in emails])
+
+    async def flush(self):
+        await self._redis().flushdb()
+        self.local.clear()
+        await self._announce([], flush=True)
+
+    def metrics(self) -> dict:
+        snapshot = self.local.snapshot()
+        snapshot["subscribed"] = bool(self._subscribed is not None and self._subscribed.is_set())
+        snapshot["inflight_loads"] = len(self._inflight)
+        return snapshot
+
+    def _local_ready(self) -> bool:
+        """Start the invalidation listener if needed; the local layer is bypassed until it is subscribed"""
+        if self.local.maxsize <= 0:
+            return False
+        self._redis()
+        if self._subscribed is None:
+            self._subscribed = asyncio.Event()
+        if self._listener is None or self._listener.done():
+            self._subscribed.clear()
+            self._listener = asyncio.get_event_loop().create_task(self._listen())
+        return self._subscribed.is_set()
+
+    async def _announce(self, users: List[list], flush: bool = False):
+        try:
+            await self._redis().publish(USER_INVALIDATION_CHANNEL, json.dumps({
+                "origin": WORKER_ID,
+                "users": users,
+                "flush": flush,
+            }))
+        except Exception as e:
+            # Other workers fall back on the TTL for this write
+            logger.error(f"[USER_CACHE] Error publishing invalidation: {str(e)}")
+
+    async def _listen(self):
+        while True:
+            pubsub = self._client.pubsub()
+            try:
+                await pubsub.subscribe(USER_INVALIDATION_CHANNEL)
+                # Anything written while we were not subscribed may be stale
+                self.local.clear()
+                self._subscribed.set()
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    self._apply_invalidation(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[USER_CACHE] Invalidation subscription error, reconnecting: {str(e)}")
+                self._subscribed.clear()
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    def _apply_invalidation(self, data: str):
+        try:
+            payload = json.loads(data)
+        except (ValueError, TypeError):
+            return
+        if payload.get("origin") == WORKER_ID:
+            return
+        if payload.get("flush"):
+            self.local.clear()
+            return
+        for email, username, old_username in payload.get("users") or ():
+            self.local.discard(email=email, username=username)
+            self.local.discard(username=old_username)
+
+    async def shutdown(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        # The pooled client itself is closed with the pool
+        self._client = None
+
+    @staticmethod
+    def _bump(pipe, email: Optional[str], username: Optional[str]):
+        if email:
+            pipe.incr(_version_key("email", email))
+        if username:
+            pipe.incr(_version_key("username", username))
+
+    async def _ids_for(self, users: List[dict]) -> list:
+        async with self._redis().pipeline(transaction=False) as pipe:
+            for user in users:
+                await self._scripts["id"](keys=[_pointer_key("email", user['email']), USER_ID_COUNTER], client=pipe)
+            return await pipe.execute()
+
+    @staticmethod
+    def _write(pipe, user_id, user: dict, loaded: bool = False):
+        """
+        Queue a write of one record and point both lookups at it.
+
+        A loaded record (read from Postgres with its relations) replaces
+        everything and is marked complete; any other write updates the
+        hash and battles but leaves the relation lists as they are. A
+        record that was never loaded stays unmarked and reads as a miss.
+        """
+        lists = USER_LIST_FIELDS if loaded else tuple(f for f in USER_LIST_FIELDS if f not in USER_RELATION_FIELDS)
+        fields = {field: json.dumps(user.get(field)) for field in USER_HASH_FIELDS}
+        if loaded:
+            pipe.delete(_record_key(user_id))
+            fields[USER_LOADED_FIELD] = "1"
+        pipe.delete(*(_list_key(user_id, field) for field in lists))
+        pipe.hset(_record_key(user_id), mapping=fields)
+        for field in lists:
+            if user.get(field):
+                pipe.rpush(_list_key(user_id, field), *user[field])
+        pipe.set(_pointer_key("email", user['email']), user_id)
+        pipe.set(_pointer_key("username", user['username']), user_id)
+
+    async def _read(self, key: tuple) -> Optional[dict]:
+        self._redis()
+        reply = await self._scripts["read"](keys=[_pointer_key(*key)], args=USER_LIST_FIELDS)
+        return self._decode(reply, key)
+
+    @staticmethod
+    def _decode(reply, key: tuple) -> Optional[dict]:
+        if not reply:
+            return None
+        try:
+            flat = reply[1]
+            user = {_text(flat[i]): json.loads(flat[i + 1]) for i in range(0, len(flat), 2)}
+        except (ValueError, TypeError, IndexError):
+            return None
+        # A username pointer can outlive a rename that another worker has not seen yet
+        if user.get(key[0]) != key[1] or not user.get(USER_LOADED_FIELD):
+            return None
+        for field, values in zip(USER_LIST_FIELDS, reply[2:]):
+            user[field] = [_text(value) for value in values]
+        return {field: user.get(field) for field in USER_FIELDS}
+
+    async def _single_flight(self, key: tuple, column, value: str) -> Optional[dict]:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key[0], column, value))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shielded so one cancelled waiter does not abort the load for the others
+        return await asyncio.shield(task)
+
+    async def _load(self, kind: str, column, value: str) -> Optional[dict]:
+        observed = await self._redis().get(_version_key(kind, value))
+        from friends.relations import user_record
+        async with SessionLocal() as session:
+            result = await session.execute(select(UserData).where(column == value))
+            row = result.scalar_one_or_none()
+            if row is None:
+                return None
+            user = await user_record(session, row)
+        await self._store_if_unchanged(user, kind, value, observed)
+        return user
+
+    async def _store_if_unchanged(self, user: dict, kind: str, value: str, observed):
+        """Cache a loaded record unless the user was written or invalidated since the load began"""
+        user_id = (await self._ids_for([user]))[0]
+        try:
+            async with self._redis().pipeline() as pipe:
+                await pipe.watch(_version_key(kind, value))
+                if await pipe.get(_version_key(kind, value)) != observed:
+                    return
+                pipe.multi()
+                self._write(pipe, user_id, user, loaded=True)
+                await pipe.execute()
+        except WatchError:
+            return
+
+
+# Global user cache instance
+user_cache = UserCache()
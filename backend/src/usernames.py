@@ -0,0 +1,105 @@
+import logging
+from typing import Optional
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import insert
+from init import SessionLocal
+from models import UserData, UsernameHistory
+from redis_pool import redis_pool
+from user_cache import user_cache
+
+logger = logging.getLogger(__name__)
+
+# Hash of lower(username) -> current username
+USERNAME_LOWER_KEY = "usernames:lower"
+
+# Hash of lower(former username) -> email of the user who renamed away from it
+USERNAME_FORMER_KEY = "usernames:former"
+
+
+async def record_rename(session, old_username: str, email: str):
+    """Remember a former username inside the caller's transaction; its latest owner wins"""
+    stmt = insert(UsernameHistory).values(old_username=old_username, email=email)
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=[UsernameHistory.old_username],
+        set_={"email": stmt.excluded.email, "renamed_at": func.now()},
+    ))
+
+
+class UsernameResolver:
+    """
+    Maps the name a client presents to the user's current username.
+
+    Tried in order: exact (the user cache), case-insensitive (a Redis hash
+    of lower(username) -> username, backed by the lower(username) index)
+    and former names (a Redis hash of lower(old name) -> email, backed by
+    username_history). Each step is a hash lookup once warm; a miss costs
+    one indexed query and fills the map.
+    """
+
+    async def resolve(self, name: str) -> Optional[str]:
+        if not name:
+            return None
+        if await user_cache.get(name) is not None:
+            return name
+        key = name.lower()
+        username = await self._case_insensitive(key)
+        if username is not None:
+            return username
+        return await self._former(key)
+
+    async def _case_insensitive(self, key: str) -> Optional[str]:
+        client = redis_pool.client()
+        username = await client.hget(USERNAME_LOWER_KEY, key)
+        # The map is only a hint; the user cache has the final word
+        if username is not None and await user_cache.get(username) is not None:
+            return username
+
+        async with SessionLocal() as db:
+            result = await db.execute(
+                select(UserData.username).where(func.lower(UserData.username) == key).limit(1)
+            )
+            username = result.scalar_one_or_none()
+        if username is not None:
+            await client.hset(USERNAME_LOWER_KEY, key, username)
+        return username
+
+    async def _former(self, key: str) -> Optional[str]:
+        client = redis_pool.client()
+        email = await client.hget(USERNAME_FORMER_KEY, key)
+        if email is None:
+            async with SessionLocal() as db:
+                result = await db.execute(
+                    select(UsernameHistory.email)
+                    .where(func.lower(UsernameHistory.old_username) == key)
+                    .order_by(UsernameHistory.renamed_at.desc())
+                    .limit(1)
+                )
+                email = result.scalar_one_or_none()
+            if email is None:
+                return None
+            await client.hset(USERNAME_FORMER_KEY, key, email)
+
+        user = await user_cache.get_by_email(email)
+        if user is None:
+            return None
+        logger.info(f"[USERNAMES] Former username {key} resolved to {user['username']}")
+        return user['username']
+
+    async def registered(self, username: str):
+        await redis_pool.client().hset(USERNAME_LOWER_KEY, username.lower(), username)
+
+    async def renamed(self, old_username: str, new_username: str, email: str):
+        """Call after the rename (and its record_rename) has committed"""
+        async with redis_pool.pipeline(transaction=True) as pipe:
+            pipe.hdel(USERNAME_LOWER_KEY, old_username.lower())
+            pipe.hset(USERNAME_LOWER_KEY, new_username.lower(), new_username)
+            pipe.hset(USERNAME_FORMER_KEY, old_username.lower(), email)
+            await pipe.execute()
+
+    async def removed(self, username: str):
+        # Former names that pointed at this user resolve to nothing once the email is gone
+        await redis_pool.client().hdel(USERNAME_LOWER_KEY, username.lower())
+
+
+# Global resolver instance
+username_resolver = UsernameResolver()
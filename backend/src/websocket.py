@@ -1,26 +1,30 @@
 from fastapi import WebSocket, FastAPI, WebSocketDisconnect
 import json
 import logging
-from typing import Dict, List
+from typing import Dict, List, Optional
 from db.router import delete_user_data, get_user_data, update_user_data, get_user_by_username
 from friends.router import add_friend, cancel_friend_request, send_friend_request
-from battle.router import invite_friend, cancel_invitation, accept_invitation, get_waiting_battles
-from battle.init import battles, Battle
+from battle.router import invite_friend, cancel_invitation, accept_invitation, clear_battle_invitations
+from battle.init import battles, Battle, seat_opponent, drop_battle, withdraw_battle, active_battle_for, find_battle
+from battle.lobby import lobby
 from models import UserDataCreate
 from init import init_models
 from friends.router import remove_friend
 import asyncio
+import time
 import uuid
 from fastapi import HTTPException
 from ai_quiz_generator import ai_quiz_generator
-from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, select
 from models import Chat, ChatCreate
-from db.init import SessionLocal
-import redis
 import os
 import json
 from datetime import datetime
+from scheduler import scheduler
+from notification_bus import NotificationBus, NOTIFICATION_BUS_BACKEND, LOBBY_TOPIC
+from outbound import OutboundQueue, encode_frame
+from latency import ws_connect_latency
+from user_cache import user_cache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -29,81 +33,95 @@ app = FastAPI()
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
+        # username -> bounded send queue wrapping the user's lobby websocket
+        self.active_connections: Dict[str, OutboundQueue] = {}
+        # Cross-worker delivery; None keeps delivery to this process only
+        self.bus = None
+        if NOTIFICATION_BUS_BACKEND == "redis":
+            self.bus = NotificationBus(self._deliver_local, lambda: list(self.active_connections.keys()))
 
     async def connect(self, websocket: WebSocket, username: str):
         await websocket.accept()
-        self.active_connections[username] = websocket
+        previous = self.active_connections.get(username)
+        if previous is not None:
+            previous.close()
+        self.active_connections[username] = OutboundQueue(f"lobby:{username}", websocket)
+        if self.bus is not None:
+            await self.bus.subscribe_user(username)
 
     async def disconnect(self, username: str):
         if username in self.active_connections:
-            del self.active_connections[username]
+            self.active_connections.pop(username).close()
             user_warnings_sent.pop(username, None)
+            if self.bus is not None:
+                await self.bus.unsubscribe_user(username)
             await self.handle_battle_disconnect(username)
 
+    async def rename(self, old_username: str, new_username: str):
+        """Move a live connection (and its bus subscription) to a new username"""
+        if old_username not in self.active_connections:
+            return
+        outbound = self.active_connections.pop(old_username)
+        outbound.label = f"lobby:{new_username}"
+        self.active_connections[new_username] = outbound
+        if self.bus is not None:
+            await self.bus.unsubscribe_user(old_username)
+            await self.bus.subscribe_user(new_username)
+
     async def handle_battle_disconnect(self, disconnected_username: str, reason: str = "disconnected"):
         try:
-            for battle_id, battle in list(battles.items()):
-                if (battle.first_opponent == disconnected_username or 
-                    battle.second_opponent == disconnected_username):
-
-                    # If it's a waiting battle (no second opponent), do nothing on disconnect.
-                    # The inactivity monitor will clean it up if it's truly abandoned.
-                    if not battle.second_opponent:
-                        logger.info(f"User {disconnected_username} disconnected from a waiting battle ({battle_id}). Battle will not be removed immediately.")
-                        continue
-
-                    # The rest of this logic only applies to active battles.
-                    if battle.first_opponent == disconnected_username:
-                        winner = battle.second_opponent
-                        loser = battle.first_opponent
-                        battle.second_opponent_score = 10
-                        
-                    else:
-                        winner = battle.first_opponent
-                        loser = battle.second_opponent
-                        battle.first_opponent_score = 10
-                       
-                    # Customize message based on reason
-                    if reason == "inactive":
-                        battle_finished_message = json.dumps({
-                            "type": "battle_finished",
-                            "data": {
-                                "battle_id": battle_id,
-                                "text": f"{winner} wins by default - {loser} was inactive for 1 minute",
-                                "questions": f"{winner} wins because {loser} was inactive for 1 minute",
-                                "loser": loser,
-                                "winner": winner,
-                            }
-                        })
-                    else:
-                        battle_finished_message = json.dumps({
-                            "type": "battle_finished",
-                            "data": {
-                                "battle_id": battle_id,
-                                "text": f"{winner} wins by default - {loser} disconnected",
-                                "questions": f"{winner} wins because {loser} left the game",
-                                "loser": loser,
-                                "winner": winner,
-                            }
-                        })
-                    
-                    if winner in self.active_connections:
-                        await self.send_message(battle_finished_message, winner)
-                       
-                    
-                    try:
-                        from battle.router import battle_result
-                        await battle_result(battle_id, winner, loser, "win")
-                       
-                    except Exception as e:
-                        logger.error(f"Error processing battle result for disconnect: {str(e)}")
-                    
-                    if battle_id in battles:
-                        del battles[battle_id]
-                       
-                    
-                    break  
+            # Waiting battles are left alone on disconnect; the inactivity timer cleans them up
+            battle = active_battle_for(disconnected_username)
+            if battle is None:
+                return
+            battle_id = battle.id
+
+            if battle.first_opponent == disconnected_username:
+                winner = battle.second_opponent
+                loser = battle.first_opponent
+                battle.second_opponent_score = 10
+                
+            else:
+                winner = battle.first_opponent
+                loser = battle.second_opponent
+                battle.first_opponent_score = 10
+               
+            # Customize message based on reason
+            if reason == "inactive":
+                battle_finished_message = json.dumps({
+                    "type": "battle_finished",
+                    "data": {
+                        "battle_id": battle_id,
+                        "text": f"{winner} wins by default - {loser} was inactive for 1 minute",
+                        "questions": f"{winner} wins because {loser} was inactive for 1 minute",
+                        "loser": loser,
+                        "winner": winner,
+                    }
+                })
+            else:
+                battle_finished_message = json.dumps({
+                    "type": "battle_finished",
+                    "data": {
+                        "battle_id": battle_id,
+                        "text": f"{winner} wins by default - {loser} disconnected",
+                        "questions": f"{winner} wins because {loser} left the game",
+                        "loser": loser,
+                        "winner": winner,
+                    }
+                })
+            
+            if winner in self.active_connections:
+                await self.send_message(battle_finished_message, winner)
+               
+            
+            try:
+                from battle.router import battle_result
+                await battle_result(battle_id, winner, loser, "win")
+               
+            except Exception as e:
+                logger.error(f"Error processing battle result for disconnect: {str(e)}")
+            
+            await drop_battle(battle_id)
                     
         except Exception as e:
             logger.error(f"Error handling battle disconnect for {disconnected_username}: {str(e)}")
@@ -112,9 +130,42 @@ class ConnectionManager:
        
         if username in self.active_connections:
             await self.active_connections[username].send_text(message)
+        elif self.bus is not None:
+            try:
+                if not await self.bus.publish_to_user(username, message):
+                    logger.warning(f"User {username} not connected to any worker")
+            except Exception as e:
+                logger.error(f"Error publishing message for {username}: {e}")
         else:
             logger.warning(f"User {username} not found in active connections")
 
+    async def _deliver_local(self, username: str, message: str):
+        outbound = self.active_connections.get(username)
+        if outbound is not None and not outbound.offer(message):
+            logger.warning(f"Dropped message for {username}: connection closed")
+
+    async def send_many(self, message, usernames):
+        """Send the same frame to several users, encoding it once"""
+        frame = encode_frame(message)
+        for username in usernames:
+            try:
+                await self.send_message(frame, username)
+            except Exception as e:
+                logger.error(f"Error sending message to {username}: {e}")
+
+    async def broadcast(self, message, exclude=(), topic: str = LOBBY_TOPIC):
+        """Send one frame to every lobby connection on every worker, except the excluded users"""
+        message = encode_frame(message)
+        # Enqueue only: nothing awaits a client, so the dict cannot change under the loop
+        for connected_user, outbound in self.active_connections.items():
+            if connected_user not in exclude:
+                outbound.offer(message)
+        if self.bus is not None:
+            try:
+                await self.bus.publish_to_topic(topic, message, exclude)
+            except Exception as e:
+                logger.error(f"Error publishing broadcast to {topic}: {e}")
+
     async def _notify_friend_update(self, friend: str):
         """Helper method to notify a friend about user updates"""
         try:
@@ -158,143 +209,89 @@ async def validate_and_fix_username(connecting_username: str) -> str:
     logger.info(f"Attempting to validate username: {connecting_username}")
     
     try:
-        # First, try to find the user directly
-        user_data = await get_user_by_username(connecting_username)
-        if user_data:
-            logger.info(f"Direct username match found: {connecting_username}")
-            return connecting_username  
-    except Exception as direct_error:
-        logger.warning(f"Error in direct username lookup: {direct_error}")
-    
-    try:
-        from init import SessionLocal
-        from models import UserData
-        from sqlalchemy import select
-        
-        async with SessionLocal() as db:
-            # Try to find a user with a similar username
-            all_users_stmt = select(UserData)
-            all_users_result = await db.execute(all_users_stmt)
-            all_users = all_users_result.scalars().all()
-            
-            # Check for exact case-insensitive match first
-            for user in all_users:
-                if user.username.lower() == connecting_username.lower():
-                    logger.warning(f"Found case-insensitive match for username {connecting_username}. Returning {user.username}")
-                    return user.username
-            
-            # Check if username exists in any friend list
-            for user in all_users:
-                if connecting_username in user.friends:
-                    logger.warning(f"User {connecting_username} found in {user.username}'s friends list. Returning {user.username}")
-                    return user.username
-            
-            logger.warning(f"No valid username found for {connecting_username}")
+        # Exact, then case-insensitive, then former usernames
+        from usernames import username_resolver
+        username = await username_resolver.resolve(connecting_username)
     except Exception as e:
         logger.error(f"Error validating username {connecting_username}: {e}")
+        return None
     
-    return None  # Return None if no valid username is found
+    if username is None:
+        logger.warning(f"No valid username found for {connecting_username}")
+    elif username != connecting_username:
+        logger.warning(f"Resolved username {connecting_username} to {username}")
+    return username
 
-async def monitor_inactive_players():
-    while True:
-        try:
-            current_time = asyncio.get_event_loop().time()
-            warning_threshold = 45  
-            inactive_threshold = 60  
-            waiting_inactive_threshold = 600  
-            
-            for battle_id, battle in battles.items():
-                if battle.second_opponent:
-                    if battle.first_opponent in user_last_activity:
-                        time_since_activity = current_time - user_last_activity[battle.first_opponent]
-                        
-                        if time_since_activity >= warning_threshold and time_since_activity < inactive_threshold:
-                            if not user_warnings_sent.get(battle.first_opponent, False):
-                                logger.info(f"Warning: Player {battle.first_opponent} inactive for {time_since_activity:.1f} seconds")
-                                user_warnings_sent[battle.first_opponent] = True
-                                
-                                if battle.first_opponent in manager.active_connections:
-                                    await manager.send_message(json.dumps({
-                                        "type": "inactivity_warning",
-                                        "data": {
-                                            "message": "You have been inactive for 45 seconds. You will lose automatically in 15 seconds if you don't respond.",
-                                            "time_remaining": 15
-                                        }
-                                    }), battle.first_opponent)
-                        
-                        if time_since_activity >= inactive_threshold:
-                            logger.info(f"Player {battle.first_opponent} inactive for {time_since_activity:.1f} seconds - giving default win to {battle.second_opponent}")
-                            battle.second_opponent_score = 10
-                            await manager.handle_battle_disconnect(battle.first_opponent, "inactive")
-                            user_warnings_sent.pop(battle.first_opponent, None)
-                            continue
-                    
-                    if battle.second_opponent in user_last_activity:
-                        time_since_activity = current_time - user_last_activity[battle.second_opponent]
-                        
-                        if time_since_activity >= warning_threshold and time_since_activity < inactive_threshold:
-                            if not user_warnings_sent.get(battle.second_opponent, False):
-                                logger.info(f"Warning: Player {battle.second_opponent} inactive for {time_since_activity:.1f} seconds")
-                                user_warnings_sent[battle.second_opponent] = True
+# Lobby inactivity thresholds in seconds
+INACTIVITY_WARNING_THRESHOLD = 45
+INACTIVITY_FORFEIT_THRESHOLD = 60
+WAITING_INACTIVITY_THRESHOLD = 600
 
-                                if battle.second_opponent in manager.active_connections:
-                                    await manager.send_message(json.dumps({
-                                        "type": "inactivity_warning",
-                                        "data": {
-                                            "message": "You have been inactive for 45 seconds. You will lose automatically in 15 seconds if you don't respond.",
-                                            "time_remaining": 15
-                                        }
-                                    }), battle.second_opponent)
-                        
-                        
-                        if time_since_activity >= inactive_threshold:
-                            logger.info(f"Player {battle.second_opponent} inactive for {time_since_activity:.1f} seconds - giving default win to {battle.first_opponent}")
-                            battle.first_opponent_score = 10
-                            await manager.handle_battle_disconnect(battle.second_opponent, "inactive")
-                            
-                            user_warnings_sent.pop(battle.second_opponent, None)
-                            continue
-            
-            
-            for battle_id, battle in list(battles.items()):
-                if not battle.second_opponent:  
-                    if battle.first_opponent in user_last_activity:
-                        time_since_activity = current_time - user_last_activity[battle.first_opponent]
-                        
-                        
-                        if time_since_activity >= waiting_inactive_threshold - 60:  
-                            logger.info(f"Waiting battle {battle_id} by {battle.first_opponent} will be removed in {waiting_inactive_threshold - time_since_activity:.1f} seconds")
-                        
-                        
-                        if time_since_activity >= waiting_inactive_threshold:
-                            logger.info(f"Player {battle.first_opponent} inactive in waiting room for {time_since_activity:.1f} seconds - removing waiting battle {battle_id}")
-                            
-                            battles.pop(battle_id)
-                            
-                            for connected_user in manager.active_connections.keys():
-                                await manager.send_message(json.dumps({
-                                    "type": "battle_removed",
-                                    "data": battle_id
-                                }), connected_user)
-                            
-                            if battle.first_opponent in manager.active_connections:
-                                await manager.send_message(json.dumps({
-                                    "type": "waiting_room_inactivity",
-                                    "data": {
-                                        "message": "You were inactive in the waiting room for 10 minutes. Your battle has been removed.",
-                                        "battle_id": battle_id
-                                    }
-                                }), battle.first_opponent)
-                            continue
-            
-            await asyncio.sleep(5)  
-        except Exception as e:
-            logger.error(f"Error in monitor_inactive_players: {str(e)}")
-            await asyncio.sleep(5)
+def record_user_activity(username: str):
+    """Record activity for a user and push their inactivity deadlines back"""
+    user_last_activity[username] = asyncio.get_event_loop().time()
+    user_warnings_sent.pop(username, None)
+    group = ("user", username)
+    scheduler.schedule(("inactivity_warning", username), INACTIVITY_WARNING_THRESHOLD,
+                       warn_inactive_player, username, group=group)
+    scheduler.schedule(("inactivity_forfeit", username), INACTIVITY_FORFEIT_THRESHOLD,
+                       forfeit_inactive_player, username, group=group)
+    scheduler.schedule(("waiting_inactivity", username), WAITING_INACTIVITY_THRESHOLD,
+                       remove_inactive_waiting_battles, username, group=group)
+
+def find_active_battle(username: str):
+    return active_battle_for(username)
+
+async def warn_inactive_player(username: str):
+    """Fired by the scheduler INACTIVITY_WARNING_THRESHOLD seconds after a user's last message"""
+    if find_active_battle(username) is None or user_warnings_sent.get(username, False):
+        return
+    logger.info(f"Warning: Player {username} inactive for {INACTIVITY_WARNING_THRESHOLD} seconds")
+    user_warnings_sent[username] = True
+    if username in manager.active_connections:
+        await manager.send_message(json.dumps({
+            "type": "inactivity_warning",
+            "data": {
+                "message": "You have been inactive for 45 seconds. You will lose automatically in 15 seconds if you don't respond.",
+                "time_remaining": INACTIVITY_FORFEIT_THRESHOLD - INACTIVITY_WARNING_THRESHOLD
+            }
+        }), username)
+
+async def forfeit_inactive_player(username: str):
+    """Fired by the scheduler INACTIVITY_FORFEIT_THRESHOLD seconds after a user's last message"""
+    battle = find_active_battle(username)
+    if battle is None:
+        return
+    winner = battle.second_opponent if battle.first_opponent == username else battle.first_opponent
+    logger.info(f"Player {username} inactive for {INACTIVITY_FORFEIT_THRESHOLD} seconds - giving default win to {winner}")
+    await manager.handle_battle_disconnect(username, "inactive")
+    user_warnings_sent.pop(username, None)
+
+async def remove_inactive_waiting_battles(username: str):
+    """Fired by the scheduler WAITING_INACTIVITY_THRESHOLD seconds after a user's last message"""
+    for entry in await lobby.waiting_for(username):
+        battle_id = entry["id"]
+        logger.info(f"Player {username} inactive in waiting room for {WAITING_INACTIVITY_THRESHOLD} seconds - removing waiting battle {battle_id}")
+        change = await withdraw_battle(battle_id)
+        if change is None:
+            # Joined or cancelled in the meantime
+            continue
+        
+        await manager.broadcast(json.dumps(lobby.delta("battle_removed", change)))
+        
+        if username in manager.active_connections:
+            await manager.send_message(json.dumps({
+                "type": "waiting_room_inactivity",
+                "data": {
+                    "message": "You were inactive in the waiting room for 10 minutes. Your battle has been removed.",
+                    "battle_id": battle_id
+                }
+            }), username)
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket, username: str):
     actual_username = None  # Initialize to None to avoid UnboundLocalError
+    connect_started = time.perf_counter()
     try:
         valid_username = await validate_and_fix_username(username)
         if valid_username is None:
@@ -308,52 +305,38 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
         
         await manager.connect(websocket, actual_username)
         
-        user_last_activity[actual_username] = asyncio.get_event_loop().time()
+        record_user_activity(actual_username)
 
         try:
-            user_data = await get_user_by_username(actual_username)
+            # The user is already cached by the lookup above; friends come in one batched read
+            user_data = await user_cache.get(actual_username)
             if user_data and user_data.get('friends'):
-                updated_friends = []
-                for friend_username in user_data['friends']:
-                    try:
-                        friend_data = await get_user_by_username(friend_username)
-                        if friend_data:
-                            updated_friends.append(friend_username)
-                        else:
-                            logger.warning(f"Friend {friend_username} not found for user {actual_username}")
-                    except Exception as e:
-                        logger.error(f"Error checking friend {friend_username}: {e}")
-                
-                if len(updated_friends) != len(user_data['friends']):
-                    logger.info(f"Updating friend list for {actual_username} due to username changes")
-                    user_data['friends'] = updated_friends
-                    user_update_data = UserDataCreate(**user_data)
-                    await update_user_data(user_update_data)
-
+                found = await user_cache.get_many(user_data['friends'])
+                missing = [friend for friend in user_data['friends'] if friend not in found]
+                if missing:
+                    # The relation tables are authoritative; a stale cached list is simply reloaded
+                    logger.warning(f"Friends {missing} not found for user {actual_username}, reloading cached record")
+                    await user_cache.invalidate(email=user_data['email'], username=actual_username)
                     await manager.send_message(json.dumps({
                         "type": "user_updated",
-                        "data": user_data
+                        "data": await user_cache.get(actual_username)
                     }), actual_username)
         except Exception as e:
             logger.error(f"Error checking friend list for {actual_username}: {e}")
 
-        
         try:
-            waiting_battles = await get_waiting_battles()
-            await manager.send_message(json.dumps({
-                "type": "waiting_battles",
-                "data": waiting_battles
-            }), actual_username)
+            # Pre-encoded at the current lobby version; no DB access on connect
+            await manager.send_message(await lobby.snapshot_frame(), actual_username)
         except Exception as e:
             logger.error(f"Error sending waiting battles to {actual_username}: {str(e)}")
 
+        ws_connect_latency.observe(time.perf_counter() - connect_started)
+
         while True:
             try:
                 data = await websocket.receive_text()
                 
-                user_last_activity[actual_username] = asyncio.get_event_loop().time()
-                
-                user_warnings_sent.pop(actual_username, None)
+                record_user_activity(actual_username)
                 
                 try:
                     message = json.loads(data)          
@@ -401,17 +384,16 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                             logger.info(f"Username changed from {old_username} to {message['username']}")
                             
                             
-                            if old_username in manager.active_connections:
-                                manager.active_connections[message["username"]] = manager.active_connections.pop(old_username)
+                            await manager.rename(old_username, message["username"])
                             
                             
-                            if old_username in user_last_activity:
-                                user_last_activity[message["username"]] = user_last_activity.pop(old_username)
-                            
-                            
-                            if old_username in user_warnings_sent:
-                                user_warnings_sent[message["username"]] = user_warnings_sent.pop(old_username)
+                            user_last_activity.pop(old_username, None)
+                            user_warnings_sent.pop(old_username, None)
+                            scheduler.cancel_group(("user", old_username))
+                            record_user_activity(message["username"])
 
+                        # Waiting battles keep the creator name they were created under; only the avatar follows
+                        await lobby.update_creator(old_username, avatar=updated_user['avatar'])
                         
                         # Notify all friends in parallel
                         friend_notifications = []
@@ -594,60 +576,24 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                                 })
                                 logger.info(f"[WS] Sending battle_started to {battle.first_opponent} and {battle.second_opponent}")
                                 logger.info(f"[WS] Active connections: {list(manager.active_connections.keys())}")
-                                await manager.send_message(battle_started_message, battle.first_opponent)
-                                await manager.send_message(battle_started_message, battle.second_opponent)
-                                
+                                await manager.send_many(battle_started_message, (battle.first_opponent, battle.second_opponent))
+                                # accept_invitation already announced the battle leaving the lobby
                                 
-                                for connected_user in manager.active_connections.keys():
-                                    if connected_user not in [battle.first_opponent, battle.second_opponent]:
+                                # Withdraw the invitations other friends still hold for this battle
+                                for invited_user in await clear_battle_invitations(message["battle_id"]):
+                                    if invited_user in manager.active_connections:
                                         await manager.send_message(json.dumps({
-                                            "type": "battle_removed",
-                                            "data": message["battle_id"]
-                                        }), connected_user)
-                                
-                                
-                                for connected_user in manager.active_connections.keys():
-                                    if connected_user != battle.first_opponent and connected_user != battle.second_opponent:
-                                        user_data = await get_user_by_username(connected_user)
-                                        if user_data and message["battle_id"] in user_data.get('invitations', []):
-                                            user_data['invitations'].remove(message["battle_id"])
-                                            user_update_data = UserDataCreate(**user_data)
-                                            await update_user_data(user_update_data)
-                                            await manager.send_message(json.dumps({
-                                                "type": "user_updated",
-                                                "data": user_data
-                                            }), connected_user)
+                                            "type": "user_updated",
+                                            "data": await get_user_by_username(invited_user)
+                                        }), invited_user)
                                 
                                 # Send immediate response that quiz is being generated
-                                await manager.send_message(json.dumps({
+                                await manager.send_many({
                                     "type": "quiz_generating",
                                     "data": {"battle_id": battle.id}
-                                }), battle.first_opponent)
-                                await manager.send_message(json.dumps({
-                                    "type": "quiz_generating",
-                                    "data": {"battle_id": battle.id}
-                                }), battle.second_opponent)
-                                # Poll for questions in the background
-                                async def poll_for_questions():
-                                    try:
-                                        max_attempts = 30
-                                        attempts = 0
-                                        questions = await get_cached_questions(battle.id)
-                                        while not questions and attempts < max_attempts:
-                                            await asyncio.sleep(1)
-                                            questions = await get_cached_questions(battle.id)
-                                            attempts += 1
-                                        if not questions:
-                                            try:
-                                                questions = ai_quiz_generator.generate_questions(battle.sport, battle.level, 5, battle.id)
-                                            except Exception as e:
-                                                logger.error(f"Error getting fallback questions for battle {battle.id}: {str(e)}")
-                                                questions = []
-                                        battle.questions = questions
-                                    except Exception as e:
-                                        logger.error(f"Error polling for questions: {str(e)}")
-                                        battle.questions = []
-                                asyncio.create_task(poll_for_questions())
+                                }, (battle.first_opponent, battle.second_opponent))
+                                # Push the quiz to both players as soon as the worker publishes it
+                                asyncio.create_task(deliver_battle_questions(battle))
                         except HTTPException as e:
                             
                             await manager.send_message(json.dumps({
@@ -657,14 +603,6 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                                     "battle_id": message["battle_id"]
                                 }
                             }), message["friend_username"])
-                            
-                            
-                            if e.status_code == 409:
-                                for connected_user in manager.active_connections.keys():
-                                    await manager.send_message(json.dumps({
-                                        "type": "battle_removed",
-                                        "data": message["battle_id"]
-                                    }), connected_user)
                     elif message.get("type") == "reject_invitation":
                         try:
                             from battle.router import reject_invitation
@@ -684,17 +622,11 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                                 }
                             }), message["friend_username"])
                     elif message.get("type") == "join_battle":
-                        battle = battles.get(message["battle_id"])
+                        # The battle may have been created on another worker
+                        battle = await find_battle(message["battle_id"])
                         if battle and not battle.second_opponent:
                             # Check if user is already in another active battle
-                            user_in_active_battle = False
-                            for existing_battle in battles.values():
-                                if (existing_battle.second_opponent and 
-                                    (existing_battle.first_opponent == message["username"] or 
-                                     existing_battle.second_opponent == message["username"])):
-                                    user_in_active_battle = True
-                                    break
-                            if user_in_active_battle:
+                            if active_battle_for(message["username"]) is not None:
                                 logger.warning(f"User {message['username']} tried to join battle but is already in an active battle")
                                 await manager.send_message(json.dumps({
                                     "type": "error",
@@ -719,73 +651,42 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                                     "message": "Error verifying user. Please try again."
                                 }), message["username"])
                                 return
-                            battle.second_opponent = message["username"]
-                            logger.info(f"User {message['username']} joined battle {message['battle_id']}")
-                            # Broadcast battle joined to all connected users
-                            battle_joined_message = json.dumps({
-                                "type": "battle_joined",
-                                "data": {
-                                    "battle_id": message["battle_id"],
-                                    "second_opponent": message["username"]
-                                }
-                            })
-                            for connected_user in manager.active_connections.keys():
-                                await manager.send_message(battle_joined_message, connected_user)
-                            # Start quiz generation in the background
-                            async def ensure_seven_questions():
-                                questions = await get_cached_questions(battle.id)
-                                if not questions or len(questions) < 6:
-                                    logger.warning(f"No cached questions found for battle {battle.id}, using fallback questions")
-                                    questions = ai_quiz_generator.generate_questions(battle.sport, battle.level, 5, battle.id)
-                                    logger.info(f"Saved fallback questions for battle {battle.id}")
-                                battle.questions = questions
-                            asyncio.create_task(ensure_seven_questions())
-                            # Immediately notify both users that the battle has started
-                            battle_started_message = json.dumps({
-                                "type": "battle_started",
-                                "data": battle.id
-                            })
-                            logger.info(f"[WS] Sending battle_started to {battle.first_opponent} and {battle.second_opponent}")
-                            logger.info(f"[WS] Active connections: {list(manager.active_connections.keys())}")
-                            await manager.send_message(battle_started_message, battle.first_opponent)
-                            await manager.send_message(battle_started_message, battle.second_opponent)
-                            # Broadcast battle removal to other users since it's no longer waiting
-                            for connected_user in manager.active_connections.keys():
-                                if connected_user not in [battle.first_opponent, battle.second_opponent]:
-                                    await manager.send_message(json.dumps({
-                                        "type": "battle_removed",
-                                        "data": message["battle_id"]
-                                    }), connected_user)
-                            # Notify both users that quiz is being generated
-                            await manager.send_message(json.dumps({
-                                "type": "quiz_generating",
-                                "data": {"battle_id": battle.id}
-                            }), battle.first_opponent)
-                            await manager.send_message(json.dumps({
-                                "type": "quiz_generating",
-                                "data": {"battle_id": battle.id}
-                            }), battle.second_opponent)
-                            # Poll for questions in the background
-                            async def poll_for_questions():
-                                try:
-                                    max_attempts = 30
-                                    attempts = 0
-                                    questions = await get_cached_questions(battle.id)
-                                    while not questions and attempts < max_attempts:
-                                        await asyncio.sleep(1)
-                                        questions = await get_cached_questions(battle.id)
-                                        attempts += 1
-                                    if not questions:
-                                        try:
-                                            questions = ai_quiz_generator.generate_questions(battle.sport, battle.level, 5, battle.id)
-                                        except Exception as e:
-                                            logger.error(f"Error getting fallback questions for battle {battle.id}: {str(e)}")
-                                            questions = []
-                                    battle.questions = questions
-                                except Exception as e:
-                                    logger.error(f"Error polling for questions: {str(e)}")
-                                    battle.questions = []
-                            asyncio.create_task(poll_for_questions())
+                            change = await seat_opponent(battle, message["username"])
+                            if change is None:
+                                # Another player (possibly on another worker) took the seat first
+                                logger.warning(f"Battle {message['battle_id']} was joined before {message['username']} could take the seat")
+                                await manager.send_message(json.dumps({
+                                    "type": "error",
+                                    "message": "Battle is already full"
+                                }), message["username"])
+                            else:
+                                logger.info(f"User {message['username']} joined battle {message['battle_id']}")
+                                # Broadcast battle joined to all connected users
+                                battle_joined_message = json.dumps({
+                                    "type": "battle_joined",
+                                    "data": {
+                                        "battle_id": message["battle_id"],
+                                        "second_opponent": message["username"]
+                                    }
+                                })
+                                await manager.broadcast(battle_joined_message)
+                                # Immediately notify both users that the battle has started
+                                battle_started_message = json.dumps({
+                                    "type": "battle_started",
+                                    "data": battle.id
+                                })
+                                logger.info(f"[WS] Sending battle_started to {battle.first_opponent} and {battle.second_opponent}")
+                                logger.info(f"[WS] Active connections: {list(manager.active_connections.keys())}")
+                                await manager.send_many(battle_started_message, (battle.first_opponent, battle.second_opponent))
+                                # Broadcast battle removal to other users since it's no longer waiting
+                                await manager.broadcast(json.dumps(lobby.delta("battle_removed", change)), exclude=(battle.first_opponent, battle.second_opponent))
+                                # Notify both users that quiz is being generated
+                                await manager.send_many({
+                                    "type": "quiz_generating",
+                                    "data": {"battle_id": battle.id}
+                                }, (battle.first_opponent, battle.second_opponent))
+                                # Push the quiz to both players as soon as the worker publishes it
+                                asyncio.create_task(deliver_battle_questions(battle))
                         else:
                             if not battle:
                                 logger.warning(f"Battle {message['battle_id']} not found")
@@ -836,17 +737,11 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
 
                         if battles[message["battle_id"]].first_opponent == actual_username:
                             # Notify all connected users about battle start in parallel
-                            battle_start_notifications = []
-                            for connected_user in manager.active_connections.keys():
-                                if connected_user != battles[message["battle_id"]].first_opponent and connected_user != battles[message["battle_id"]].second_opponent:
-                                    battle_start_notifications.append(
-                                        manager.send_message(json.dumps({
-                                            "type": "battle_start",
-                                            "data": message["battle_id"]
-                                        }), connected_user)
-                                    )
-                            if battle_start_notifications:
-                                await asyncio.gather(*battle_start_notifications, return_exceptions=True)
+                            started_battle = battles[message["battle_id"]]
+                            await manager.broadcast(json.dumps({
+                                "type": "battle_start",
+                                "data": message["battle_id"]
+                            }), exclude=(started_battle.first_opponent, started_battle.second_opponent))
                
                     elif message.get("type") == "check_for_winner":
                         # Battle winner checking is handled by battle_ws.py for individual battles
@@ -866,15 +761,7 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                     elif message.get("type") == "notify_battle_created":
                         try:
                             # Check if user is already in an active battle
-                            user_in_active_battle = False
-                            for existing_battle in battles.values():
-                                if (existing_battle.second_opponent and 
-                                    (existing_battle.first_opponent == message["first_opponent"] or 
-                                     existing_battle.second_opponent == message["first_opponent"])):
-                                    user_in_active_battle = True
-                                    break
-                            
-                            if user_in_active_battle:
+                            if active_battle_for(message["first_opponent"]) is not None:
                                 await manager.send_message(json.dumps({
                                     "type": "error",
                                     "message": "You are already in an active battle. Please finish your current battle first."
@@ -882,17 +769,15 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                                 return
                             
                             # Check for duplicate battle with same sport and level
+                            user_waiting_battles = await lobby.waiting_for(message["first_opponent"])
                             duplicate_battle = None
-                            for b in battles.values():
-                                if (b.first_opponent == message["first_opponent"] and 
-                                    b.sport == message["sport"] and 
-                                    b.level == message["level"] and 
-                                    b.second_opponent == ''):
-                                    duplicate_battle = b
+                            for entry in user_waiting_battles:
+                                if entry["sport"] == message["sport"] and entry["level"] == message["level"]:
+                                    duplicate_battle = entry
                                     break
                             
                             if duplicate_battle:
-                                logger.warning(f"Duplicate battle creation attempt for {duplicate_battle.id}, skipping creation.")
+                                logger.warning(f"Duplicate battle creation attempt for {duplicate_battle['id']}, skipping creation.")
                                 await manager.send_message(json.dumps({
                                     "type": "error",
                                     "message": f"You already have a {message['sport']} ({message['level']}) battle waiting. Please wait for someone to join or cancel it first."
@@ -900,9 +785,6 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                                 return
                             
                             # Check total number of waiting battles for this user (limit to 3)
-                            user_waiting_battles = [b for b in battles.values() 
-                                                  if b.first_opponent == message["first_opponent"] and b.second_opponent == '']
-                            
                             if len(user_waiting_battles) >= 3:
                                 logger.warning(f"User {message['first_opponent']} tried to create more than 3 waiting battles.")
                                 await manager.send_message(json.dumps({
@@ -929,37 +811,18 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                             except Exception as e:
                                 logger.error(f"Failed to start manual quiz generation for battle {battle_id}: {str(e)}")
 
-                            # Get creator's user data to include avatar
+                            # Creator's avatar is looked up once and cached in the lobby entry
                             creator_user = await get_user_by_username(message["first_opponent"])
                             creator_avatar = creator_user.get('avatar', '') if creator_user else ''
+                            change = await lobby.add(battle, creator_avatar)
                             # Send response to battle creator
-                            response_message = json.dumps({
-                                "type": "battle_created_response",
-                                "data": {
-                                    "id": battle.id,
-                                    "first_opponent": battle.first_opponent,
-                                    "sport": battle.sport,
-                                    "level": battle.level,
-                                    "creator_avatar": creator_avatar
-                                }
-                            })
+                            response_message = json.dumps(lobby.delta("battle_created_response", change))
                             logger.info(f"Sending battle_created_response to {message['first_opponent']}: {response_message}")
                             await manager.send_message(response_message, message["first_opponent"])
                             logger.info(f"Successfully sent battle_created_response to {message['first_opponent']}")
 
                             # Send notification to other users
-                            for connected_user in manager.active_connections.keys():
-                                if connected_user != message["first_opponent"]:
-                                    await manager.send_message(json.dumps({
-                                        "type": "battle_created",
-                                        "data": {
-                                            "id": battle.id,
-                                            "first_opponent": battle.first_opponent,
-                                            "sport": battle.sport,
-                                            "level": battle.level,
-                                            "creator_avatar": creator_avatar
-                                        }
-                                    }), connected_user)
+                            await manager.broadcast(json.dumps(lobby.delta("battle_created", change)), exclude=(message["first_opponent"],))
                         except Exception as e:
                             logger.error(f"Error creating battle: {str(e)}")
                             # Send error message to the user
@@ -983,19 +846,15 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                         battle_id = message["battle_id"]
                         username = message["username"]
                         
-                        # Check if the battle exists and belongs to the user
-                        if battle_id in battles:
-                            battle = battles[battle_id]
-                            if battle.first_opponent == username and not battle.second_opponent:
-                                # Remove the battle
-                                del battles[battle_id]
+                        # Check if the battle exists and belongs to the user; it may have been created on another worker
+                        battle = await find_battle(battle_id)
+                        if battle is not None:
+                            # Removing it from the lobby fails if someone joined in the meantime
+                            change = await withdraw_battle(battle_id) if battle.first_opponent == username and not battle.second_opponent else None
+                            if change is not None:
                                 logger.info(f"Battle {battle_id} cancelled by {username}")
                                 # Notify all users that the battle was removed
-                                for connected_user in manager.active_connections.keys():
-                                    await manager.send_message(json.dumps({
-                                        "type": "battle_removed",
-                                        "data": battle_id
-                                    }), connected_user)
+                                await manager.broadcast(json.dumps(lobby.delta("battle_removed", change)))
                                 await manager.send_message(json.dumps({
                                     "type": "battle_cancelled",
                                     "data": battle_id
@@ -1051,21 +910,44 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
          await manager.disconnect(actual_username)
          logger.info(f"Cleaned up connection for client {actual_username}")
 
+username_cleanup_task: Optional[asyncio.Task] = None
+
 @app.on_event("startup")
 async def startup_event():
     await init_models()
-
-    asyncio.create_task(monitor_inactive_players())
     
-    try:
-        from db.router import cleanup_old_usernames
-        cleanup_result = await cleanup_old_usernames()
-        logger.info(f"Old username cleanup completed: {cleanup_result}")
-    except Exception as e:
-        logger.error(f"Error during old username cleanup: {e}")
+    # The orphaned-relation sweep runs in the background so startup does not wait on it
+    global username_cleanup_task
+    from db.router import run_username_cleanup
+    username_cleanup_task = asyncio.get_event_loop().create_task(run_username_cleanup())
     
     logger.info("WebSocket server started successfully")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    if username_cleanup_task is not None and not username_cleanup_task.done():
+        username_cleanup_task.cancel()
+    # Running maintenance jobs stop at their last checkpoint and can be resumed
+    from maintenance import maintenance
+    await maintenance.shutdown()
+    # Flush pending leaderboard write-back before the scheduler drops its deadlines
+    from battle.leaderboard import leaderboard
+    await leaderboard.shutdown()
+    await scheduler.shutdown()
+    if manager.bus is not None:
+        await manager.bus.shutdown()
+    from battle.answer_writer import answer_writer
+    await answer_writer.shutdown()
+    from quiz_events import quiz_ready_listener
+    await quiz_ready_listener.shutdown()
+    from battle.state import battle_state
+    await battle_state.shutdown()
+    await lobby.shutdown()
+    from user_cache import user_cache
+    await user_cache.shutdown()
+    from redis_pool import redis_pool
+    await redis_pool.close()
+
 class ChatConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, List[WebSocket]] = {}
@@ -1090,10 +972,11 @@ class ChatConnectionManager:
         for connection in self.active_connections.get(chat_id, []):
             await connection.send_text(message)
 
-    def save_message(self, chat_message: ChatCreate):
-        db = SessionLocal()
-        try:
+    async def save_message(self, chat_message: ChatCreate):
+        from init import SessionLocal
+        async with SessionLocal() as db:
             db_message = Chat(
+                id=str(uuid.uuid4()),
                 chat_id=f"{chat_message.sender}_{chat_message.receiver}",
                 sender=chat_message.sender,
                 receiver=chat_message.receiver,
@@ -1101,17 +984,15 @@ class ChatConnectionManager:
                 message_type=chat_message.message_type or 'text'
             )
             db.add(db_message)
-            db.commit()
-            db.refresh(db_message)
+            await db.commit()
+            await db.refresh(db_message)
             return db_message
-        finally:
-            db.close()
 
-    def get_chat_history(self, sender: str, receiver: str):
-        db = SessionLocal()
-        try:
+    async def get_chat_history(self, sender: str, receiver: str):
+        from init import SessionLocal
+        async with SessionLocal() as db:
             chat_id = f"{sender}_{receiver}"
-            messages = db.query(Chat).filter(
+            result = await db.execute(select(Chat).where(
                 and_(
                     Chat.chat_id == chat_id,
                     or_(
@@ -1119,10 +1000,8 @@ class ChatConnectionManager:
                         and_(Chat.sender == receiver, Chat.receiver == sender)
                     )
                 )
-            ).order_by(Chat.timestamp).all()
-            return [msg.to_dict() for msg in messages]
-        finally:
-            db.close()
+            ).order_by(Chat.timestamp))
+            return [msg.to_dict() for msg in result.scalars().all()]
 
 chat_manager = ChatConnectionManager()
 
@@ -1147,7 +1026,7 @@ async def chat_websocket_endpoint(
             )
             
             # Save message to database
-            saved_message = chat_manager.save_message(chat_message)
+            saved_message = await chat_manager.save_message(chat_message)
             
             # Broadcast to all connections in this chat
             await chat_manager.broadcast(
@@ -1159,39 +1038,29 @@ async def chat_websocket_endpoint(
     except WebSocketDisconnect:
         chat_manager.disconnect(websocket, username, chat_id)
 
-async def get_cached_questions(battle_id: str):
-    """
-    Retrieve cached questions for a specific battle
-    
-    Args:
-        battle_id: Unique identifier for the battle
-    
-    Returns:
-        List of questions or None if not found
-    """
+async def deliver_battle_questions(battle: Battle):
+    """Wait for the worker's quiz_ready event, attach the questions to the battle and tell both players"""
+    from quiz_events import quiz_ready_listener
     try:
-        # Use the same Redis URL as in other parts of the application
-        redis_client = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"))
-        
-        # Construct the key used for caching questions
-        questions_key = f"battle_questions:{battle_id}"
-        
-        # Retrieve and decode the cached questions
-        cached_questions = redis_client.get(questions_key)
-        
-        if cached_questions:
+        questions = await quiz_ready_listener.wait_for_questions(battle.id)
+        if not questions:
+            logger.warning(f"No quiz published for battle {battle.id} in time, using fallback questions")
             try:
-                questions = json.loads(cached_questions)
-                return questions
-            except json.JSONDecodeError:
-                logger.error(f"Failed to decode cached questions for battle {battle_id}")
-                return None
-        
-        return None
-    
+                questions = ai_quiz_generator.generate_questions(battle.sport, battle.level, 5, battle.id)
+            except Exception as e:
+                logger.error(f"Error getting fallback questions for battle {battle.id}: {str(e)}")
+                questions = []
+        battle.questions = questions
     except Exception as e:
-        logger.error(f"Error retrieving cached questions for battle {battle_id}: {str(e)}")
-        return None
+        logger.error(f"Error waiting for questions: {str(e)}")
+        battle.questions = []
+        return
+
+    if battle.questions:
+        await manager.send_many({
+            "type": "quiz_ready",
+            "data": {"battle_id": battle.id, "question_count": len(battle.questions)}
+        }, (battle.first_opponent, battle.second_opponent))
 
 class SimpleChatConnectionManager:
     def __init__(self):
@@ -1223,12 +1092,12 @@ class SimpleChatConnectionManager:
         """Save message to simple chat database using async operations"""
         try:
             from models import SimpleChatMessage
-            from db.init import AsyncSessionLocal
+            from init import SessionLocal
             import uuid
             from datetime import datetime
             
             # Create async database session
-            async with AsyncSessionLocal() as db:
+            async with SessionLocal() as db:
                 try:
                     # Create new message
                     new_message = SimpleChatMessage(
@@ -1258,33 +1127,6 @@ class SimpleChatConnectionManager:
             print(f"Import error saving message: {import_error}")
             return None
 
-    def save_message_to_db(self, sender: str, receiver: str, message: str, message_type: str = 'text'):
-        """Save message to simple chat database (sync wrapper for async function)"""
-        import asyncio
-        
-        try:
-            # Get the current event loop or create a new one
-            try:
-                loop = asyncio.get_event_loop()
-            except RuntimeError:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-            
-            # Run the async function
-            if loop.is_running():
-                # If loop is already running, create a task
-                import concurrent.futures
-                with concurrent.futures.ThreadPoolExecutor() as executor:
-                    future = executor.submit(asyncio.run, self.save_message_to_db_async(sender, receiver, message, message_type))
-                    return future.result()
-            else:
-                # If no loop is running, run directly
-                return loop.run_until_complete(self.save_message_to_db_async(sender, receiver, message, message_type))
-                
-        except Exception as e:
-            print(f"Error in sync wrapper: {e}")
-            return None
-
 simple_chat_manager = SimpleChatConnectionManager()
 
 async def simple_chat_websocket_endpoint(
@@ -1301,7 +1143,7 @@ async def simple_chat_websocket_endpoint(
             message_data = json.loads(data)
             
             # Save message to database
-            saved_message = simple_chat_manager.save_message_to_db(
+            saved_message = await simple_chat_manager.save_message_to_db_async(
                 sender=username,
                 receiver=receiver,
                 message=message_data.get('message', ''),